@@ -0,0 +1,85 @@
+"""
+ルームへの1回のブロードキャストにかかるエンコード/デコードのCPU時間を計測するマイクロベンチマーク。
+
+- before: publish で json.dumps → 各ソケットの reader で json.loads → send_json で再エンコード
+          (N人のルームで 2N+1 回のエンコード/デコード)
+- after:  publish で encode_frame を1回だけ → 各ソケットには同じ文字列を send_text で送る
+
+    python benchmarks/broadcast_encoding.py --users 100 --rounds 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import frames  # noqa: E402
+
+
+def sample_frame() -> dict:
+    return {
+        "type": "message",
+        "message_id": str(uuid.uuid4()),
+        "username": "参加者A",
+        "content": "地域の公共交通を維持するために、デマンド型の乗り合いバスを導入してはどうでしょうか。" * 3,
+        "stance": "提案",
+        "file_url": None,
+        "original_filename": None,
+        "reactions": {"agree": ["参加者B", "参加者C"], "partial": [], "disagree": []},
+        "reply_to": {"id": str(uuid.uuid4()), "username": "参加者B", "content": "交通の便が悪い地域の課題について"},
+        "is_resolved": False,
+        "created_at": "2025-01-01T12:00:00.000000",
+    }
+
+
+def starlette_send_json(data) -> str:
+    # starlette の WebSocket.send_json と同じエンコード
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def broadcast_before(frame: dict, users: int):
+    published = json.dumps(frame)
+    for _ in range(users):
+        starlette_send_json(json.loads(published))
+
+
+def broadcast_after(frame: dict, users: int):
+    published = frames.encode_frame(frame)
+    sent = []
+    for _ in range(users):
+        sent.append(published)
+
+
+def measure(func, frame, users, rounds) -> float:
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        func(frame, users)
+    return (time.perf_counter() - started_at) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    frame = sample_frame()
+    results = {"users": args.users, "rounds": args.rounds, "orjson": frames.orjson is not None}
+    results["before_us_per_broadcast"] = round(measure(broadcast_before, frame, args.users, args.rounds), 1)
+    results["after_us_per_broadcast"] = round(measure(broadcast_after, frame, args.users, args.rounds), 1)
+
+    # orjson がない環境 (標準 json へのフォールバック) の場合も計測する
+    orjson_module, frames.orjson = frames.orjson, None
+    results["after_stdlib_json_us_per_broadcast"] = round(measure(broadcast_after, frame, args.users, args.rounds), 1)
+    frames.orjson = orjson_module
+
+    results["payload_bytes_before"] = len(json.dumps(frame).encode("utf-8"))
+    results["payload_bytes_after"] = len(frames.encode_frame(frame).encode("utf-8"))
+    print(json.dumps(results, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
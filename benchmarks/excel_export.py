@@ -0,0 +1,136 @@
+"""
+議事録の Excel 書き出しにかかる時間とメモリ (ピーク RSS) を計測するベンチマーク。
+
+- before: 通常の Workbook に全セルを作り、セルごとに Font / Alignment / Border を設定してから保存
+- after:  utils.exports.create_meeting_minutes_excel (write-only モード + 名前付きスタイル + 一時ファイルからの置き換え)
+
+ピーク RSS が前の計測に引きずられないよう、各方式は別のプロセスで実行する。
+
+    python benchmarks/excel_export.py --messages 10000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from openpyxl import Workbook  # noqa: E402
+from openpyxl.styles import Font, Alignment, Border, Side  # noqa: E402
+
+from utils.exports import create_meeting_minutes_excel  # noqa: E402
+
+STANCES = ["意見", "質問", "提案", "賛成", "反対"]
+
+
+def sample_rows(count: int) -> list:
+    return [
+        {
+            "username": f"参加者{i % 30}",
+            "stance": STANCES[i % len(STANCES)],
+            "content": f"{i}番目の発言です。地域の公共交通を維持するために、デマンド型の乗り合いバスを導入してはどうでしょうか。" * 2,
+            "reaction_count": i % 7,
+        }
+        for i in range(count)
+    ]
+
+
+def export_before(rows, topic, participants, file_path):
+    # 変更前の実装 (全セルをメモリに保持し、セルごとにスタイルを設定する)
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "議事録"
+    ws["A1"] = "議題"
+    ws["B1"] = topic
+    ws["A2"] = "参加者"
+    ws["B2"] = ", ".join(participants) if participants else "なし"
+
+    bold_font = Font(bold=True, name="Meiryo UI")
+    normal_font = Font(name="Meiryo UI")
+    center_align = Alignment(horizontal="center", vertical="center")
+    top_left_align = Alignment(horizontal="left", vertical="top", wrap_text=True)
+    top_center_align = Alignment(horizontal="center", vertical="top")
+    thin_border = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
+
+    for cell in ["A1", "B1", "A2", "B2"]:
+        ws[cell].font = normal_font
+    ws["A1"].font = bold_font
+    ws["A2"].font = bold_font
+
+    headers = ["No.", "発言者", "発言の種類", "発言内容", "リアクション数"]
+    header_row = 4
+    for col_idx, header in enumerate(headers, 1):
+        cell = ws.cell(row=header_row, column=col_idx, value=header)
+        cell.font = bold_font
+        cell.alignment = center_align
+        cell.border = thin_border
+
+    for i, row in enumerate(rows, 1):
+        row_idx = header_row + i
+        row_data = [i, row["username"], row["stance"], row["content"], row["reaction_count"]]
+        for col_idx, value in enumerate(row_data, 1):
+            cell = ws.cell(row=row_idx, column=col_idx, value=value)
+            cell.font = normal_font
+            cell.border = thin_border
+            if col_idx == 1 or col_idx == 5: cell.alignment = top_center_align
+            elif col_idx == 4: cell.alignment = top_left_align
+            else: cell.alignment = top_center_align
+
+    ws.column_dimensions["A"].width = 6
+    ws.column_dimensions["B"].width = 15
+    ws.column_dimensions["C"].width = 15
+    ws.column_dimensions["D"].width = 60
+    ws.column_dimensions["E"].width = 15
+    wb.save(file_path)
+
+
+VARIANTS = {"before": export_before, "after": create_meeting_minutes_excel}
+
+
+def run_variant(name: str, count: int, queue):
+    rows = sample_rows(count)
+    participants = sorted({row["username"] for row in rows})
+    # ru_maxrss は KB 単位 (Linux)。入力データを作った後の値との差を書き出し処理の分とする
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "minutes.xlsx")
+        started_at = time.perf_counter()
+        VARIANTS[name](rows, "地域交通の将来", participants, file_path)
+        elapsed = time.perf_counter() - started_at
+        size = os.path.getsize(file_path)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        "seconds": round(elapsed, 3),
+        "peak_rss_mb": round(peak_kb / 1024, 1),
+        "export_rss_mb": round((peak_kb - baseline_kb) / 1024, 1),
+        "file_kb": round(size / 1024, 1),
+    })
+
+
+def measure(name: str, count: int) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_variant, args=(name, count, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000)
+    args = parser.parse_args()
+
+    results = {"messages": args.messages}
+    for name in VARIANTS:
+        results[name] = measure(name, args.messages)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+5W1H 提案フォームの1回の入力 (デバウンス後の1回の送信) あたりに WebSocket で流れるバイト数を比べるベンチマーク。
+
+- before: クライアントが提案の一覧全体を送り (proposal_form_update)、サーバーも一覧全体をルームの全員に配信する
+- after:  変更した項目だけを送り (proposal_patch)、サーバーもその項目だけを配信する
+
+    python benchmarks/proposal_patch_bytes.py --proposals 1 5 20 --users 30
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.frames import encode_frame  # noqa: E402
+
+SAMPLE_VALUES = {
+    "q1": "デマンド型の乗り合いバスを市内全域に導入する",
+    "q2": "高齢者の移動手段を確保し、自家用車の利用を減らして温室効果ガスの排出を削減するため。" * 2,
+    "q3": "2026年度末までに",
+    "q4": "市内全域の公共施設と住宅地",
+    "q5": "【実施者】市の交通政策課\n【対象】高齢者・学生\n【ステークホルダー】地域の交通事業者、自治会",
+    "q6": "補助金・助成、規制・ルール作り、その他：住民ワークショップ",
+    "q7": "backcast",
+}
+
+
+def sample_proposals(count: int) -> list:
+    return [{"id": f"p{i}", **SAMPLE_VALUES} for i in range(count)]
+
+
+def client_send_bytes(frame: dict) -> int:
+    # ブラウザの JSON.stringify と同じく区切りの空白なし・非ASCIIはそのまま (UTF-8 で送られる)
+    return len(json.dumps(frame, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def broadcast_bytes(frame: dict) -> int:
+    return len(encode_frame(frame).encode("utf-8"))
+
+
+def measure(count: int, users: int) -> dict:
+    proposals = sample_proposals(count)
+    # 最後の提案の q2 (なぜ大切か) の末尾に1文字入力した場合
+    edited = proposals[-1]
+    edited["q2"] = edited["q2"] + "。"
+
+    before_up = client_send_bytes({"type": "proposal_form_update", "proposals": proposals})
+    before_down = broadcast_bytes({"type": "proposal_form_update", "proposals": proposals, "sender": "参加者A"})
+
+    after_up = client_send_bytes({
+        "type": "proposal_patch", "proposal_id": edited["id"], "field": "q2", "value": edited["q2"],
+        "version": 12, "client_id": "0f8fad5bd9cb469fa16570867728950e",
+    })
+    after_down = broadcast_bytes({
+        "type": "proposal_patch", "proposal_id": edited["id"], "index": count - 1, "field": "q2",
+        "value": edited["q2"], "version": 13, "client_id": "0f8fad5bd9cb469fa16570867728950e", "sender": "参加者A",
+    })
+    return {
+        "proposals": count,
+        "fields_per_proposal": len(SAMPLE_VALUES),
+        "before": {"upstream": before_up, "per_recipient": before_down, "room_total": before_up + before_down * users},
+        "after": {"upstream": after_up, "per_recipient": after_down, "room_total": after_up + after_down * users},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--proposals", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--users", type=int, default=30)
+    args = parser.parse_args()
+
+    results = {"users": args.users, "bytes_per_keystroke": [measure(count, args.users) for count in args.proposals]}
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+WebSocketフレームの処理レイテンシを計測する負荷ベンチマーク。
+
+起動中のサーバー (例: gunicorn -w 4 -k uvicorn.workers.UvicornWorker main:app) に
+複数の参加者として接続し、各参加者が送ったフレームが room:{room_id} 経由で
+自分に届くまでの時間 (送信 → 配信) を計測して p50 / p95 / p99 を出力する。
+
+変更前後のコミットで同じ条件で実行し、--label を付けて結果を比較する:
+
+    python benchmarks/ws_frame_latency.py --url http://localhost:8000 --users 30 --frames 50 --label before
+    python benchmarks/ws_frame_latency.py --url http://localhost:8000 --users 30 --frames 50 --label after
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+import websockets
+
+
+def create_room(base_url: str) -> str:
+    data = urllib.parse.urlencode({"username": "bench-host", "topic": "benchmark"}).encode()
+    with urllib.request.urlopen(f"{base_url}/create", data=data) as res:
+        return json.loads(res.read())["room_id"]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+def build_frame(kind: str, token: str, target_message_id: str):
+    if kind == "message":
+        return {"type": "message", "stance": "意見", "content": token}
+    if kind == "note":
+        return {"type": "note_update", "content": token}
+    # reaction: 同じメッセージへのリアクションを付け外しする (token は使わない)
+    return {"type": "reaction", "message_id": target_message_id, "reaction": "agree"}
+
+
+def match_frame(kind: str, frame: dict, token: str, target_message_id: str) -> bool:
+    if kind == "message":
+        return frame.get("type") == "message" and frame.get("content") == token
+    if kind == "note":
+        return frame.get("type") == "note_update" and frame.get("content") == token
+    return frame.get("type") == "reaction_update" and frame.get("message_id") == target_message_id
+
+
+async def participant(ws_url: str, username: str, kind: str, frames: int, target_message_id: str,
+                      start: asyncio.Event, latencies: list, rejected: list):
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        await start.wait()
+        for _ in range(frames):
+            token = f"{username}:{uuid.uuid4().hex}"
+            sent_at = time.perf_counter()
+            await ws.send(json.dumps(build_frame(kind, token, target_message_id)))
+            while True:
+                frame = json.loads(await ws.recv())
+                # 混雑などでフレームが反映されなかった場合は送信者にだけ system_message が返る
+                if frame.get("type") == "system_message":
+                    rejected.append((time.perf_counter() - sent_at) * 1000)
+                    break
+                # リアクションは誰の操作か区別できないため、自分の送信後に届いた最初の更新で計測する
+                if match_frame(kind, frame, token, target_message_id):
+                    latencies.append((time.perf_counter() - sent_at) * 1000)
+                    break
+
+
+async def seed_message(ws_base: str, room_id: str) -> str:
+    token = f"seed:{uuid.uuid4().hex}"
+    async with websockets.connect(f"{ws_base}/ws/{room_id}/bench-host", max_size=None) as ws:
+        await ws.send(json.dumps({"type": "message", "stance": "意見", "content": token}))
+        while True:
+            frame = json.loads(await ws.recv())
+            if frame.get("type") == "message" and frame.get("content") == token:
+                return frame["message_id"]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--room", help="既存のルームIDを使う場合に指定 (省略時は新規作成)")
+    parser.add_argument("--users", type=int, default=30)
+    parser.add_argument("--frames", type=int, default=50, help="1人あたりの送信フレーム数")
+    parser.add_argument("--kind", choices=["message", "note", "reaction"], default="reaction")
+    parser.add_argument("--label", default="run")
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip("/")
+    ws_base = base_url.replace("https://", "wss://").replace("http://", "ws://")
+    room_id = args.room or create_room(base_url)
+    target_message_id = await seed_message(ws_base, room_id)
+
+    latencies = []
+    rejected = []
+    start = asyncio.Event()
+    tasks = [
+        asyncio.create_task(participant(
+            f"{ws_base}/ws/{room_id}/bench-{i}", f"bench-{i}", args.kind, args.frames,
+            target_message_id, start, latencies, rejected
+        ))
+        for i in range(args.users)
+    ]
+    # 全員の接続と履歴の受信が落ち着いてから一斉に送信を開始する
+    await asyncio.sleep(1.0)
+    started_at = time.perf_counter()
+    start.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started_at
+
+    result = {
+        "label": args.label,
+        "kind": args.kind,
+        "users": args.users,
+        "frames": len(latencies),
+        "throughput_fps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(max(latencies), 2),
+        "rejected": len(rejected),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,11 @@
 import os
+from fastapi import Request
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 
+from utils.dbmetrics import db_metrics, set_query_site, InstrumentedQueuePool
+
 # Renderの環境変数からデータベースURLを取得
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -13,8 +17,29 @@ if DATABASE_URL:
     elif DATABASE_URL.startswith("postgresql://"):
         DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
 
+# 接続プールの設定。gunicorn のワーカーごとに最大 DB_POOL_SIZE + DB_MAX_OVERFLOW 本の接続を持つため、
+# (ワーカー数 × その合計) が Postgres の接続数の上限に収まるようにする
+ENGINE_OPTIONS = {}
+if DATABASE_URL and DATABASE_URL.startswith("postgresql+asyncpg://"):
+    ENGINE_OPTIONS = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        # 使う前に接続が生きているか確かめ、一定時間使った接続は作り直す (接続の切断・メンテナンス対策)
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        # asyncpg のプリペアドステートメントのキャッシュ (PgBouncer のトランザクションモードでは 0 にする)
+        "connect_args": {"statement_cache_size": int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))},
+    }
+    DATABASE_URL = make_url(DATABASE_URL).update_query_dict({
+        "prepared_statement_cache_size": os.getenv("DB_STATEMENT_CACHE_SIZE", "500"),
+    }).render_as_string(hide_password=False)
+
 # データベースエンジンを作成
-engine = create_async_engine(DATABASE_URL)
+engine = create_async_engine(DATABASE_URL, **ENGINE_OPTIONS)
+# プールの状態とクエリの所要時間を /api/metrics で見られるようにする
+db_metrics.instrument(engine)
 
 # データベースセッションを作成するためのクラス
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
@@ -23,6 +48,9 @@ AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
 # FastAPIのDI（Dependency Injection）で使用するセッション取得関数
-async def get_db():
+async def get_db(request: Request):
+    # このリクエストのクエリは、エンドポイントのパス (例: "GET /api/analytics") ごとに集計する
+    route = request.scope.get("route")
+    set_query_site(f"{request.method} {route.path if route else request.url.path}")
     async with AsyncSessionLocal() as session:
         yield session
\ No newline at end of file
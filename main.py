@@ -1,8 +1,10 @@
 import os
 import re
+import glob
+import hashlib
 import textwrap
 from sqlalchemy.future import select
-from sqlalchemy import delete
+from sqlalchemy import delete, func, or_, and_
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -11,24 +13,20 @@ from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.sql import not_
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm.attributes import flag_modified
-from docx import Document
-from docx.shared import Pt, Cm, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.table import WD_TABLE_ALIGNMENT
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
-from io import BytesIO
+from sqlalchemy.orm.exc import StaleDataError
 
 from database import engine, Base, get_db, AsyncSessionLocal
-from models import Room, Message, PushSubscription
+from models import Room, Message, PushSubscription, UserActivity
+from migrations import run_migrations
 
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse, StreamingResponse
+from fastapi.responses import Response, HTMLResponse, RedirectResponse, JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 import uuid
+from datetime import datetime, timezone
 
 import asyncio
 
@@ -37,16 +35,120 @@ import json
 from contextlib import asynccontextmanager
 from google import genai
 
-from pywebpush import webpush, WebPushException
 
-from utils.summarizer import generate_summary, ask_gemini_simple, analyze_discussion_progress, get_facilitation_from_gemini
-
-from utils.client import get_gemini_client
+from utils.summarizer import (
+    generate_summary, ask_gemini_simple, analyze_discussion_progress, get_facilitation_from_gemini,
+    summarize_transcript_segment, merge_transcript_summaries, is_ai_error_reply
+)
+
+from utils.client import get_gemini_client, get_llm_gateway, close_gemini_client
+from utils.llm import LLMCancelledError
+from utils.jobs import BackgroundJobQueue, DurableJobQueue
+from utils.sequencer import RoomSequencer, LeaseTimeoutError
+from utils.hub import RoomHub
+from utils.transcript import TranscriptCache, TranscriptCompactor
+from utils.ai_cache import AIResponseCache
+from utils.notes import SharedNoteStore, NoteResyncRequired, NoteClosedError
+from utils.proposals import ProposalFormStore, ProposalPatchError, ProposalConflictError
+from utils.reactions import MessageReactionStore
+from utils.replies import ReplyParentCache, parent_summary
+from utils.writebehind import WriteBehindJournal
+from utils.uploads import UploadStore, UploadTooLargeError
+from utils.frames import encode_frame
+from utils.dbmetrics import db_metrics, set_query_site
+from utils.exports import (
+    minutes_rows, create_meeting_minutes_excel, write_proposals_docx, load_proposals_template,
+    PROPOSALS_TEMPLATE_VERSION
+)
+from utils.push import PushDispatcher, webpush_sender
+from utils.events import (
+    append_events, event_row, message_event, claim_journal_entries, build_range_analytics, replay_room,
+)
+from utils.activity import (
+    bump_activity, stance_metric, build_room_user_report, AnalyticsSnapshot,
+    NON_PARTICIPANT_USERNAMES
+)
 import textwrap
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side
 redis_client = None
 
+# Gemini呼び出し・議事録作成など、ルームのロック外で実行する処理のキュー
+job_queue = BackgroundJobQueue(workers=int(os.getenv("AI_JOB_WORKERS", "4")))
+
+# 議事録・Excel・Word の作成ジョブ (DBに記録し、切断・再起動後も最後まで実行する)
+# 文書の生成はプロセスプールで行い、イベントループを止めない
+artifact_jobs = DurableJobQueue(
+    AsyncSessionLocal,
+    workers=int(os.getenv("ARTIFACT_JOB_WORKERS", "2")),
+    processes=int(os.getenv("ARTIFACT_PROCESSES", "2")),
+    lease_seconds=float(os.getenv("ARTIFACT_JOB_LEASE_SECONDS", "60")),
+    max_attempts=int(os.getenv("ARTIFACT_JOB_MAX_ATTEMPTS", "3")),
+    # 各プロセスの起動時に提言案の Word のテンプレートを用意しておく
+    process_initializer=load_proposals_template,
+)
+
+# Roomの行を更新する書き込みをルームごとに直列化する (SELECT ... FOR UPDATE の代わり)
+room_sequencer = RoomSequencer(lease_ttl_ms=int(os.getenv("ROOM_LEASE_TTL_MS", "5000")))
+
+# ワーカー内でルームごとに1つだけ Redis を購読し、接続中のソケットに配る
+room_hub = RoomHub(queue_size=int(os.getenv("WS_SEND_QUEUE_SIZE", "256")))
+
+# AIに渡す議論ログをルームごとに保持し、room_hub に届いたフレームで差分更新する
+transcript_cache = TranscriptCache(AsyncSessionLocal, room_hub)
+
+# 返信の引用に使う直近の発言の要約 (返信の投稿時に返信元をDBから読まない)
+reply_parents = ReplyParentCache(AsyncSessionLocal, room_hub, max_per_room=int(os.getenv("REPLY_CACHE_SIZE", "500")))
+
+# 長いルームでは古い発言を区間ごとに要約して保存し、AIには「要約 + 直近の発言」だけを渡す
+transcript_compactor = TranscriptCompactor(
+    AsyncSessionLocal,
+    transcript_cache,
+    summarize=summarize_transcript_segment,
+    merge=merge_transcript_summaries,
+    tail_size=int(os.getenv("ROLLING_TAIL_MESSAGES", "60")),
+    segment_size=int(os.getenv("ROLLING_SEGMENT_MESSAGES", "40")),
+    max_segments=int(os.getenv("ROLLING_MAX_SEGMENTS", "8")),
+)
+# AIに渡す議論ログの形式の既定値 ("rolling": 要約 + 直近の発言 / "full": 全発言)
+# ファシリテーション・進捗確認は rolling、議事録は全発言を既定にする (呼び出しごとに context_mode で切り替え可)
+AI_CONTEXT_MODE = os.getenv("AI_CONTEXT_MODE", "rolling")
+SUMMARY_CONTEXT_MODE = os.getenv("SUMMARY_CONTEXT_MODE", "full")
+CONTEXT_MODES = ("rolling", "full")
+
+# ファシリテーション・進捗確認の結果を、ルームの状態バージョンごとにキャッシュする
+ai_response_cache = AIResponseCache(
+    ttl=int(os.getenv("AI_CACHE_TTL_SECONDS", "300")),
+    lock_ttl_ms=int((float(os.getenv("LLM_TIMEOUT_SECONDS", "180")) + 20) * 1000),
+)
+
+# 分析画面の全体・ルーム別の合計は、リクエストごとではなく一定間隔でまとめて読み直す
+analytics_snapshot = AnalyticsSnapshot(
+    AsyncSessionLocal, refresh_interval=float(os.getenv("ANALYTICS_REFRESH_SECONDS", "15"))
+)
+
+# ノート・提案フォームの編集とリアクションは Redis 上の状態に適用してすぐに配信し、
+# 変更の記録 (Redis Stream) から一定間隔でまとめて Postgres に書き込む。
+# 記録はルームの出来事の記録 (room_events) に source_id 付きで追記し、再配送された記録は反映しない。
+# 反映した記録は活動カウンタも変えるため、コミット後に分析画面の作り直しを知らせる
+write_behind = WriteBehindJournal(
+    AsyncSessionLocal,
+    flush_interval=float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "5")),
+    claim=claim_journal_entries,
+    on_applied=analytics_snapshot.bump,
+)
+
+# 共有ノートの正本は Redis に置き、編集は操作 (OT) として配信する
+note_store = SharedNoteStore(AsyncSessionLocal, write_behind)
+
+# 5W1H 提案フォームも正本は Redis に置き、変更は項目単位で配信する
+proposal_store = ProposalFormStore(AsyncSessionLocal, write_behind)
+
+# リアクションの付け外しは Redis 上で原子的に行う
+reaction_store = MessageReactionStore(AsyncSessionLocal, write_behind)
+
+write_behind.register("note", note_store.persist)
+write_behind.register("proposal", proposal_store.persist)
+write_behind.register("reaction", reaction_store.persist)
+
 VAPID_PRIVATE_KEY = os.getenv("VAPID_PRIVATE_KEY")
 VAPID_PUBLIC_KEY = os.getenv("VAPID_PUBLIC_KEY")
 
@@ -54,6 +156,14 @@ VAPID_CLAIMS = {
     "sub": "mailto:admin@example.com"
 }
 
+# Web Push の送信キュー (VAPIDキーが未設定の場合は送信しない)
+push_dispatcher = PushDispatcher(
+    AsyncSessionLocal,
+    sender=webpush_sender(VAPID_PRIVATE_KEY, VAPID_CLAIMS) if VAPID_PRIVATE_KEY and VAPID_PUBLIC_KEY else None,
+    workers=int(os.getenv("PUSH_WORKERS", "4")),
+    coalesce_window=float(os.getenv("PUSH_COALESCE_SECONDS", "3")),
+)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # アプリケーション起動時に実行
@@ -61,6 +171,7 @@ async def lifespan(app: FastAPI):
     # データベースのテーブルを作成
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await run_migrations(conn)
     
     # Redisへの接続
     global redis_client
@@ -73,10 +184,37 @@ async def lifespan(app: FastAPI):
         print(f"Redisへの接続に失敗しました: {e}")
         redis_client = None
 
+    room_sequencer.attach_redis(redis_client)
+    room_hub.attach_redis(redis_client)
+    push_dispatcher.attach_redis(redis_client)
+    ai_response_cache.attach_redis(redis_client)
+    analytics_snapshot.attach_redis(redis_client)
+    artifact_jobs.attach_redis(redis_client)
+    note_store.attach_redis(redis_client)
+    proposal_store.attach_redis(redis_client)
+    reaction_store.attach_redis(redis_client)
+    write_behind.attach_redis(redis_client)
+    job_queue.start()
+    artifact_jobs.start()
+    push_dispatcher.start()
+    upload_store.start()
+    analytics_snapshot.start()
+    await write_behind.start()
+    job_queue.submit("index_existing_uploads", upload_store.index_existing)
+
     yield  # ここでアプリケーションが実行される
 
     # アプリケーション終了時に実行
     print("アプリケーションを終了します...")
+    await job_queue.stop()
+    await artifact_jobs.stop()
+    await push_dispatcher.stop()
+    await upload_store.stop()
+    await analytics_snapshot.stop()
+    await write_behind.stop()
+    await room_sequencer.stop()
+    await room_hub.stop()
+    await close_gemini_client()
     if redis_client:
         await redis_client.close()
         print("Redisとの接続を閉じました。")
@@ -109,6 +247,7 @@ async def subscribe(sub: SubscriptionSchema, db: AsyncSession = Depends(get_db))
         if existing_sub.username != sub.username:
             existing_sub.username = sub.username
             await db.commit()
+            await push_dispatcher.invalidate(sub.room_id)
     else:
         new_sub = PushSubscription(
             room_id=sub.room_id,
@@ -119,48 +258,27 @@ async def subscribe(sub: SubscriptionSchema, db: AsyncSession = Depends(get_db))
         )
         db.add(new_sub)
         await db.commit()
+        await push_dispatcher.invalidate(sub.room_id)
     return {"message": "Subscribed successfully"}
 
-# 3. 通知送信のヘルパー関数
-async def send_push_notification(subscriptions: list, message_content: str, sender_name: str, exclude_users: set):
-    try:
-        if not VAPID_PRIVATE_KEY or not VAPID_PUBLIC_KEY:
-            return
-
-        # DBアクセスは削除し、渡されたリストを使用する
-        for sub in subscriptions:
-            if sub.username == sender_name or sub.username in exclude_users:
-                continue
-            
-            payload = json.dumps({
-                "title": f"{sender_name}さんからのメッセージ",
-                "body": message_content[:100],
-                "url": f"/room/{sub.room_id}?username={sub.username}" # sub.room_idを使用
-            })
-
-            try:
-                await asyncio.to_thread(
-                    webpush,
-                    subscription_info={
-                        "endpoint": sub.endpoint,
-                        "keys": {"p256dh": sub.p256dh, "auth": sub.auth}
-                    },
-                    data=payload,
-                    vapid_private_key=VAPID_PRIVATE_KEY,
-                    vapid_claims=VAPID_CLAIMS
-                )
-            except Exception as e:
-                print(f"Notification Error for {sub.username}: {e}")
-
-    except Exception as e:
-        print(f"Error in send_push_notification: {e}")
-
 UPLOAD_DIR = "static/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# 添付ファイルの保存 (内容のハッシュで重複を排除) と Gemini へのバックグラウンドアップロード
+upload_store = UploadStore(
+    AsyncSessionLocal,
+    UPLOAD_DIR,
+    get_gemini_client,
+    max_bytes=int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024,
+    workers=int(os.getenv("UPLOAD_WORKERS", "2")),
+)
+
 EXCEL_DIR = "static/excels"
 os.makedirs(EXCEL_DIR, exist_ok=True)
 
+WORD_DIR = "static/words"
+os.makedirs(WORD_DIR, exist_ok=True)
+
 FONT_PATH = "fonts/ipaexg.ttf"
 if not os.path.exists("fonts"):
     os.makedirs("fonts")
@@ -196,7 +314,6 @@ async def create_room(username: str = Form(...), topic: str = Form(...), db: Asy
     new_room = Room(
         room_id=room_id,
         topic=topic,
-        analytics={"users": {}}, # analyticsの初期構造を作成
         proposals_data=[]
     )
     db.add(new_room)
@@ -232,6 +349,561 @@ async def room(request: Request, room_id: str, username: str, db: AsyncSession =
         "vapid_public_key": VAPID_PUBLIC_KEY 
     })
 
+def resolve_context_mode(mode: str = None, default_mode: str = AI_CONTEXT_MODE) -> str:
+    return mode if mode in CONTEXT_MODES else default_mode
+
+async def get_prompt_transcript(room_id: str, topic: str, mode: str = None, default_mode: str = AI_CONTEXT_MODE,
+                                wait_for_compaction: bool = False):
+    """
+    AIに渡す議論ログを返す。rolling の場合は要約の追いついていない発言が溜まっていれば
+    要約ジョブを投入する (wait_for_compaction の場合はその場で要約が追いつくのを待つ)。
+    """
+    if resolve_context_mode(mode, default_mode) != "rolling":
+        return await transcript_cache.get(room_id)
+
+    rolling = await transcript_compactor.rolling(room_id)
+    if transcript_compactor.needs_compaction(rolling):
+        if wait_for_compaction:
+            await transcript_compactor.compact(room_id, topic)
+            rolling = await transcript_compactor.rolling(room_id)
+        else:
+            job_queue.submit("transcript_compaction", transcript_compactor.compact, room_id, topic)
+    return rolling
+
+# Geminiの応答を生成しながら gemini_delta フレームで逐次配信するか
+# (完成した応答は従来どおり保存して gemini_response / message フレームで配信し、クライアントは同じ message_id の表示を置き換える)
+AI_STREAMING = os.getenv("AI_STREAMING", "true").lower() == "true"
+
+def gemini_delta_publisher(room_id: str, message_id: str, username: str, stance: str):
+    """ストリーミングの断片をルームに配信する関数 (ストリーミングしない場合は None) を返す"""
+    if not AI_STREAMING or not redis_client:
+        return None
+
+    async def publish_delta(delta: str):
+        await redis_client.publish(f"room:{room_id}", encode_frame({
+            "type": "gemini_delta", "message_id": message_id, "username": username, "stance": stance, "delta": delta,
+        }))
+    return publish_delta
+
+async def abort_gemini_stream(room_id: str, message_id: str):
+    """配信途中の応答を保存しなかった場合に、クライアントの途中までの表示を消させる"""
+    if AI_STREAMING and redis_client:
+        await redis_client.publish(f"room:{room_id}", encode_frame({"type": "gemini_delta", "message_id": message_id, "aborted": True}))
+
+# --- バックグラウンドジョブ (ルームのロックを保持せずに実行) ---
+async def answer_gemini_question(room_id: str, question: str, file_ref: str = None, owner: str = None):
+    """Geminiへの質問に回答し、回答を短いトランザクションで保存してルームに配信する"""
+    files_to_ask = await upload_store.resolve([file_ref]) if file_ref else []
+    # 配信中の断片と保存後のメッセージを同じIDで結びつける
+    message_id = str(uuid.uuid4())
+    try:
+        gemini_answer = await ask_gemini_simple(
+            question, files=files_to_ask, room_id=room_id, owner=owner,
+            on_text=gemini_delta_publisher(room_id, message_id, "Gemini", "Geminiからの回答")
+        )
+    except LLMCancelledError:
+        # 質問した接続が切断された場合は、回答を保存・配信しない
+        print(f"Geminiへの質問は取り消されました (Room: {room_id})")
+        await abort_gemini_stream(room_id, message_id)
+        return
+
+    async with AsyncSessionLocal() as db:
+        async with db.begin():
+            answer_message_obj = Message(
+                message_id=message_id,
+                room_id=room_id,
+                username="Gemini",
+                content=gemini_answer,
+                stance="Geminiからの回答"
+            )
+            db.add(answer_message_obj)
+            await db.flush()
+            await append_events(db, [message_event(answer_message_obj)])
+
+    await ai_response_cache.bump(room_id)
+    if redis_client:
+        await redis_client.publish(f"room:{room_id}", encode_frame({"type": "gemini_response", **answer_message_obj.to_dict()}))
+
+# --- 議事録の Excel ---
+# ルームの最後の発言 (と発言数) と最後のリアクションごとに1つだけ作り、どちらも変わっていなければ作成済みのファイルを返す
+minutes_excel_stats = {"hits": 0, "built": 0, "shared": 0}
+_minutes_excel_builds = {}
+
+def minutes_excel_url(room_id: str) -> str:
+    return f"/excels/meeting_minutes_{room_id}.xlsx"
+
+async def minutes_excel_key(db, room_id: str) -> str:
+    """議事録の Excel のキャッシュキー (最後の発言のIDと発言数、ルームのリアクションのバージョンから作る)"""
+    minutes_filter = (Message.room_id == room_id, Message.stance != "summary")
+    res = await db.execute(
+        select(Message.message_id)
+        .filter(*minutes_filter)
+        .order_by(Message.created_at.desc(), Message.message_id.desc())
+        .limit(1)
+    )
+    last_message_id = res.scalar() or "-"
+    count = (await db.execute(select(func.count(Message.message_id)).filter(*minutes_filter))).scalar()
+    # リアクション数の列も Excel に載るため、リアクションが変わったら作り直す
+    # (Redis のバージョンを使い、まだDBに書き込まれていないリアクションのために書き込みの記録を反映しなくてよいようにする)
+    reaction_version = await reaction_store.room_version(room_id)
+    return hashlib.sha256(f"{last_message_id}:{count}:{reaction_version}".encode("utf-8")).hexdigest()[:16]
+
+async def ensure_minutes_excel(room_id: str):
+    """最新の議事録の Excel のパスを返す (なければ作る)。ルームが存在しない場合は None"""
+    async with AsyncSessionLocal() as db:
+        key = await minutes_excel_key(db, room_id)
+    file_path = os.path.join(EXCEL_DIR, f"meeting_minutes_{room_id}_{key}.xlsx")
+    if os.path.exists(file_path):
+        minutes_excel_stats["hits"] += 1
+        return file_path
+
+    # 同じファイルの同時の作成要求は1回にまとめる
+    task = _minutes_excel_builds.get(file_path)
+    if task is not None:
+        minutes_excel_stats["shared"] += 1
+        return await asyncio.shield(task)
+    task = asyncio.create_task(build_minutes_excel(room_id, file_path))
+    _minutes_excel_builds[file_path] = task
+    task.add_done_callback(lambda _: _minutes_excel_builds.pop(file_path, None))
+    return await asyncio.shield(task)
+
+async def build_minutes_excel(room_id: str, file_path: str):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Room.topic).filter_by(room_id=room_id))
+        topic = result.scalar()
+        if topic is None:
+            return None
+        # 必要な列だけを読み、プロセスプールに渡せるよう辞書にする
+        res = await db.execute(
+            select(
+                Message.message_id, Message.username, Message.stance, Message.content,
+                Message.agree_count, Message.partial_count, Message.disagree_count
+            )
+            .filter(Message.room_id == room_id, Message.stance != "summary")
+            .order_by(Message.created_at)
+        )
+        rows = res.all()
+        minutes = minutes_rows(rows)
+        res_participants = await db.execute(
+            select(UserActivity.username)
+            .filter(UserActivity.room_id == room_id, UserActivity.username.notin_(NON_PARTICIPANT_USERNAMES))
+            .distinct()
+            .order_by(UserActivity.username)
+        )
+        participants = res_participants.scalars().all()
+
+    # まだDBに書き込まれていないリアクションは Redis の値を使う (履歴の読み込みと同じ)
+    latest_reactions = await reaction_store.current(row.message_id for row in rows)
+    for row, minute in zip(rows, minutes):
+        if row.message_id in latest_reactions:
+            minute["reaction_count"] = sum(latest_reactions[row.message_id].values())
+
+    await artifact_jobs.run_in_process(create_meeting_minutes_excel, minutes, topic, list(participants), file_path)
+    minutes_excel_stats["built"] += 1
+    remove_minutes_excels(room_id, keep=file_path)
+    return file_path
+
+def remove_minutes_excels(room_id: str, keep: str = None):
+    """ルームの古い議事録の Excel を削除する"""
+    for path in glob.glob(os.path.join(EXCEL_DIR, f"meeting_minutes_{room_id}_*.xlsx")):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+async def build_meeting_summary(room_id: str, context_mode: str = None):
+    """議事録とExcelを作成し、結果を短いトランザクションで保存してルームに配信する"""
+    # 1. 必要なデータをロックなしで読み取る
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Room).filter_by(room_id=room_id))
+        room_obj = result.scalars().first()
+        if not room_obj:
+            return {}
+
+        note_content = room_obj.shared_note
+        proposals_data = room_obj.proposals_data or []
+        topic = room_obj.topic
+    note_content = await note_store.text(room_id, note_content)
+    proposals_data = await proposal_store.snapshot(room_id, proposals_data)
+
+    # 2. DB接続を保持しないままGeminiとExcel作成を実行
+    transcript = await get_prompt_transcript(
+        room_id, topic, context_mode, default_mode=SUMMARY_CONTEXT_MODE, wait_for_compaction=True
+    )
+    summary_content = await generate_summary(
+        transcript,
+        topic,
+        files=await upload_store.resolve(transcript.file_refs()),
+        note_content=note_content,
+        proposals_data=proposals_data,
+        room_id=room_id
+    )
+
+    await ensure_minutes_excel(room_id)
+    excel_url = minutes_excel_url(room_id)
+
+    summary_data_dict = {
+        "content": summary_content,
+        "excel_url": excel_url  # キー名を pdf_url から excel_url に変更
+    }
+
+    # 3. 結果だけを短いトランザクションで保存
+    async with AsyncSessionLocal() as db:
+        async with db.begin():
+            res_summary = await db.execute(select(Message).filter_by(room_id=room_id, stance="summary"))
+            summary_message_obj = res_summary.scalars().first()
+
+            if summary_message_obj:
+                summary_message_obj.content = json.dumps(summary_data_dict)
+                flag_modified(summary_message_obj, "content")
+            else:
+                summary_message_obj = Message(
+                    room_id=room_id,
+                    username="System",
+                    content=json.dumps(summary_data_dict),
+                    stance="summary"
+                )
+                db.add(summary_message_obj)
+
+    if redis_client:
+        publish_data = {"type": "summary", **summary_data_dict}
+        await redis_client.publish(f"room:{room_id}", encode_frame(publish_data))
+    return {"excel_url": excel_url}
+
+async def run_meeting_summary_job(job: dict):
+    return await build_meeting_summary(job["room_id"], job["payload"].get("context_mode"))
+
+def proposals_word_path(digest: str) -> str:
+    return os.path.join(WORD_DIR, f"proposals_{digest}.docx")
+
+async def run_proposals_word_job(job: dict):
+    payload = job["payload"]
+    file_path = proposals_word_path(payload["digest"])
+    await artifact_jobs.run_in_process(write_proposals_docx, payload["topic"], payload["proposals"], file_path)
+    return {"file_url": f"/words/{os.path.basename(file_path)}"}
+
+artifact_jobs.register("meeting_summary", run_meeting_summary_job)
+artifact_jobs.register("proposals_word", run_proposals_word_job)
+
+# --- WebSocketフレームのハンドラ ---
+# 各ハンドラはトランザクション内でDBを更新するだけにし、配信・通知・ジョブ投入は
+# FrameOutcome に溜めてコミット後に行う (楽観的ロックの再試行で二重配信しないため)
+class FrameOutcome:
+    def __init__(self, owner: str = None):
+        self.owner = owner            # フレームを送った接続のID (切断時にAI呼び出しを取り消すため)
+        self.frames = []              # room:{room_id} に配信するペイロード
+        self.jobs = []                # (ジョブ名, コルーチン関数, 引数) コミット後に job_queue へ投入
+        self.artifact_jobs = []       # トランザクション内で登録した成果物ジョブ (コミット後にワーカーを起こす)
+        self.push_notification = None # 通知本文 (コミット後に push_dispatcher へ渡す)
+        self.after_commit = []        # コミット後に行う Redis 上の後始末 (引数なしのコルーチン関数)
+
+async def record_activity(room_id: str, entries):
+    """活動カウンタの加算だけを短いトランザクションで行う (Roomの行には触れない)"""
+    async with AsyncSessionLocal() as db:
+        async with db.begin():
+            await bump_activity(db, room_id, entries)
+    await analytics_snapshot.bump()
+
+async def handle_chat_message(db, room_obj, room_id, username, data, outcome):
+    stance = data["stance"].strip()
+    content = data["content"]
+
+    await bump_activity(db, room_id, [
+        (username, "posts", 1),
+        (username, stance_metric(stance), 1),
+    ])
+
+    parent_message_dict = None
+    if data.get("reply_to_id"):
+        parent_message_dict = await reply_parents.get(db, room_id, data["reply_to_id"])
+
+    new_message = Message(
+        room_id=room_id,
+        username=username,
+        content=content,
+        stance=stance,
+        file_url=data.get("file_url"),
+        original_filename=data.get("original_filename"),
+        gemini_file_ref=data.get("gemini_file_ref"),
+        reply_to_id=data.get("reply_to_id")
+    )
+    db.add(new_message)
+    await db.flush()
+    await append_events(db, [message_event(new_message)])
+    outcome.after_commit.append(analytics_snapshot.bump)
+
+    # 購読一覧の取得と送信は push_dispatcher がトランザクションの外で行う
+    outcome.push_notification = content
+    outcome.frames.append({"type": "message", **new_message.to_dict(parent_message_dict)})
+
+    if stance == "Geminiへの質問":
+        # 回答の生成はロックの外（コミット後）でバックグラウンド実行する
+        outcome.jobs.append(("gemini_question", answer_gemini_question, (room_id, content, new_message.gemini_file_ref, outcome.owner)))
+
+async def handle_delete_message(db, room_obj, room_id, username, data, outcome):
+    message_id_to_delete = data.get("message_id")
+    res = await db.execute(select(Message).filter_by(message_id=message_id_to_delete, room_id=room_id))
+    message_to_delete = res.scalars().first()
+    if not message_to_delete or message_to_delete.username != username:
+        return
+
+    await bump_activity(db, room_id, [
+        (username, "posts", -1),
+        (username, stance_metric(message_to_delete.stance), -1),
+    ])
+
+    await db.delete(message_to_delete)
+    await append_events(db, [event_row(
+        room_id, "delete", username, message_id_to_delete, {"stance": message_to_delete.stance}
+    )])
+    # 再試行・ロールバックで削除されなかった場合にリアクションを消さないよう、コミット後に消す
+    outcome.after_commit.append(lambda: reaction_store.forget(message_id_to_delete))
+    outcome.after_commit.append(analytics_snapshot.bump)
+    outcome.frames.append({"type": "message_deleted", "message_id": message_id_to_delete})
+
+async def handle_resolve_proposal(db, room_obj, room_id, username, data, outcome):
+    message_id_to_resolve = data.get("message_id")
+    res = await db.execute(select(Message).filter_by(message_id=message_id_to_resolve, room_id=room_id))
+    message_to_resolve = res.scalars().first()
+    if message_to_resolve and message_to_resolve.stance == "提案":
+        if not message_to_resolve.is_resolved:
+            await append_events(db, [event_row(room_id, "resolve", username, message_id_to_resolve)])
+        message_to_resolve.is_resolved = True
+        outcome.frames.append({"type": "proposal_resolved", "message_id": message_id_to_resolve})
+
+async def flush_closed_room():
+    # 溜まっているノート・提案フォーム・リアクションの変更をすぐにDBへ書き込む
+    write_behind.wake()
+
+async def handle_finish(db, room_obj, room_id, username, data, outcome):
+    room_obj.status = "終了"
+    await append_events(db, [event_row(room_id, "finish", username)])
+    # ノート・提案フォームの編集の締め切りはコミット後に行う (ルームが終了しなかった場合に閉じないため)
+    outcome.after_commit.append(lambda: note_store.close(room_id))
+    outcome.after_commit.append(lambda: proposal_store.close(room_id))
+    outcome.after_commit.append(flush_closed_room)
+    # 議事録・Excelの作成ジョブはルームの終了と同じトランザクションで登録し、コミット後に別のタスクで実行する
+    # (ルームごとに1つだけ作り、終了ボタンが何度押されても作り直さない)
+    job = await artifact_jobs.enqueue(
+        db, "meeting_summary", room_id, f"meeting_summary:{room_id}", {"context_mode": data.get("context_mode")}
+    )
+    outcome.artifact_jobs.append(job)
+    if job["status"] == "done":
+        outcome.frames.append({"type": "system_message", "content": "議事録は作成済みです。"})
+    else:
+        outcome.frames.append({"type": "system_message", "content": "議事録を作成中です。しばらくお待ちください..."})
+
+# フレーム種別 -> (ハンドラ, Roomの行 (status) を更新するか)
+# Roomを更新しないフレームはシーケンサー（ルームのリース）を通さずに実行する
+# (活動カウンタは user_activity への原子的な加算なので、Roomのロックは不要)
+FRAME_HANDLERS = {
+    "message": (handle_chat_message, False),
+    "delete_message": (handle_delete_message, False),
+    "resolve_proposal": (handle_resolve_proposal, False),
+    "finish": (handle_finish, True),
+}
+
+OPTIMISTIC_RETRIES = 3
+
+async def run_room_transaction(room_id: str, func, load_room: bool = True):
+    """
+    func(db, room_obj) を1つのトランザクションで実行する。
+    Roomのバージョンが他の書き込みと競合した場合 (StaleDataError) は最初からやり直す。
+    """
+    for attempt in range(1, OPTIMISTIC_RETRIES + 1):
+        try:
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    room_obj = None
+                    if load_room:
+                        result = await db.execute(select(Room).filter_by(room_id=room_id))
+                        room_obj = result.scalars().first()
+                        if not room_obj:
+                            return None
+                    return await func(db, room_obj)
+        except StaleDataError:
+            if attempt == OPTIMISTIC_RETRIES:
+                raise
+            print(f"ルーム {room_id} の更新が競合したため再試行します ({attempt}/{OPTIMISTIC_RETRIES})")
+
+async def apply_frame(room_id: str, username: str, data: dict, handler, load_room: bool, owner: str = None):
+    async def _transaction(db, room_obj):
+        outcome = FrameOutcome(owner)
+        await handler(db, room_obj, room_id, username, data, outcome)
+        return outcome
+
+    outcome = await run_room_transaction(room_id, _transaction, load_room=load_room)
+    if outcome:
+        for action in outcome.after_commit:
+            await action()
+    # コミット後、シーケンサー内で配信することでコミット順と配信順を一致させる
+    if outcome and redis_client:
+        for payload in outcome.frames:
+            await redis_client.publish(f"room:{room_id}", encode_frame(payload))
+    if outcome:
+        for job in outcome.artifact_jobs:
+            if job["created"]:
+                artifact_jobs.wake()
+                await artifact_jobs.publish_status(job)
+    return outcome
+
+NOTE_FRAME_TYPES = ("note_op", "note_update", "note_sync")
+
+async def handle_note_frame(websocket: WebSocket, room_id: str, username: str, data: dict):
+    """共有ノートの編集はDBを通さず、Redis 上の正本に適用して操作だけを配信する"""
+    try:
+        if data["type"] == "note_op":
+            frame = await note_store.apply(room_id, data.get("rev"), data.get("ops"), username, data.get("client_id"))
+        elif data["type"] == "note_update":
+            # 全文を送ってくる旧形式のクライアント
+            frame = await note_store.replace(room_id, data.get("content", ""), username)
+        else:
+            raise NoteResyncRequired(room_id)
+    except NoteClosedError:
+        return
+    except NoteResyncRequired:
+        # クライアントの文書が古い・不正な場合は全文を送り直す
+        state = await note_store.load(room_id)
+        if state:
+            await websocket.send_json({"type": "note_state", "content": state[0], "rev": state[1]})
+        return
+    if frame:
+        await redis_client.publish(f"room:{room_id}", encode_frame(frame))
+        await ai_response_cache.bump(room_id)
+
+PROPOSAL_FRAME_TYPES = ("proposal_patch", "proposal_form_update")
+
+async def handle_proposal_frame(websocket: WebSocket, room_id: str, username: str, data: dict):
+    """提案フォームの編集もDBを通さず、Redis 上の正本に項目単位で適用して変わった項目だけを配信する"""
+    try:
+        if data["type"] == "proposal_patch":
+            frames = [await proposal_store.patch(
+                room_id, data.get("proposal_id"), data.get("field"), data.get("value"), data.get("version"),
+                username, data.get("client_id")
+            )]
+        else:
+            # 一覧全体を送ってくる旧形式のクライアント
+            frames = await proposal_store.replace(room_id, data.get("proposals"), username)
+    except ProposalPatchError:
+        return
+    except ProposalConflictError as e:
+        # 他の人が先に同じ項目を書き換えていた場合は、最新の値を送信元にだけ返す
+        await websocket.send_json(e.frame)
+        return
+    for frame in frames:
+        await redis_client.publish(f"room:{room_id}", encode_frame(frame))
+    if frames:
+        await ai_response_cache.bump(room_id)
+
+async def handle_reaction_frame(room_id: str, username: str, data: dict):
+    """リアクションの付け外しはDBを通さず Redis 上で行い、集計した件数を配信する"""
+    frame = await reaction_store.toggle(room_id, data.get("message_id"), username, data.get("reaction"))
+    if frame:
+        await redis_client.publish(f"room:{room_id}", encode_frame(frame))
+        await ai_response_cache.bump(room_id)
+
+async def process_frame(room_id: str, username: str, data: dict, owner: str = None):
+    """受信したフレームを適切な経路 (シーケンサー経由 / 直接) で処理する"""
+    handler_entry = FRAME_HANDLERS.get(data.get("type"))
+    if not handler_entry:
+        return None
+    handler, touches_room = handler_entry
+    if touches_room:
+        return await room_sequencer.run_exclusive(
+            room_id, lambda: apply_frame(room_id, username, data, handler, True, owner)
+        )
+    return await apply_frame(room_id, username, data, handler, False, owner)
+
+# --- 履歴の読み込み (キーセット方式のページング) ---
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+
+def history_cursor(message) -> dict:
+    """ページングに使うカーソル。(created_at, message_id) の組で一意に位置を表す"""
+    return {"created_at": message.created_at.isoformat(), "message_id": message.message_id}
+
+def parse_history_cursor(cursor):
+    try:
+        return datetime.fromisoformat(cursor["created_at"]), str(cursor["message_id"])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+async def load_history_page(db, room_id: str, before=None, after=None, limit: int = HISTORY_PAGE_SIZE):
+    """
+    履歴を1ページ分、古い順で返す。
+    before: このカーソルより古いメッセージ (「さらに古いメッセージ」用)
+    after: このカーソルより新しいメッセージ (再接続時の差分用)
+    どちらもない場合は最新のページ。戻り値は (メッセージのリスト, 続きがあるか, 返信元の要約の辞書)
+    返信元の投稿者と内容は同じクエリで結合して読む。
+    """
+    parent = aliased(Message)
+    query = (
+        select(Message, parent.message_id, parent.username, parent.content)
+        .outerjoin(parent, parent.message_id == Message.reply_to_id)
+        .filter(Message.room_id == room_id, Message.stance != "summary")
+    )
+    if after:
+        created_at, message_id = after
+        query = query.filter(or_(
+            Message.created_at > created_at,
+            and_(Message.created_at == created_at, Message.message_id > message_id)
+        )).order_by(Message.created_at, Message.message_id)
+    else:
+        if before:
+            created_at, message_id = before
+            query = query.filter(or_(
+                Message.created_at < created_at,
+                and_(Message.created_at == created_at, Message.message_id < message_id)
+            ))
+        query = query.order_by(Message.created_at.desc(), Message.message_id.desc())
+
+    result = await db.execute(query.limit(limit + 1))
+    rows = result.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not after:
+        rows.reverse()
+    messages = [row[0] for row in rows]
+    parents = {row[1]: parent_summary(*row[1:]) for row in rows if row[1] is not None}
+    # 読んだ発言は返信元になりやすいので、返信の引用用のキャッシュにも入れておく
+    for message in messages:
+        reply_parents.put(room_id, message.message_id, message.username, message.content)
+    return messages, has_more, parents
+
+async def build_history_batch(messages, parents: dict, mode: str, has_more: bool) -> dict:
+    """メッセージのリストを1つの history_batch フレームにまとめる (parents は load_history_page の返信元の要約)"""
+    messages_to_send = [
+        message.to_dict(parents.get(message.reply_to_id) if message.reply_to_id else None)
+        for message in messages
+    ]
+
+    # まだDBに書き込まれていないリアクションは Redis の値を使う
+    latest_reactions = await reaction_store.current(msg.message_id for msg in messages)
+    for message_dict in messages_to_send:
+        if message_dict["message_id"] in latest_reactions:
+            message_dict["reactions"] = latest_reactions[message_dict["message_id"]]
+
+    return {
+        "type": "history_batch",
+        "mode": mode,
+        "messages": messages_to_send,
+        "has_more": has_more,
+        "cursor": history_cursor(messages[0]) if messages else None
+    }
+
+async def send_older_history(websocket: WebSocket, room_id: str, before):
+    """load_older 要求に応じて、カーソルより古い履歴を要求元のソケットにだけ送る"""
+    cursor = parse_history_cursor(before)
+    if not cursor:
+        return
+    async with AsyncSessionLocal() as db:
+        messages, has_more, parents = await load_history_page(db, room_id, before=cursor)
+        batch = await build_history_batch(messages, parents, "older", has_more)
+    await websocket.send_json(batch)
+
+# クエリの所要時間をフレームの種類ごとに集計する (知らない種類は "ws:other" にまとめ、集計の種類を増やさない)
+QUERY_SITE_FRAME_TYPES = {"load_older", "reaction", *NOTE_FRAME_TYPES, *PROPOSAL_FRAME_TYPES, *FRAME_HANDLERS}
+
 @app.websocket("/ws/{room_id}/{username}")
 async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
     # 【変更点】引数から db: AsyncSession = Depends(get_db) を削除しました
@@ -242,11 +914,12 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
         await websocket.close()
         return
 
+    # 接続時 (ルームの確認・履歴) のクエリ。受信したフレームの処理は writer() でフレームの種類ごとに集計する
+    set_query_site("ws:connect")
+
     # 1. ルーム存在確認とAnalytics初期化 (必要な時だけDBを開く)
     async with AsyncSessionLocal() as db:
-        result = await db.execute(
-            select(Room).options(selectinload(Room.messages)).filter_by(room_id=room_id)
-        )
+        result = await db.execute(select(Room).filter_by(room_id=room_id))
         room_obj = result.scalars().first()
         
         if not room_obj:
@@ -255,323 +928,103 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
             await websocket.close()
             return
 
-        try:
-                result_lock = await db.execute(select(Room).filter_by(room_id=room_id).with_for_update())
-                room_obj_for_analytics = result_lock.scalars().first()
-                
-                if room_obj_for_analytics:
-                    analytics = room_obj_for_analytics.analytics
-                    if "users" not in analytics:
-                        analytics["users"] = {}
-                    
-                    if username not in analytics["users"]:
-                        analytics["users"][username] = {
-                            "posts": 0, "stances": {}, 
-                            "reactions_given": {"agree": 0, "partial": 0, "disagree": 0},
-                            "reactions_received": {"agree": 0, "partial": 0, "disagree": 0},
-                            "note_edits": 0, "facilitator_uses": 0, "proposal_form_edits": 0
-                        }
-                        flag_modified(room_obj_for_analytics, "analytics")
-
-                        await db.commit()
-        except Exception as e:
-            print(f"Analytics への接続ユーザー登録でエラー: {e}")
+    try:
+        # 接続回数を記録する (一度も発言していない参加者も参加者数に含めるため)
+        await record_activity(room_id, [(username, "sessions", 1)])
+    except Exception as e:
+        print(f"Analytics への接続ユーザー登録でエラー: {e}")
 
     await websocket.accept()
     
     room_channel = f"room:{room_id}"
     participants_key = f"participants:{room_id}"
+    # この接続から依頼したAI呼び出しを、切断時にまとめて取り消すためのID
+    connection_id = uuid.uuid4().hex
 
     # --- Readerタスク ---
-    async def reader(pubsub, event):
+    # Redis の購読はワーカー内でルームごとに1つ (room_hub) で、ここでは自分宛てのキューから送るだけ
+    async def reader(subscriber):
         try:
-            await pubsub.subscribe(room_channel)
-            event.set()
             while True:
-                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
-                if message and message.get("data"):
-                    try:
-                        await websocket.send_json(json.loads(message["data"]))
-                    except RuntimeError:
-                        break
+                frame = await subscriber.get()
+                if frame is None:
+                    if subscriber.lagging:
+                        # 送信が追いつかなかった接続は閉じ、再接続時の差分取得に任せる
+                        await websocket.close(code=1013, reason="lagging")
+                    break
+                try:
+                    # publish 時にエンコード済みの文字列をそのまま送る (デコード・再エンコードしない)
+                    await websocket.send_text(frame)
+                except RuntimeError:
+                    break
         except asyncio.CancelledError:
             pass
         except Exception as e:
             print(f"Readerタスクでエラーが発生 (Room: {room_id}, User: {username}): {e}")
-        finally:
-            if pubsub:
-                await pubsub.unsubscribe(room_channel)
 
     # --- Writerタスク ---
     async def writer():
         try:
             while True:
                 data = await websocket.receive_json()
-                
-                # 【重要】メッセージ受信時、その都度DB接続を開くように変更
-                async with AsyncSessionLocal() as db:
-                    async with db.begin():
-                        # ロックを取得して競合を防ぐ
-                        result = await db.execute(select(Room).filter_by(room_id=room_id).with_for_update())
-                        room_obj_writer = result.scalars().first()
-                        if not room_obj_writer:
-                            continue
-
-                        message_type = data.get("type")
-
-                        if message_type == "message":
-                            stance = data["stance"].strip()
-                            content = data["content"]
-
-                            analytics = room_obj_writer.analytics
-                            user_analytics = analytics.get("users", {}).get(username)
-                            
-                            if user_analytics:
-                                user_analytics["posts"] += 1
-                                user_analytics["stances"][stance] = user_analytics.get(stance, 0) + 1
-                                flag_modified(room_obj_writer, "analytics")
-
-                            parent_message_dict = None
-                            if data.get("reply_to_id"):
-                                parent_res = await db.execute(select(Message).filter_by(message_id=data["reply_to_id"]))
-                                parent_message = parent_res.scalars().first()
-                                if parent_message:
-                                    parent_message_dict = {
-                                        "id": parent_message.message_id, 
-                                        "username": parent_message.username, 
-                                        "content": parent_message.content
-                                    }
-
-                            new_message = Message(
-                                room_id=room_id,
-                                username=username,
-                                content=content,
-                                stance=stance,
-                                file_url=data.get("file_url"),
-                                original_filename=data.get("original_filename"),
-                                gemini_file_ref=data.get("gemini_file_ref"), 
-                                reply_to_id=data.get("reply_to_id")
-                            )
-                            db.add(new_message)
-                            await db.flush()
-
-                            message_to_send = new_message.to_dict(parent_message_dict)
-                            
-                            # 通知処理用データの取得
-                            sub_result = await db.execute(select(PushSubscription).filter_by(room_id=room_id))
-                            subscriptions = sub_result.scalars().all()
-                            subscriptions_data = [
-                                PushSubscription(
-                                    endpoint=sub.endpoint, p256dh=sub.p256dh, auth=sub.auth, 
-                                    username=sub.username, room_id=sub.room_id
-                                ) for sub in subscriptions
-                            ]
-                            current_online_users = await redis_client.smembers(participants_key)
-                            
-                            asyncio.create_task(
-                                send_push_notification(subscriptions_data, content, username, set(current_online_users))
-                            )
-
-                            if stance == "Geminiへの質問":
-                                await redis_client.publish(room_channel, json.dumps({"type": "message", **message_to_send}))
-                                
-                                files_to_ask = [new_message.gemini_file_ref] if new_message.gemini_file_ref else []
-                                gemini_answer = await asyncio.to_thread(
-                                    ask_gemini_simple, question=content, files=files_to_ask
-                                )
-                                
-                                answer_message_obj = Message(
-                                    room_id=room_id,
-                                    username="Gemini",
-                                    content=gemini_answer,
-                                    stance="Geminiからの回答"
-                                )
-                                db.add(answer_message_obj)
-                                await redis_client.publish(room_channel, json.dumps({"type": "gemini_response", **answer_message_obj.to_dict()}))
-                            else:
-                                await redis_client.publish(room_channel, json.dumps({"type": "message", **message_to_send}))
-
-                        elif message_type == "reaction":
-                            message_id = data.get("message_id")
-                            reaction_type = data.get("reaction")
-                            res = await db.execute(select(Message).filter_by(message_id=message_id))
-                            target_message = res.scalars().first()
-                            
-                            if target_message:
-                                previous_reaction = None
-                                for r_type, users in target_message.reactions.items():
-                                    if username in users:
-                                        previous_reaction = r_type
-                                        break
-                                already_reacted = username in target_message.reactions.get(reaction_type, [])
-                                
-                                new_reactions = dict(target_message.reactions)
-                                for r_type, users in new_reactions.items():
-                                    if username in users:
-                                        users.remove(username)
-                                
-                                if not already_reacted:
-                                    if reaction_type not in new_reactions:
-                                        new_reactions[reaction_type] = []
-                                    new_reactions[reaction_type].append(username)
-                                
-                                target_message.reactions = new_reactions
-                                flag_modified(target_message, "reactions")
-
-                                analytics = room_obj_writer.analytics
-                                if username in analytics.get("users", {}):
-                                    author_username = target_message.username
-                                    if previous_reaction:
-                                        analytics["users"][username]["reactions_given"][previous_reaction] -= 1
-                                        if author_username and author_username in analytics["users"]:
-                                            analytics["users"][author_username]["reactions_received"][previous_reaction] -= 1
-                                    if not already_reacted:
-                                        analytics["users"][username]["reactions_given"][reaction_type] += 1
-                                        if author_username and author_username in analytics["users"]:
-                                            analytics["users"][author_username]["reactions_received"][reaction_type] += 1
-                                    flag_modified(room_obj_writer, "analytics")
-                                
-                                reaction_update_data = {"type": "reaction_update", "message_id": message_id, "reactions": {k: len(v) for k, v in target_message.reactions.items()}}
-                                await redis_client.publish(room_channel, json.dumps(reaction_update_data))
-
-                        elif message_type == "delete_message":
-                            message_id_to_delete = data.get("message_id")
-                            res = await db.execute(select(Message).filter_by(message_id=message_id_to_delete))
-                            message_to_delete = res.scalars().first()
-
-                            if message_to_delete and message_to_delete.username == username:
-                                analytics = room_obj_writer.analytics
-                                if username in analytics.get("users", {}):
-                                    user_analytics = analytics["users"][username]
-                                    user_analytics["posts"] -= 1
-                                    if message_to_delete.stance in user_analytics.get("stances", {}):
-                                        user_analytics["stances"][message_to_delete.stance] -= 1
-                                    flag_modified(room_obj_writer, "analytics")
-
-                                await db.delete(message_to_delete)
-                                await redis_client.publish(room_channel, json.dumps({
-                                    "type": "message_deleted", 
-                                    "message_id": message_id_to_delete
-                                }))
-
-                        elif message_type == "resolve_proposal":
-                            message_id_to_resolve = data.get("message_id")
-                            res = await db.execute(select(Message).filter_by(message_id=message_id_to_resolve))
-                            message_to_resolve = res.scalars().first()
-            
-                            if message_to_resolve and message_to_resolve.stance == "提案":
-                                message_to_resolve.is_resolved = True
-                                flag_modified(message_to_resolve, "is_resolved")
-                                await redis_client.publish(room_channel, json.dumps({
-                                    "type": "proposal_resolved",
-                                    "message_id": message_id_to_resolve
-                                }))
-
-                        elif message_type == "note_update":
-                            if room_obj_writer.status != "終了":
-                                content = data.get("content", "")
-                                room_obj_writer.shared_note = content
-                                analytics = room_obj_writer.analytics
-                                if username in analytics.get("users", {}):
-                                    analytics["users"][username]["note_edits"] += 1
-                                flag_modified(room_obj_writer, "analytics")
-                                note_update_data = {"type": "note_update", "content": content, "sender": username}
-                                await redis_client.publish(room_channel, json.dumps(note_update_data))
-
-                        elif message_type == "proposal_form_update":
-                            if room_obj_writer.status != "終了":
-                                proposals_list = data.get("proposals", [])
-                                room_obj_writer.proposals_data = proposals_list
-                                analytics = room_obj_writer.analytics
-                                if username in analytics.get("users", {}):
-                                    analytics["users"][username]["proposal_form_edits"] = analytics["users"][username].get("proposal_form_edits", 0) + 1
-                                flag_modified(room_obj_writer, "analytics")
-                                form_update_data = {
-                                    "type": "proposal_form_update", 
-                                    "proposals": proposals_list, 
-                                    "sender": username
-                                }
-                                await redis_client.publish(room_channel, json.dumps(form_update_data))
-
-                        elif message_type == "finish":
-                            room_obj_writer.status = "終了"
-                            system_message = {"type": "system_message", "content": "議事録を作成中です。しばらくお待ちください..."}
-                            await redis_client.publish(room_channel, json.dumps(system_message))
-
-                            res = await db.execute(
-                                select(Message)
-                                .filter(Message.room_id == room_id, Message.stance != "summary") 
-                                .order_by(Message.created_at)
-                            )
-                            messages_from_db = res.scalars().all()
-                            
-                            chat_messages_dict = [msg.to_dict() for msg in messages_from_db]
-                            files_for_summary = [msg.gemini_file_ref for msg in messages_from_db if msg.gemini_file_ref]
-                            note_content = room_obj_writer.shared_note
-                            proposals_data = room_obj_writer.proposals_data or []
-                            topic = room_obj_writer.topic
-
-                            summary_content = await asyncio.to_thread(
-                                generate_summary, 
-                                chat_messages_dict, 
-                                topic, 
-                                files=files_for_summary, 
-                                note_content=note_content,
-                                proposals_data=proposals_data
-                            )
-                            
-                            participants = list(room_obj_writer.analytics.get("users", {}).keys())
-
-                            excel_filename = f"meeting_minutes_{room_id}.xlsx"
-                            excel_path = os.path.join(EXCEL_DIR, excel_filename)
-                            excel_url = f"/excels/{excel_filename}"
-                            
-                            await asyncio.to_thread(
-                                create_meeting_minutes_excel, 
-                                messages_from_db, 
-                                topic, 
-                                participants, 
-                                excel_path
-                            )
-                            
-                            summary_data_dict = {
-                                "content": summary_content,
-                                "excel_url": excel_url  # キー名を pdf_url から excel_url に変更
-                            }
-                            
-                            res_summary = await db.execute(select(Message).filter_by(room_id=room_id, stance="summary"))
-                            summary_message_obj = res_summary.scalars().first()
-
-                            if summary_message_obj:
-                                summary_message_obj.content = json.dumps(summary_data_dict)
-                                flag_modified(summary_message_obj, "content")
-                            else:
-                                summary_message_obj = Message(
-                                    room_id=room_id,
-                                    username="System", 
-                                    content=json.dumps(summary_data_dict),
-                                    stance="summary"
-                                )
-                                db.add(summary_message_obj)
-                            
-                            publish_data = {"type": "summary", **summary_data_dict}
-                            await redis_client.publish(room_channel, json.dumps(publish_data))
+                set_query_site(f"ws:{data.get('type')}" if data.get("type") in QUERY_SITE_FRAME_TYPES else "ws:other")
+
+                # 読み取りだけの要求は、書き込みの経路を通さずに要求元へ直接返す
+                if data.get("type") == "load_older":
+                    await send_older_history(websocket, room_id, data.get("before"))
+                    continue
+
+                if data.get("type") in NOTE_FRAME_TYPES:
+                    await handle_note_frame(websocket, room_id, username, data)
+                    continue
+
+                if data.get("type") in PROPOSAL_FRAME_TYPES:
+                    await handle_proposal_frame(websocket, room_id, username, data)
+                    continue
+
+                if data.get("type") == "reaction":
+                    await handle_reaction_frame(room_id, username, data)
+                    continue
+
+                try:
+                    outcome = await process_frame(room_id, username, data, owner=connection_id)
+                except (LeaseTimeoutError, StaleDataError) as e:
+                    print(f"フレームの処理に失敗しました (Room: {room_id}, User: {username}): {e}")
+                    await websocket.send_json({"type": "system_message", "content": "操作が混み合っているため反映できませんでした。もう一度お試しください。"})
+                    continue
+                if not outcome:
+                    continue
+
+                # ルームの内容が変わったので、以前の状態に対するAIの結果のキャッシュを使わないようにする
+                if outcome.frames:
+                    await ai_response_cache.bump(room_id)
+
+                if outcome.push_notification:
+                    push_dispatcher.notify(room_id, username, outcome.push_notification)
+
+                # トランザクション（ロック）を抜けてからジョブを投入する
+                for job_name, job_func, job_args in outcome.jobs:
+                    if not job_queue.submit(job_name, job_func, *job_args):
+                        await websocket.send_json({"type": "system_message", "content": "サーバーが混み合っています。しばらくしてから再度お試しください。"})
 
         except WebSocketDisconnect:
             pass
         except Exception as e:
             print(f"Writerタスクでエラーが発生 (Room: {room_id}, User: {username}): {e}")
 
-    pubsub = redis_client.pubsub()
-    subscribe_event = asyncio.Event()
-    reader_task = asyncio.create_task(reader(pubsub, subscribe_event))
+    try:
+        subscriber = await room_hub.subscribe(room_id)
+    except Exception as e:
+        print(f"ルームの購読に失敗しました (Room: {room_id}): {e}")
+        await websocket.close(code=1011)
+        return
+    reader_task = asyncio.create_task(reader(subscriber))
     writer_task = asyncio.create_task(writer())
-    await subscribe_event.wait()
     
     await redis_client.sadd(participants_key, username)
     current_participants = list(await redis_client.smembers(participants_key))
     update_message = {"type": "participant_update", "users": current_participants}
-    await redis_client.publish(room_channel, json.dumps(update_message))
+    await redis_client.publish(room_channel, encode_frame(update_message))
 
     # --- 履歴読み込み処理 ---
     try:
@@ -583,35 +1036,41 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
                 await websocket.close(code=1008, reason="Room not found during history load")
                 return
 
-            res_history = await db.execute(
-                select(Message)
-                .filter_by(room_id=room_id)
-                .order_by(Message.created_at)
-            )
-            history_messages = res_history.scalars().all()
-            message_dict_for_replies = {msg.message_id: msg for msg in history_messages}
-
-            for message in history_messages:
-                if message.stance == "summary":
-                    summary_data = json.loads(message.content)
-                    await websocket.send_json({"type": "summary", **summary_data})
-                    continue
-                
-                parent_message_dict = None
-                if message.reply_to_id:
-                    parent_message = message_dict_for_replies.get(message.reply_to_id)
-                    if parent_message:
-                        parent_message_dict = {
-                            "id": parent_message.message_id, 
-                            "username": parent_message.username, 
-                            "content": parent_message.content
-                        }
-                await websocket.send_json({"type": "history", **message.to_dict(parent_message_dict)})
+            # 再接続時は、クライアントが最後に受け取ったメッセージより後の差分だけを送る
+            after_cursor = None
+            last_seen_id = websocket.query_params.get("after")
+            if last_seen_id:
+                res_last = await db.execute(select(Message).filter_by(message_id=last_seen_id, room_id=room_id))
+                last_seen = res_last.scalars().first()
+                if last_seen:
+                    after_cursor = (last_seen.created_at, last_seen.message_id)
+
+            batch = None
+            if after_cursor:
+                messages, has_more, parents = await load_history_page(db, room_id, after=after_cursor)
+                # 差分が1ページに収まらない場合は、最新ページを送り直してもらう
+                if not has_more:
+                    batch = await build_history_batch(messages, parents, "after", False)
+            if batch is None:
+                messages, has_more, parents = await load_history_page(db, room_id)
+                batch = await build_history_batch(messages, parents, "latest", has_more)
+            await websocket.send_json(batch)
+
+            res_summary = await db.execute(select(Message).filter_by(room_id=room_id, stance="summary"))
+            summary_message = res_summary.scalars().first()
+            if summary_message:
+                summary_data = json.loads(summary_message.content)
+                await websocket.send_json({"type": "summary", **summary_data})
             
-            await websocket.send_json({"type": "note_initial_state", "content": current_room_obj.shared_note})
+            note_state = await note_store.load(room_id)
+            note_content, note_rev = note_state or (current_room_obj.shared_note, 0)
+            await websocket.send_json({"type": "note_initial_state", "content": note_content, "rev": note_rev})
+            form_state = await proposal_store.load(room_id)
+            proposals, proposal_versions, _ = form_state or (current_room_obj.proposals_data or [], {}, 0)
             await websocket.send_json({
-                "type": "proposal_form_initial_state", 
-                "proposals": current_room_obj.proposals_data if current_room_obj.proposals_data else []
+                "type": "proposal_form_initial_state",
+                "proposals": proposals,
+                "versions": proposal_versions,
             })
     except RuntimeError:
         print(f"History send failed for {username}: client disconnected.")
@@ -624,6 +1083,7 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
     )
     for task in pending:
         task.cancel()
+    get_llm_gateway().cancel_owner(connection_id)
     
     try:
         if redis_client:
@@ -632,21 +1092,25 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
                 remaining_participants = list(await redis_client.smembers(participants_key))
                 if remaining_participants:
                      update_message = {"type": "participant_update", "users": remaining_participants}
-                     await redis_client.publish(room_channel, json.dumps(update_message))
+                     await redis_client.publish(room_channel, encode_frame(update_message))
+                else:
+                    # ルームが空いたら、溜まっている変更をすぐにDBへ書き込む
+                    write_behind.wake()
             except Exception as e:
                 print(f"Redis cleanup error: {e}")
         
-        if pubsub:
-            await pubsub.close()
+        await room_hub.unsubscribe(subscriber)
         print(f"User {username} disconnected from room {room_id}. Cleaned up resources.")
     except Exception:
         pass
 
 class FacilitatePayload(BaseModel):
     username: str
+    context_mode: str = None  # "rolling" / "full" (未指定なら AI_CONTEXT_MODE)
 
 class ProgressCheckPayload(BaseModel):
     username: str
+    context_mode: str = None
 
 @app.post("/check_progress/{room_id}")
 async def check_progress(room_id: str, payload: ProgressCheckPayload, db: AsyncSession = Depends(get_db)):
@@ -656,51 +1120,39 @@ async def check_progress(room_id: str, payload: ProgressCheckPayload, db: AsyncS
     if not room_obj:
         return JSONResponse(content={"error": "ルームが見つかりません。"}, status_code=404)
     
-    res_msg = await db.execute(
-        select(Message)
-        .filter(Message.room_id == room_id, Message.stance != "summary")
-        .order_by(Message.created_at)
-    )
-    messages_from_db = res_msg.scalars().all()
-    
     # MissingGreenletエラーを回避するため、commitの前に属性にアクセスする
-    note_content = room_obj.shared_note
+    note_content = await note_store.text(room_id, room_obj.shared_note)
+    proposals_data = await proposal_store.snapshot(room_id, room_obj.proposals_data)
     
     try:
-        username = payload.username
-        
-        # 分析データを更新
-        analytics = room_obj.analytics
-        if username in analytics.get("users", {}):
-            # "progress_check_uses" というキーで回数をカウントアップ
-            analytics["users"][username]["progress_check_uses"] = analytics["users"][username].get("progress_check_uses", 0) + 1
-            flag_modified(room_obj, "analytics")
-            await db.commit() # ここでコミット
-        else:
-            # ユーザーが analytics に見つからない場合（通常は発生しないはず）
-            await db.rollback()
-            
+        # 分析データを更新 ("progress_check_uses" というキーで回数をカウントアップ)
+        await record_activity(room_id, [(payload.username, "progress_check_uses", 1)])
     except Exception as e:
         print(f"Error during progress check analytics update: {e}")
-        await db.rollback()
 
     # --- 3. 読み取ったデータを使ってAIに問い合わせ ---
-    chat_messages_dict = [msg.to_dict() for msg in messages_from_db]
-    if not chat_messages_dict and not note_content:
+    transcript = await get_prompt_transcript(room_id, room_obj.topic, payload.context_mode)
+    if transcript.is_empty() and not note_content:
         return JSONResponse(content={"progress": "まだ議論が開始されていません。"})
 
-    files_for_analysis = [msg['gemini_file_ref'] for msg in chat_messages_dict if msg.get('gemini_file_ref')]
+    async def compute():
+        progress_summary = await analyze_discussion_progress(
+            transcript, room_obj.topic, files=await upload_store.resolve(transcript.file_refs()), note_content=note_content,
+            proposals_data=proposals_data, room_id=room_id
+        )
+        return progress_summary, not is_ai_error_reply(progress_summary)
 
-    progress_summary = await asyncio.to_thread(
-        analyze_discussion_progress, chat_messages_dict, room_obj.topic, files=files_for_analysis, note_content=note_content, proposals_data=room_obj.proposals_data or []
+    # ルームの状態が前回から変わっていなければ、前回の結果をそのまま返す
+    progress_summary, cached = await ai_response_cache.get_or_compute(
+        room_id, f"progress:{resolve_context_mode(payload.context_mode)}", compute
     )
-    return JSONResponse(content={"progress": progress_summary})
+    return JSONResponse(content={"progress": progress_summary, "cached": cached})
 
 @app.post("/upload_file/")
 async def upload_file_endpoint(file: UploadFile = File(...)):
     try:
-        # 新しい作法でクライアントを取得
-        client = get_gemini_client()
+        # APIキーが未設定の場合はここで知らせる (アップロード自体はバックグラウンドで行う)
+        get_gemini_client()
     except ValueError as e:
         return JSONResponse(content={"message": str(e)}, status_code=500)
 
@@ -714,37 +1166,27 @@ async def upload_file_endpoint(file: UploadFile = File(...)):
         error_message = f"サポートされていないファイル形式です: {file.filename} ({file.content_type})。PDF, TXT, 画像ファイルなどを利用してください。"
         return JSONResponse(content={"message": error_message}, status_code=400)
 
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_location = os.path.join(UPLOAD_DIR, unique_filename)
-
     try:
-        # ファイルをサーバーに一時保存
-        with open(file_location, "wb") as f:
-            f.write(await file.read())
-        
-        # フロントエンドが参照するためのURL
-        file_url = f"/static/uploads/{unique_filename}"
-
-        # 新しいSDKのファイルアップロード方法
-        uploaded_file = client.files.upload(file=file_location)
-
-        print(f"Completed upload. File name: {uploaded_file.name}")
-
-        # フロントエンドに返す情報をJSON形式で作成
-        return JSONResponse(content={
-            "file_url": file_url,
-            "original_filename": file.filename,
-            "gemini_file_ref": uploaded_file.name
-        })
+        # チャンクごとにディスクへ書き出し、同じ内容のファイルは既存のものを使い回す
+        # Gemini へのアップロードはバックグラウンドで行い、ここでは仮の参照を返す
+        uploaded = await upload_store.save(file)
+        return JSONResponse(content=uploaded)
+    except UploadTooLargeError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=413)
     except Exception as e:
         print(f"!!! 詳細なエラー内容: {e}")
         print(f"!!! エラーの型: {type(e)}")
         return JSONResponse(content={"message": f"ファイルのアップロード中にエラーが発生しました: {e}"}, status_code=500)
 
+MINUTES_EXCEL_PATTERN = re.compile(r"^meeting_minutes_([0-9A-Za-z-]+)\.xlsx$")
+
 @app.get("/excels/{filename}")
 async def get_excel(filename: str):
-    file_path = os.path.join(EXCEL_DIR, filename)
+    # 議事録は最新の発言までを含むファイルを返す (発言が増えていなければ作成済みのものを使う)
+    match = MINUTES_EXCEL_PATTERN.match(filename)
+    file_path = await ensure_minutes_excel(match.group(1)) if match else None
+    if file_path is None:
+        file_path = os.path.join(EXCEL_DIR, os.path.basename(filename))
     if os.path.exists(file_path):
         return FileResponse(
             file_path, 
@@ -792,29 +1234,9 @@ async def delete_room(room_id: str = Form(...), password: str = Form(...), db: A
     room_to_delete = result.scalars().first()
 
     if room_to_delete:
-        # 2. 【追加】Gemini上のファイルを削除する処理
+        # 2. Gemini上のファイルを削除する (同じファイルを他のルームが使っている場合は残す)
         try:
-            # このルームのメッセージで、Geminiファイル参照を持っているものを検索
-            msg_result = await db.execute(
-                select(Message)
-                .filter_by(room_id=room_id)
-                .where(Message.gemini_file_ref.is_not(None))
-            )
-            messages_with_files = msg_result.scalars().all()
-            
-            if messages_with_files:
-                client = get_gemini_client()
-                print(f"Deleting {len(messages_with_files)} files from Gemini...")
-                
-                for msg in messages_with_files:
-                    try:
-                        # Gemini APIを使ってファイルを削除
-                        # msg.gemini_file_ref は "files/xxxx..." という形式の名前
-                        client.files.delete(name=msg.gemini_file_ref)
-                        print(f"Deleted Gemini file: {msg.gemini_file_ref}")
-                    except Exception as e:
-                        print(f"Failed to delete file {msg.gemini_file_ref}: {e}")
-
+            await upload_store.delete_room_files(room_id)
         except Exception as e:
             # ファイル削除に失敗しても、ルーム削除自体は続行する
             print(f"Error during Gemini file cleanup: {e}")
@@ -822,6 +1244,10 @@ async def delete_room(room_id: str = Form(...), password: str = Form(...), db: A
         # 3. DBからルームを削除（カスケード設定によりメッセージも消えます）
         await db.delete(room_to_delete)
         await db.commit()
+        await analytics_snapshot.bump()
+        remove_minutes_excels(room_id)
+        await note_store.forget(room_id)
+        await proposal_store.forget(room_id)
         print(f"Room deleted: {room_id}")
         return RedirectResponse(f"/?", status_code=303)
     
@@ -836,42 +1262,59 @@ async def facilitate_discussion(room_id: str, payload: FacilitatePayload, db: As
         raise HTTPException(status_code=404, detail="Room not found")
 
     try:
-        username = payload.username
-        
         # 分析データを更新
-        analytics = room_obj.analytics
-        if username in analytics.get("users", {}):
-            analytics["users"][username]["facilitator_uses"] += 1
-            flag_modified(room_obj, "analytics")
+        await record_activity(room_id, [(payload.username, "facilitator_uses", 1)])
 
-        res = await db.execute(
-            select(Message)
-            .filter(Message.room_id == room_id, Message.stance != "summary")
-            .order_by(Message.created_at)
-        )
-        messages_from_db = res.scalars().all()
-        chat_messages_dict = [msg.to_dict() for msg in messages_from_db]
-        
-        note_content = room_obj.shared_note
-        facilitation_text = await asyncio.to_thread(
-            get_facilitation_from_gemini, chat_messages_dict, room_obj.topic, note_content, proposals_data=room_obj.proposals_data or []
-        )
+        topic = room_obj.topic
+        note_content = await note_store.text(room_id, room_obj.shared_note)
+        proposals_data = await proposal_store.snapshot(room_id, room_obj.proposals_data)
+        posted = False
 
-        # AIの発言としてメッセージを作成し、DBに追加
-        ai_message_obj = Message(
-            room_id=room_id,
-            username="Gemini（AIファシリテーター）",
-            content=facilitation_text,
-            stance="ファシリテーション"
-        )
-        db.add(ai_message_obj)
-        await db.commit()
+        async def compute():
+            nonlocal posted
+            message_id = str(uuid.uuid4())
+            try:
+                transcript = await get_prompt_transcript(room_id, topic, payload.context_mode)
+                facilitation_text = await get_facilitation_from_gemini(
+                    transcript, topic, note_content,
+                    proposals_data=proposals_data, room_id=room_id,
+                    on_text=gemini_delta_publisher(room_id, message_id, "Gemini（AIファシリテーター）", "ファシリテーション")
+                )
 
-        # 全員にブロードキャスト
-        if redis_client:
-            room_channel = f"room:{room_id}"
-            await redis_client.publish(room_channel, json.dumps({"type": "message", **ai_message_obj.to_dict()}))
-        return JSONResponse(content={"status": "success", "message": facilitation_text})
+                # AIの発言としてメッセージを作成し、DBに追加
+                # (同時に押された他の要求とも共有するため、要求ごとのセッションではなく新しいセッションで保存する)
+                async with AsyncSessionLocal() as session:
+                    ai_message_obj = Message(
+                        message_id=message_id,
+                        room_id=room_id,
+                        username="Gemini（AIファシリテーター）",
+                        content=facilitation_text,
+                        stance="ファシリテーション"
+                    )
+                    session.add(ai_message_obj)
+                    await session.flush()
+                    await append_events(session, [message_event(ai_message_obj)])
+                    await session.commit()
+                posted = True
+            except Exception:
+                await abort_gemini_stream(room_id, message_id)
+                raise
+
+            # 全員にブロードキャスト
+            if redis_client:
+                room_channel = f"room:{room_id}"
+                await redis_client.publish(room_channel, encode_frame({"type": "message", **ai_message_obj.to_dict()}))
+            return facilitation_text, not is_ai_error_reply(facilitation_text)
+
+        # ルームの状態が前回から変わっていなければ、前回の発言を投稿し直さずにそのまま返す
+        facilitation_text, cached = await ai_response_cache.get_or_compute(
+            room_id, f"facilitate:{resolve_context_mode(payload.context_mode)}", compute
+        )
+        if posted:
+            # ファシリテーターの発言でルームの状態が変わったため、進捗確認などのキャッシュを使わせない
+            # (get_or_compute の中で進めると、この結果を保存する前に古いバージョンになってしまう)
+            await ai_response_cache.bump(room_id)
+        return JSONResponse(content={"status": "success", "message": facilitation_text, "cached": cached})
     except Exception as e:
         print(f"Error during facilitation: {e}")
         raise HTTPException(status_code=500, detail=f"AIファシリテーション中にサーバーエラーが発生しました: {e}")
@@ -885,231 +1328,158 @@ async def dev_tools_page(request: Request, password: str = None):
         
     return templates.TemplateResponse("dev_tools.html", {"request": request})
 
+def etag_matches(request: Request, etag: str) -> bool:
+    return etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+
 @app.get("/api/analytics")
-async def get_analytics_data(db: AsyncSession = Depends(get_db)):
+async def get_analytics_data(request: Request):
+    """全体・ルーム別の合計。analytics_snapshot が定期的に作り直した本文を返すだけで、DBは読まない"""
     try:
-        result = await db.execute(select(Room))
-        all_rooms = result.scalars().all()
-
-    # DBから取得した analytics データを基に、フロントエンドで扱いやすい形に整形
-        analytics_from_db = {room.room_id: room.analytics for room in all_rooms if room.analytics}
-    
-        by_room = {}
-        overall = {
-            "posts": 0, "stances": {}, "reactions_given": {"agree": 0, "partial": 0, "disagree": 0},
-            "reactions_received": {"agree": 0, "partial": 0, "disagree": 0},
-            "note_edits": 0, "facilitator_uses": 0, "participants": set()
-        }
-
-        for room_id, r_data in analytics_from_db.items():
-            room_summary = {
-                "posts": 0, "stances": {}, "reactions_given": {"agree": 0, "partial": 0, "disagree": 0},
-                "reactions_received": {"agree": 0, "partial": 0, "disagree": 0},
-                "note_edits": 0, "facilitator_uses": 0, "participants": set()
-            }
-            for user, u_data in r_data.get("users", {}).items():
-                room_summary["posts"] += u_data.get("posts", 0)
-                overall["posts"] += u_data.get("posts", 0)
-                room_summary["note_edits"] += u_data.get("note_edits", 0)
-                overall["note_edits"] += u_data.get("note_edits", 0)
-                room_summary["facilitator_uses"] += u_data.get("facilitator_uses", 0)
-                overall["facilitator_uses"] += u_data.get("facilitator_uses", 0)
-
-                room_summary["proposal_form_edits"] = room_summary.get("proposal_form_edits", 0) + u_data.get("proposal_form_edits", 0)
-                overall["proposal_form_edits"] = overall.get("proposal_form_edits", 0) + u_data.get("proposal_form_edits", 0)
-
-                room_summary["progress_check_uses"] = room_summary.get("progress_check_uses", 0) + u_data.get("progress_check_uses", 0)
-                overall["progress_check_uses"] = overall.get("progress_check_uses", 0) + u_data.get("progress_check_uses", 0)
-
-                room_summary["participants"].add(user)
-                overall["participants"].add(user)
-
-                for stance, count in u_data.get("stances", {}).items():
-                    room_summary["stances"][stance] = room_summary["stances"].get(stance, 0) + count
-                    overall["stances"][stance] = overall["stances"].get(stance, 0) + count
-                for r_type, count in u_data.get("reactions_given", {}).items():
-                    room_summary["reactions_given"][r_type] = room_summary["reactions_given"].get(r_type, 0) + count
-                    overall["reactions_given"][r_type] = overall["reactions_given"].get(r_type, 0) + count
-                for r_type, count in u_data.get("reactions_received", {}).items():
-                    room_summary["reactions_received"][r_type] = room_summary["reactions_received"].get(r_type, 0) + count
-                    overall["reactions_received"][r_type] = overall["reactions_received"].get(r_type, 0) + count
-        
-            room_summary["participants"] = len(room_summary["participants"])
-            by_room[room_id] = room_summary
-
-        overall["participants"] = len(overall["participants"])
-    
-    # 最終的なレスポンスを作成
-        response_data = {
-            "by_room_by_user": analytics_from_db,
-            "by_room": by_room,
-            "overall": overall
-        }
-        return JSONResponse(content=response_data)
+        body, etag = await analytics_snapshot.current()
     except Exception as e:
         print(f"Error in get_analytics_data: {e}")
         raise HTTPException(status_code=500, detail="分析データの集計中にサーバーエラーが発生しました。")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    # 内容が変わっていなければ 304 を返す
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/analytics/rooms/{room_id}")
+async def get_room_user_analytics(room_id: str, request: Request, db: AsyncSession = Depends(get_db)):
+    """ルームの参加者別の詳細 (分析画面でルームを開いたときに読む)"""
+    try:
+        report = await build_room_user_report(db, room_id)
+    except Exception as e:
+        print(f"Error in get_room_user_analytics: {e}")
+        raise HTTPException(status_code=500, detail="分析データの集計中にサーバーエラーが発生しました。")
+    body = json.dumps(report, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    etag = f'W/"analytics-{room_id}-{hashlib.sha256(body).hexdigest()[:16]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def parse_event_time(value: str, name: str):
+    """クエリで指定された日時 (ISO 8601)。記録はタイムゾーンなしの UTC で保存しているため、UTC に直して比べる"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} の日時の形式が正しくありません。")
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@app.get("/api/analytics/range")
+async def get_range_analytics(start: str = None, end: str = None, room_id: str = None, db: AsyncSession = Depends(get_db)):
+    """期間 [start, end) の分析データ。ルームの出来事の記録 (room_events) から集計する"""
+    start_at, end_at = parse_event_time(start, "start"), parse_event_time(end, "end")
+    try:
+        # まだDBに書き込まれていないノート・提案フォーム・リアクションの変更も含める
+        await write_behind.flush()
+        report = await build_range_analytics(db, start_at, end_at, room_id)
+    except Exception as e:
+        print(f"Error in get_range_analytics: {e}")
+        raise HTTPException(status_code=500, detail="期間別の分析データの集計中にサーバーエラーが発生しました。")
+    return JSONResponse(content=report)
+
+@app.get("/api/rooms/{room_id}/replay")
+async def get_room_replay(room_id: str, at: str = None, db: AsyncSession = Depends(get_db)):
+    """時刻 at の時点のルームの状態 (発言・ノート・提案フォーム・議論ログ) を、ルームの出来事の記録から再現する"""
+    until = parse_event_time(at, "at")
+    result = await db.execute(select(Room.topic).filter_by(room_id=room_id))
+    topic = result.scalar()
+    if topic is None:
+        raise HTTPException(status_code=404, detail="ルームが見つかりません。")
+    try:
+        await write_behind.flush()
+        state = await replay_room(db, room_id, until)
+    except Exception as e:
+        print(f"Error in get_room_replay: {e}")
+        raise HTTPException(status_code=500, detail="ルームの状態の再現中にサーバーエラーが発生しました。")
+    return JSONResponse(content={"topic": topic, **state})
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """このワーカーの実行状況 (AI呼び出し・通知・配信) を返す"""
+    return JSONResponse(content={
+        "llm": get_llm_gateway().stats(),
+        "push": push_dispatcher.stats(),
+        "hub": room_hub.stats(),
+        "transcript_cache": transcript_cache.stats(),
+        "reply_parents": reply_parents.stats(),
+        "transcript_compactor": transcript_compactor.stats(),
+        "ai_cache": ai_response_cache.stats(),
+        "uploads": upload_store.stats(),
+        "artifact_jobs": artifact_jobs.stats(),
+        "notes": note_store.stats(),
+        "proposals": proposal_store.stats(),
+        "reactions": reaction_store.stats(),
+        "write_behind": await write_behind.stats(),
+        "analytics": analytics_snapshot.stats(),
+        "db": db_metrics.stats(),
+        "minutes_excel": {**minutes_excel_stats, "building": len(_minutes_excel_builds)},
+    })
 
 class WordDownloadPayload(BaseModel):
     topic: str
     proposals: list
+    room_id: str = None
 
-def set_cell_border(cell, **kwargs):
-    """
-    テーブルのセルに枠線を設定するヘルパー関数
-    """
-    tc = cell._tc
-    tcPr = tc.get_or_add_tcPr()
-    tcBorders = tcPr.first_child_found_in("w:tcBorders")
-    if tcBorders is None:
-        tcBorders = OxmlElement('w:tcBorders')
-        tcPr.append(tcBorders)
-
-    for edge in ('left', 'top', 'right', 'bottom', 'insideH', 'insideV'):
-        edge_data = kwargs.get(edge)
-        if edge_data:
-            tag = 'w:{}'.format(edge)
-            element = tcBorders.find(qn(tag))
-            if element is None:
-                element = OxmlElement(tag)
-                tcBorders.append(element)
-            for key in ["sz", "val", "color", "space", "shadow"]:
-                if key in edge_data:
-                    element.set(qn('w:{}'.format(key)), str(edge_data[key]))
-
-def set_east_asia_font(run, font_name='Meiryo'):
-    """
-    Runオブジェクトに対して日本語（東アジア）フォントを設定するヘルパー関数
-    """
-    run.font.name = font_name
-    r = run._element
-    rPr = r.get_or_add_rPr()
-    # w:rFonts 要素を取得または作成
-    rFonts = rPr.find(qn('w:rFonts'))
-    if rFonts is None:
-        rFonts = OxmlElement('w:rFonts')
-        rPr.append(rFonts)
-    # 東アジアフォントを設定
-    rFonts.set(qn('w:eastAsia'), font_name)
+# Word の作成をこの秒数まで待ち、間に合わなければジョブIDを返して /jobs/{job_id} で確認してもらう
+WORD_JOB_WAIT_SECONDS = float(os.getenv("WORD_JOB_WAIT_SECONDS", "60"))
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
 
 @app.post("/download_proposals_word")
 async def download_proposals_word(payload: WordDownloadPayload):
+    # 同じ内容の提言案はジョブ・ファイルを使い回す (連打や複数人のダウンロードでも1回だけ作る)
+    digest = hashlib.sha256(json.dumps(
+        {"topic": payload.topic, "proposals": payload.proposals, "template": PROPOSALS_TEMPLATE_VERSION},
+        ensure_ascii=False, sort_keys=True
+    ).encode("utf-8")).hexdigest()[:32]
+    file_path = proposals_word_path(digest)
+    if os.path.exists(file_path):
+        return FileResponse(file_path, media_type=DOCX_MEDIA_TYPE, filename=os.path.basename(file_path))
     try:
-        # ドキュメントの作成
-        doc = Document()
-        
-        # 標準スタイルのフォント設定
-        style = doc.styles['Normal']
-        style.font.name = 'Meiryo'
-        # スタイルの場合は element 属性でアクセス可能
-        style.element.rPr.rFonts.set(qn('w:eastAsia'), 'Meiryo')
-        style.font.size = Pt(10.5)
-
-        # --- タイトル ---
-        # add_heading は Paragraph を返すが、中身のテキストは Run で管理する方が安全
-        title = doc.add_heading(level=0)
-        # 既存のテキストをクリアして Run を追加し直すことでフォントを確実に適用
-        title.clear() 
-        run = title.add_run(f"気候市民会議 提言案一覧")
-        run.font.color.rgb = RGBColor(0, 0, 0)
-        set_east_asia_font(run, 'Meiryo')
-        title.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-        # --- サブタイトル（議題） ---
-        subtitle = doc.add_paragraph()
-        run = subtitle.add_run(f"議題: {payload.topic}")
-        run.font.size = Pt(14)
-        run.bold = True
-        set_east_asia_font(run, 'Meiryo')
-        subtitle.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        doc.add_paragraph("") # スペーサー
-
-        # 質問項目のマッピング
-        labels = {
-            "q1": "【What】 提案内容",
-            "q2": "【Why】 なぜ大切か",
-            "q6": "【How】 実施手法",
-            "q3": "【When】 実施時期",
-            "q4": "【Where】 実施場所",
-            "q5": "【Who】 実施主体・対象",
-            "q7": "思考法"
-        }
-
-        # --- 各提案のループ ---
-        for idx, prop in enumerate(payload.proposals, 1):
-            # 提案ヘッダー
-            h = doc.add_heading(level=1)
-            run = h.add_run(f"提案 {idx}")
-            set_east_asia_font(run, 'Meiryo')
-            
-            # テーブル作成 (2列: 項目名, 内容)
-            table = doc.add_table(rows=0, cols=2)
-            table.style = 'Table Grid'
-            table.alignment = WD_TABLE_ALIGNMENT.CENTER
-            table.autofit = False
-            table.allow_autofit = False
-            
-            # 各項目の行を追加
-            order = ["q1", "q2", "q6", "q3", "q4", "q5", "q7"]
-            
-            for key in order:
-                row = table.add_row()
-                cell_label = row.cells[0]
-                cell_content = row.cells[1]
-                
-                # ラベル列の設定
-                cell_label.width = Cm(6)
-                p_label = cell_label.paragraphs[0]
-                run_label = p_label.add_run(labels[key])
-                run_label.bold = True
-                run_label.font.size = Pt(10)
-                set_east_asia_font(run_label, 'Meiryo')
-
-                # 内容列の設定
-                content_text = prop.get(key, "")
-                
-                # Q7（思考法）の特別な処理
-                if key == "q7":
-                    if content_text == "forecast":
-                        content_text = "フォアキャスティング"
-                    elif content_text == "backcast":
-                        content_text = "バックキャスティング"
-                    else:
-                        content_text = "未選択"
-                
-                final_text = content_text if content_text else "（未記入）"
-                p_content = cell_content.paragraphs[0]
-                run_content = p_content.add_run(final_text)
-                set_east_asia_font(run_content, 'Meiryo')
-
-            doc.add_paragraph("") # 提案間のスペース
-            
-            # 最後の提案以外は改ページを入れる
-            if idx < len(payload.proposals):
-                doc.add_page_break()
-
-        # --- ファイル書き出し ---
-        buffer = BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
-        
-        filename = f"proposals_{uuid.uuid4().hex[:8]}.docx"
-        
-        # ダウンロード用レスポンス
-        return StreamingResponse(
-            buffer, 
-            media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        job = await artifact_jobs.submit(
+            "proposals_word",
+            payload.room_id,
+            f"proposals_word:{payload.room_id or '-'}:{digest}",
+            {"topic": payload.topic, "proposals": payload.proposals, "digest": digest},
         )
-
+        if job["status"] == "done" and not os.path.exists(file_path):
+            # 作成済みのファイルが消えている場合は作り直す
+            await artifact_jobs.run_in_process(write_proposals_docx, payload.topic, payload.proposals, file_path)
+        else:
+            job = await artifact_jobs.wait(job["job_id"], WORD_JOB_WAIT_SECONDS)
     except Exception as e:
         print(f"Word generation error: {e}")
-        # スタックトレースを含めて詳細を出力するとデバッグしやすい
-        import traceback
-        traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Wordファイルの作成に失敗しました: {str(e)}")
-    
-    # main.py の末尾付近に追加
+
+    if job is None or job["status"] == "failed":
+        error = job["error"] if job else "ジョブが見つかりません。"
+        raise HTTPException(status_code=500, detail=f"Wordファイルの作成に失敗しました: {error}")
+    if job["status"] != "done":
+        return JSONResponse(content=job, status_code=202)
+
+    return FileResponse(file_path, media_type=DOCX_MEDIA_TYPE, filename=os.path.basename(file_path))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """成果物ジョブの状態 (queued / running / done / failed) を返す"""
+    job = await artifact_jobs.get(job_id)
+    if not job:
+        return JSONResponse(content={"message": "ジョブが見つかりません。"}, status_code=404)
+    return JSONResponse(content=job)
+
+@app.get("/words/{filename}")
+async def get_word(filename: str):
+    file_path = os.path.join(WORD_DIR, os.path.basename(filename))
+    if os.path.exists(file_path):
+        return FileResponse(file_path, media_type=DOCX_MEDIA_TYPE, filename=filename)
+    return JSONResponse(content={"message": "ファイルが見つかりません。"}, status_code=404)
 
 @app.get("/debug/reset_push_subscriptions")
 async def reset_push_subscriptions(db: AsyncSession = Depends(get_db)):
@@ -1117,6 +1487,7 @@ async def reset_push_subscriptions(db: AsyncSession = Depends(get_db)):
         # PushSubscription テーブルの中身を全て削除
         await db.execute(delete(PushSubscription))
         await db.commit()
+        await push_dispatcher.invalidate_all()
         return JSONResponse(content={
             "status": "success", 
             "message": "通知の購読データを全て削除しました。ブラウザで再度「通知ON」の設定を行ってください。"
@@ -1124,62 +1495,3 @@ async def reset_push_subscriptions(db: AsyncSession = Depends(get_db)):
     except Exception as e:
         await db.rollback()
         return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
-    
-def create_meeting_minutes_excel(messages, topic, participants, file_path):
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "議事録"
-
-    # ヘッダー情報
-    ws["A1"] = "議題"
-    ws["B1"] = topic
-    ws["A2"] = "参加者"
-    ws["B2"] = ", ".join(participants) if participants else "なし"
-
-    # スタイル設定
-    bold_font = Font(bold=True, name="Meiryo UI")
-    normal_font = Font(name="Meiryo UI")
-    center_align = Alignment(horizontal="center", vertical="center")
-    top_left_align = Alignment(horizontal="left", vertical="top", wrap_text=True)
-    top_center_align = Alignment(horizontal="center", vertical="top")
-    thin_border = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
-
-    # メタデータスタイル
-    for cell in ["A1", "B1", "A2", "B2"]:
-        ws[cell].font = normal_font
-    ws["A1"].font = bold_font
-    ws["A2"].font = bold_font
-
-    # テーブルヘッダー
-    headers = ["No.", "発言者", "発言の種類", "発言内容", "リアクション数"]
-    header_row = 4
-    for col_idx, header in enumerate(headers, 1):
-        cell = ws.cell(row=header_row, column=col_idx, value=header)
-        cell.font = bold_font
-        cell.alignment = center_align
-        cell.border = thin_border
-
-    # データ行
-    for i, msg in enumerate(messages, 1):
-        row_idx = header_row + i
-        reaction_sum = sum(len(users) for users in (msg.reactions or {}).values())
-
-        row_data = [i, msg.username, msg.stance, msg.content, reaction_sum]
-
-        for col_idx, value in enumerate(row_data, 1):
-            cell = ws.cell(row=row_idx, column=col_idx, value=value)
-            cell.font = normal_font
-            cell.border = thin_border
-            
-            if col_idx == 1 or col_idx == 5: cell.alignment = top_center_align # No, リアクション
-            elif col_idx == 4: cell.alignment = top_left_align # 内容
-            else: cell.alignment = top_center_align
-
-    # 列幅調整
-    ws.column_dimensions["A"].width = 6
-    ws.column_dimensions["B"].width = 15
-    ws.column_dimensions["C"].width = 15
-    ws.column_dimensions["D"].width = 60
-    ws.column_dimensions["E"].width = 15
-
-    wb.save(file_path)
\ No newline at end of file
@@ -0,0 +1,147 @@
+from sqlalchemy import inspect, text, select, update, cast, Text, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import Room, Message, MessageReaction, RoomEvent
+from utils.activity import bump_activity, flatten_legacy_analytics, REACTION_TYPES
+from utils.events import event_row, append_events
+
+# create_all は既存テーブルに列を追加しないため、既存の本番DB向けに不足している列をここで追加する
+# (テーブル名, 列名, 列定義)
+COLUMN_MIGRATIONS = [
+    ("rooms", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("rooms", "note_revision", "INTEGER NOT NULL DEFAULT 0"),
+    ("rooms", "proposals_revision", "INTEGER NOT NULL DEFAULT 0"),
+    ("messages", "agree_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("messages", "partial_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("messages", "disagree_count", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+# 既存テーブルに後から追加したインデックス (インデックス名, テーブル名, 列)
+INDEX_MIGRATIONS = [
+    ("ix_messages_room_created_id", "messages", "room_id, created_at, message_id"),
+    ("ix_uploaded_files_gemini_file_ref", "uploaded_files", "gemini_file_ref"),
+]
+
+def _add_missing_columns(sync_conn):
+    inspector = inspect(sync_conn)
+    is_postgres = sync_conn.dialect.name == "postgresql"
+    for table, column, ddl in COLUMN_MIGRATIONS:
+        existing_columns = {col["name"] for col in inspector.get_columns(table)}
+        if column in existing_columns:
+            continue
+        # 複数のgunicornワーカーが同時に起動しても失敗しないよう、Postgresでは IF NOT EXISTS を付ける
+        if_not_exists = "IF NOT EXISTS " if is_postgres else ""
+        sync_conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {if_not_exists}{column} {ddl}"))
+        print(f"Migration: {table}.{column} を追加しました。")
+
+def _add_missing_indexes(sync_conn):
+    for index_name, table, columns in INDEX_MIGRATIONS:
+        sync_conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})"))
+
+async def _migrate_legacy_analytics(conn):
+    """
+    旧形式の Room.analytics (JSON) を user_activity テーブルに移し、JSON側は空にする。
+    行ロックを取ってから読むため、複数ワーカーが同時に起動しても二重に加算されない。
+    """
+    analytics_text = cast(Room.analytics, Text)
+    result = await conn.execute(
+        select(Room.room_id, Room.analytics)
+        .where(Room.analytics.is_not(None), analytics_text != "{}", analytics_text != "null")
+        .with_for_update()
+    )
+    for room_id, analytics in result.all():
+        rows = flatten_legacy_analytics(analytics)
+        await bump_activity(conn, room_id, rows)
+        await conn.execute(update(Room.__table__).where(Room.room_id == room_id).values(analytics={}))
+        print(f"Migration: ルーム {room_id} の analytics を user_activity に移行しました ({len(rows)} 行)。")
+
+# 1回の INSERT に入れる行数 (バインド変数の上限を超えないように分ける)
+BACKFILL_CHUNK = 1000
+
+async def _migrate_message_reactions(conn):
+    """
+    旧形式の Message.reactions (JSON) を message_reactions に1行ずつ移して件数の列を数え、JSON側は空にする。
+    行ロックを取ってから読むため、複数ワーカーが同時に起動しても二重に移さない。
+    """
+    reactions_text = cast(Message.reactions, Text)
+    result = await conn.execute(
+        select(Message.message_id, Message.reactions)
+        .where(Message.reactions.is_not(None), reactions_text != "{}", reactions_text != "null")
+        .with_for_update()
+    )
+    reaction_rows, count_rows = [], []
+    for message_id, reactions in result.all():
+        users = {}
+        for r_type, usernames in (reactions or {}).items():
+            if r_type not in REACTION_TYPES:
+                continue
+            for username in usernames or []:
+                users.setdefault(username, r_type)
+        reaction_rows += [{"message_id": message_id, "username": username, "type": r_type} for username, r_type in users.items()]
+        counts = {f"{r_type}_count": 0 for r_type in REACTION_TYPES}
+        for r_type in users.values():
+            counts[f"{r_type}_count"] += 1
+        count_rows.append({"target_id": message_id, **counts})
+    if not count_rows:
+        return
+    for i in range(0, len(reaction_rows), BACKFILL_CHUNK):
+        await conn.execute(
+            pg_insert(MessageReaction).values(reaction_rows[i:i + BACKFILL_CHUNK]).on_conflict_do_nothing()
+        )
+    stmt = (
+        update(Message.__table__)
+        .where(Message.message_id == bindparam("target_id"))
+        .values(reactions={}, **{f"{r_type}_count": bindparam(f"{r_type}_count") for r_type in REACTION_TYPES})
+    )
+    for i in range(0, len(count_rows), BACKFILL_CHUNK):
+        await conn.execute(stmt, count_rows[i:i + BACKFILL_CHUNK])
+    print(f"Migration: {len(count_rows)} 件の発言のリアクション ({len(reaction_rows)} 件) を message_reactions に移行しました。")
+
+async def _backfill_room_events(conn):
+    """
+    room_events を導入する前の発言を、発言の記録として追記する (移行時点のリアクションと解決済みかどうかを含める)。
+    source_id を発言ごとに決めておくため、複数ワーカーが同時に起動しても二重に追記しない。
+    """
+    if await conn.scalar(select(RoomEvent.id).limit(1)) is not None:
+        return
+    total = 0
+    last_id = None
+    while True:
+        query = select(Message).filter(Message.stance != "summary").order_by(Message.message_id).limit(BACKFILL_CHUNK)
+        if last_id is not None:
+            query = query.filter(Message.message_id > last_id)
+        messages = (await conn.execute(query)).all()
+        if not messages:
+            break
+        reactions = {}
+        result = await conn.execute(
+            select(MessageReaction.message_id, MessageReaction.username, MessageReaction.type)
+            .where(MessageReaction.message_id.in_([message.message_id for message in messages]))
+        )
+        for message_id, username, r_type in result.all():
+            reactions.setdefault(message_id, {}).setdefault(r_type, []).append(username)
+        await append_events(conn, [
+            event_row(message.room_id, "message", message.username, message.message_id, {
+                "content": message.content,
+                "stance": message.stance,
+                "file_url": message.file_url,
+                "original_filename": message.original_filename,
+                "reply_to_id": message.reply_to_id,
+                "reactions": reactions.get(message.message_id, {}),
+                "is_resolved": bool(message.is_resolved),
+            }, message.created_at, f"backfill:{message.message_id}")
+            for message in messages
+        ])
+        total += len(messages)
+        last_id = messages[-1].message_id
+    if total:
+        print(f"Migration: 既存の発言 {total} 件を room_events に追記しました。")
+
+async def run_migrations(conn):
+    """アプリケーション起動時に create_all の後で実行するスキーマ移行処理"""
+    await conn.run_sync(_add_missing_columns)
+    await conn.run_sync(_add_missing_indexes)
+    await _migrate_legacy_analytics(conn)
+    # 発言の記録には移行後の message_reactions のリアクションを含める
+    await _migrate_message_reactions(conn)
+    await _backfill_room_events(conn)
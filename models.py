@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, JSON, ForeignKey, DateTime, Text, Boolean, Integer
+from sqlalchemy import Column, String, JSON, ForeignKey, DateTime, Text, Boolean, Integer, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database import Base
 import uuid
@@ -13,6 +13,17 @@ class Room(Base):
     analytics = Column(JSON, default=dict)
     
     proposals_data = Column(JSON, default=list) 
+
+    # shared_note に保存済みの共有ノートのリビジョン (正本は Redis。古いスナップショットで上書きしないために使う)
+    note_revision = Column(Integer, nullable=False, default=0)
+    # proposals_data に保存済みの提案フォームのリビジョン (正本は Redis。古いスナップショットで上書きしないために使う)
+    proposals_revision = Column(Integer, nullable=False, default=0)
+
+    # 楽観的同時実行制御用のバージョン番号。
+    # 更新時に "WHERE version = 読み込んだ時の値" が付くため、他の書き込みと競合すると StaleDataError になる
+    version = Column(Integer, nullable=False, default=1)
+    __mapper_args__ = {"version_id_col": version}
+
     # 'cascade="all, delete-orphan"'により、Roomが削除されると関連するMessageも全て削除されます。
     messages = relationship(
         "Message", 
@@ -27,6 +38,31 @@ class Room(Base):
         cascade="all, delete-orphan"
     )
 
+    # 削除はDB側の ON DELETE CASCADE に任せ、ルーム削除時に全カウンタを読み込まないようにする
+    activity = relationship(
+        "UserActivity",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
+    transcript_segments = relationship(
+        "TranscriptSegment",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
+    jobs = relationship(
+        "Job",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
+    events = relationship(
+        "RoomEvent",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     # 基本情報
@@ -47,7 +83,12 @@ class Message(Base):
     gemini_file_ref = Column(String)
 
     # インタラクション情報
-    reactions = Column(JSON, default=lambda: {"agree": [], "partial": [], "disagree": []})
+    # (旧形式: 種類 -> ユーザー名のリスト。現在は message_reactions に1行ずつ保存し、起動時の移行で空にする)
+    reactions = Column(JSON, default=dict)
+    # 種類ごとのリアクション数 (message_reactions の行数を非正規化したもの。表示のたびに数え直さない)
+    agree_count = Column(Integer, nullable=False, default=0)
+    partial_count = Column(Integer, nullable=False, default=0)
+    disagree_count = Column(Integer, nullable=False, default=0)
     
     # 返信情報 (リレーショナルな構造に変更)
     reply_to_id = Column(String, ForeignKey("messages.message_id", ondelete="SET NULL"), nullable=True)
@@ -56,6 +97,17 @@ class Message(Base):
     
     # Roomモデルとのリレーションシップを定義
     room = relationship("Room", back_populates="messages")
+
+    reaction_rows = relationship(
+        "MessageReaction",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
+    # 履歴のキーセットページング (room_id, created_at, message_id) 用の複合インデックス
+    __table_args__ = (
+        Index("ix_messages_room_created_id", "room_id", "created_at", "message_id"),
+    )
     
     # WebSocketでJSONとして送信する際に利用します。
     def to_dict(self, parent_message_dict=None):
@@ -67,12 +119,29 @@ class Message(Base):
             "file_url": self.file_url,
             "original_filename": self.original_filename,
             "gemini_file_ref": self.gemini_file_ref,
-            "reactions": self.reactions,
+            "reactions": self.reaction_counts(),
             "reply_to": parent_message_dict,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
             "is_resolved": self.is_resolved  # [追加] 解決ステータスを辞書に含める
         }
         return base
 
+    def reaction_counts(self) -> dict:
+        """種類ごとのリアクション数 (reaction_update フレームと同じ形)"""
+        return {"agree": self.agree_count or 0, "partial": self.partial_count or 0, "disagree": self.disagree_count or 0}
+
+class MessageReaction(Base):
+    """
+    メッセージへのリアクション。1人がメッセージに付けられるのは1種類だけなので (message_id, username) ごとに1行で、
+    種類を付け替えたら type を更新し (upsert)、取り消したら行を消す。
+    正本は Redis (utils/reactions.py) で、書き込みの記録を反映するときにこの表と Message の件数の列を更新する。
+    """
+    __tablename__ = "message_reactions"
+    message_id = Column(String, ForeignKey("messages.message_id", ondelete="CASCADE"), primary_key=True)
+    username = Column(String, primary_key=True)
+    type = Column(String, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 class PushSubscription(Base):
     __tablename__ = "push_subscriptions"
     id = Column(Integer, primary_key=True, index=True)
@@ -83,4 +152,114 @@ class PushSubscription(Base):
     endpoint = Column(Text, nullable=False)
     p256dh = Column(String, nullable=False)
     auth = Column(String, nullable=False)
-    room = relationship("Room", back_populates="push_subscriptions")
\ No newline at end of file
+    room = relationship("Room", back_populates="push_subscriptions")
+
+class UserActivity(Base):
+    """
+    参加者ごとの活動カウンタ。(room_id, username, metric) ごとに1行を持ち、
+    INSERT ... ON CONFLICT DO UPDATE SET n = n + :amount で原子的に加算する。
+    metric の例: "posts", "stances:意見", "reactions_given:agree", "note_edits"
+    """
+    __tablename__ = "user_activity"
+    room_id = Column(String, ForeignKey("rooms.room_id", ondelete="CASCADE"), primary_key=True)
+    username = Column(String, primary_key=True)
+    metric = Column(String, primary_key=True)
+    n = Column(Integer, nullable=False, default=0)
+
+class RoomEvent(Base):
+    """
+    ルームで起きた出来事の追記専用の記録 (更新・削除はしない。ルームの削除時だけ ON DELETE CASCADE で消える)。
+    kind: "message" / "delete" / "resolve" / "reaction" / "note" / "proposal" / "finish"
+    期間を指定した分析や、ある時点のルームの状態の再現 (utils/events.py) はこの記録から作る。
+    元の表 (messages・user_activity など) への書き込みと並べて追記する監査用の記録で、それらの表の代わりにはしない。
+    source_id は書き込みの記録 (Redis Stream) のIDで、同じ記録を2回反映しても二重に追記しないために使う。
+    """
+    __tablename__ = "room_events"
+    id = Column(Integer, primary_key=True)
+    room_id = Column(String, ForeignKey("rooms.room_id", ondelete="CASCADE"), nullable=False)
+    kind = Column(String, nullable=False)
+    username = Column(String)
+    message_id = Column(String)
+    payload = Column(JSON, default=dict)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+    source_id = Column(String, unique=True)
+
+    __table_args__ = (
+        Index("ix_room_events_room_created_id", "room_id", "created_at", "id"),
+    )
+
+class TranscriptSegment(Base):
+    """
+    長いルームの古い発言をまとめた要約 (ローリング要約)。
+    seq の順に並べると議論の冒頭からの流れになり、last_created_at / last_message_id より後の発言は
+    まだ要約されていない生の発言として扱う。level はまとめ直した回数 (0: 発言の要約, 1以上: 要約の要約)。
+    """
+    __tablename__ = "transcript_segments"
+    id = Column(Integer, primary_key=True)
+    room_id = Column(String, ForeignKey("rooms.room_id", ondelete="CASCADE"), nullable=False, index=True)
+    seq = Column(Integer, nullable=False)
+    level = Column(Integer, nullable=False, default=0)
+    summary = Column(Text, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    last_created_at = Column(String, nullable=False)
+    last_message_id = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("room_id", "seq", name="uq_transcript_segments_room_seq"),
+    )
+
+class UploadedFile(Base):
+    """
+    アップロードされたファイルの実体。内容の SHA-256 ごとに1行で、同じ内容のファイルは
+    ディスク上のファイルと Gemini 上のファイルを共有する。
+    status: "pending" (Gemini へのアップロード待ち) / "ready" / "failed"
+    """
+    __tablename__ = "uploaded_files"
+    sha256 = Column(String, primary_key=True)
+    file_url = Column(String, nullable=False, index=True)
+    content_type = Column(String)
+    size = Column(Integer, nullable=False, default=0)
+    gemini_file_ref = Column(String, index=True)
+    status = Column(String, nullable=False, default="pending")
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Job(Base):
+    """
+    議事録・Word などの成果物を作るジョブ。WebSocket の接続やワーカーの再起動に関係なく最後まで実行するため DB に記録する。
+    idempotency_key (例: "meeting_summary:<room_id>") が同じジョブは1つしか作らない。
+    status: "queued" / "running" / "done" / "failed"
+    実行中のワーカーは locked_until を延長し続け、期限が切れたジョブは他のワーカーが引き継ぐ。
+    """
+    __tablename__ = "jobs"
+    job_id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    kind = Column(String, nullable=False)
+    room_id = Column(String, ForeignKey("rooms.room_id", ondelete="CASCADE"), nullable=True, index=True)
+    idempotency_key = Column(String, nullable=False, unique=True)
+    status = Column(String, nullable=False, default="queued")
+    payload = Column(JSON, default=dict)
+    result = Column(JSON)
+    error = Column(Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    locked_by = Column(String)
+    locked_until = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # 実行待ちのジョブを古い順に取り出すためのインデックス
+    __table_args__ = (
+        Index("ix_jobs_status_created", "status", "created_at"),
+    )
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "room_id": self.room_id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "attempts": self.attempts,
+        }
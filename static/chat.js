@@ -2,7 +2,14 @@
 
 (() => {
   const protocol = window.location.protocol === "https:" ? "wss" : "ws";
-  const ws = new WebSocket(`${protocol}://${window.location.host}/ws/${roomId}/${username}`);
+  let ws = null;
+  // 再接続時に差分だけを受け取るため、最後に受け取ったメッセージIDを覚えておく
+  let lastSeenMessageId = null;
+  // 「さらに古いメッセージ」を読み込むためのカーソル (表示中で最も古いメッセージ)
+  let oldestCursor = null;
+  let leavingRoom = false;
+  let reconnectDelay = 1000;
+  let loadOlderItem = null;
 
   const messagesElem = document.getElementById("messages");
   const proposalListElem = document.getElementById("proposal-list");
@@ -26,6 +33,9 @@
 
   let allProposals = [];
   let currentProposalIndex = 0;
+  let proposalVersions = {};      // 提案ID -> { 項目: サーバーで確定したバージョン }
+  let proposalSynced = {};        // 提案ID -> { 項目: サーバーで確定した値 }
+  const proposalInFlight = new Set(); // 送信済みで確認待ちの "提案ID:項目"
   const defaultProposal = { q1: "", q2: "", q3: "", q4: "", q5: "", q6: "", q7: "" };
   let proposalTypingTimer;
 
@@ -169,8 +179,8 @@ function addSystemMessage(content) {
     messagesElem.scrollTop = messagesElem.scrollHeight;
 }
 
-function addMessage(message, isHistory = false) {
-    const { message_id, username: fromUser, content, stance, file_url, original_filename, reactions, reply_to, is_resolved } = message;
+function createMessageElement(message) {
+    const { message_id, username: fromUser, content, stance, file_url, original_filename, reactions, reply_to } = message;
 
     // --- 1. 吹き出し本体（li要素）を作成 ---
     const li = document.createElement("li");
@@ -227,8 +237,8 @@ function addMessage(message, isHistory = false) {
         // カウント数の表示
         const countSpan = document.createElement('span');
         countSpan.className = 'reaction-count';
-        // reactionsデータがない場合やカウントが0の場合のハンドリング
-        countSpan.textContent = (reactions && reactions[type]) ? reactions[type].length : 0;
+        // reactions は種類ごとの件数 (データがない場合は0)
+        countSpan.textContent = (reactions && reactions[type]) || 0;
         
         btn.appendChild(countSpan);
         
@@ -286,22 +296,119 @@ function addMessage(message, isHistory = false) {
         finalElementToAppend = wrapper;
     }
 
-    // --- 3. 最終的な要素を画面に追加 ---
-    if (isHistory) {
-      const divider = document.getElementById("history-divider");
-      if (divider) divider.insertAdjacentElement("beforebegin", finalElementToAppend);
-      else messagesElem.appendChild(finalElementToAppend);
+    return finalElementToAppend;
+}
+
+function addMessage(message) {
+    const existing = messagesElem.querySelector(`[data-message-id="${message.message_id}"]`);
+    if (existing) {
+        // 再接続の直後などに同じメッセージが二重に届いた場合は無視する
+        if (!existing.classList.contains("streaming")) return;
+        // 生成中に逐次表示していたGeminiの応答を、保存された完成版に置き換える
+        existing.replaceWith(createMessageElement(message));
     } else {
-      messagesElem.appendChild(finalElementToAppend);
+        messagesElem.appendChild(createMessageElement(message));
     }
-
     messagesElem.scrollTop = messagesElem.scrollHeight;
+    lastSeenMessageId = message.message_id;
 
-    if (stance === "提案" && !is_resolved) {
+    if (message.stance === "提案" && !message.is_resolved) {
         addProposalToList(message);
     }
 }
 
+// Geminiの応答の断片 (gemini_delta) を、同じ message_id の表示に追記していく
+function renderGeminiDelta(data) {
+    let element = messagesElem.querySelector(`[data-message-id="${data.message_id}"]`);
+    if (data.aborted) {
+        if (element && element.classList.contains("streaming")) element.remove();
+        return;
+    }
+    if (!element) {
+        element = createMessageElement({
+            message_id: data.message_id, username: data.username, content: "", stance: data.stance, reactions: {}
+        });
+        element.classList.add("streaming");
+        messagesElem.appendChild(element);
+    } else if (!element.classList.contains("streaming")) {
+        // 完成版が先に届いている
+        return;
+    }
+    const atBottom = messagesElem.scrollHeight - messagesElem.scrollTop - messagesElem.clientHeight < 40;
+    element.querySelector(".message-content").textContent += data.delta;
+    if (atBottom) messagesElem.scrollTop = messagesElem.scrollHeight;
+}
+
+function showLoadOlderButton(hasMore) {
+    if (!loadOlderItem) {
+        loadOlderItem = document.createElement("li");
+        loadOlderItem.className = "load-older-item";
+        const btn = document.createElement("button");
+        btn.className = "load-older-btn";
+        btn.textContent = "さらに古いメッセージを読み込む";
+        btn.onclick = () => {
+            if (!oldestCursor || !ws || ws.readyState !== WebSocket.OPEN) return;
+            btn.disabled = true;
+            ws.send(JSON.stringify({ type: "load_older", before: oldestCursor }));
+        };
+        loadOlderItem.appendChild(btn);
+    }
+    loadOlderItem.querySelector("button").disabled = false;
+    if (hasMore) {
+        messagesElem.insertAdjacentElement("afterbegin", loadOlderItem);
+    } else {
+        loadOlderItem.remove();
+    }
+}
+
+// history_batch をまとめて描画する (1メッセージずつDOMに追加するとリフローが大量に発生するため)
+function renderHistoryBatch(data) {
+    const divider = document.getElementById("history-divider");
+
+    if (data.mode === "latest") {
+        // 最新ページから描画し直す (初回接続、または差分が大きすぎる再接続)
+        messagesElem.querySelectorAll("li.message, .message-wrapper, li.system-message, li.summary").forEach(el => el.remove());
+        proposalListElem.innerHTML = "";
+        oldestCursor = null;
+    }
+
+    const fragment = document.createDocumentFragment();
+    data.messages.forEach(message => {
+        if (messagesElem.querySelector(`[data-message-id="${message.message_id}"]`)) return;
+        fragment.appendChild(createMessageElement(message));
+        if (message.stance === "提案" && !message.is_resolved) {
+            addProposalToList(message);
+        }
+    });
+
+    if (data.mode === "older") {
+        // 読み込み前の表示位置を保ったまま、先頭に差し込む
+        const previousHeight = messagesElem.scrollHeight;
+        const anchor = loadOlderItem && loadOlderItem.parentNode ? loadOlderItem.nextSibling : messagesElem.firstChild;
+        messagesElem.insertBefore(fragment, anchor);
+        messagesElem.scrollTop += messagesElem.scrollHeight - previousHeight;
+    } else if (data.mode === "latest") {
+        if (divider) {
+            messagesElem.insertBefore(fragment, divider);
+            if (data.messages.length > 0) divider.style.display = "block";
+        } else {
+            messagesElem.appendChild(fragment);
+        }
+        messagesElem.scrollTop = messagesElem.scrollHeight;
+    } else {
+        messagesElem.appendChild(fragment);
+        messagesElem.scrollTop = messagesElem.scrollHeight;
+    }
+
+    if (data.mode !== "older" && data.messages.length > 0) {
+        lastSeenMessageId = data.messages[data.messages.length - 1].message_id;
+    }
+    if (data.mode !== "after") {
+        if (data.cursor) oldestCursor = data.cursor;
+        showLoadOlderButton(data.has_more);
+    }
+}
+
   function setReplyMode(message) {
       replyTarget = message;
       replyingText.textContent = `↪ ${message.username}に返信中...`;
@@ -316,7 +423,7 @@ function addMessage(message, isHistory = false) {
 
   cancelReplyBtn.addEventListener('click', cancelReplyMode);
 
-  ws.onmessage = (event) => {
+  function handleSocketMessage(event) {
     const data = JSON.parse(event.data);
 
     switch(data.type) {
@@ -329,12 +436,11 @@ function addMessage(message, isHistory = false) {
                 sendBtn.textContent = "送信";
             }
             break;
-        case "history":
-            const divider = document.getElementById("history-divider");
-            if (divider && divider.style.display === "none") {
-              divider.style.display = "block";
-            }
-            addMessage(data, true);
+        case "gemini_delta":
+            renderGeminiDelta(data);
+            break;
+        case "history_batch":
+            renderHistoryBatch(data);
             break;
         case "reaction_update":
             const msgElement = messagesElem.querySelector(`[data-message-id="${data.message_id}"]`);
@@ -366,44 +472,35 @@ function addMessage(message, isHistory = false) {
             break;
 
         case "note_initial_state":
-            noteTextarea.value = data.content;
+        case "note_state":
+            resetNote(data.content, data.rev);
             break;
-        case "note_update":
-            // 自分からの更新は無視することで、カーソルが飛ぶ問題を防ぐ
-            if (data.sender === username) {
-                // 何もしない
-            } else if (noteTextarea.value !== data.content) {
-                // 他のユーザーからの更新のみテキストエリアに反映する
-                noteTextarea.value = data.content;
-            }
+        case "note_op":
+            receiveNoteOp(data);
             break;
         
         case "proposal_form_initial_state":
-            allProposals = data.proposals || [];
-            currentProposalIndex = 0;
-            // フォームの表示を更新
-            renderProposalForm(); 
+            resetProposals(data.proposals, data.versions);
+            break;
+        case "proposal_patch":
+            receiveProposalPatch(data, false);
+            break;
+        case "proposal_patch_rejected":
+            // 他の人が先に同じ項目を書き換えていたため、自分の変更は反映されなかった
+            receiveProposalPatch(data, true);
             break;
 
-        case "proposal_form_update":
-            // 自分からの更新は無視する（カーソル飛び防止）
-            if (data.sender === username) {
-                // 何もしない
-                break;
+        case "job_status":
+            if (data.kind === "meeting_summary" && data.status === "retrying") {
+                addSystemMessage("議事録の作成に失敗したため、再試行しています...");
+            } else if (data.kind === "meeting_summary" && data.status === "failed") {
+                addSystemMessage("議事録の作成に失敗しました。もう一度「議論終了」を押してください。");
             }
-            // 他のユーザーからの更新を反映
-            allProposals = data.proposals || [];
-            
-            // 現在のインデックスがリストの範囲外になった場合は調整
-            if (currentProposalIndex >= allProposals.length) {
-                currentProposalIndex = allProposals.length - 1;
-            }
-            
-            // フォームの表示を更新
-            renderProposalForm();
             break;
 
         case "summary":
+            // 再接続時に同じ議事録が二重に表示されないよう、既存のものは置き換える
+            messagesElem.querySelectorAll("li.summary").forEach(el => el.remove());
             const summaryLi = document.createElement("li");
             summaryLi.classList.add("summary");
             summaryLi.innerHTML = `<h3>=== 議論終了 ===</h3><div class="summary-content">${marked.parse(data.content)}</div>`;
@@ -435,15 +532,39 @@ function addMessage(message, isHistory = false) {
             });
             break;
     }
-  };
+  }
 
-  ws.onclose = () => {
+  function handleSocketOpen() {
+    reconnectDelay = 1000;
+    finishBtn.disabled = false;
+    inputElem.disabled = false;
+    stanceButtons.forEach(btn => btn.disabled = false);
+    checkSendButtonState();
+  }
+
+  function handleSocketClose(event) {
     console.log("WebSocket切断");
     sendBtn.disabled = true;
     finishBtn.disabled = true;
     inputElem.disabled = true;
     stanceButtons.forEach(btn => btn.disabled = true);
-  };
+
+    // 退出以外で切れた場合は、待ち時間を延ばしながら再接続する
+    if (leavingRoom || event.code === 1000) return;
+    setTimeout(connect, reconnectDelay);
+    reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+  }
+
+  function connect() {
+    let url = `${protocol}://${window.location.host}/ws/${roomId}/${username}`;
+    if (lastSeenMessageId) url += `?after=${encodeURIComponent(lastSeenMessageId)}`;
+    ws = new WebSocket(url);
+    ws.onopen = handleSocketOpen;
+    ws.onmessage = handleSocketMessage;
+    ws.onclose = handleSocketClose;
+  }
+
+  connect();
 
   sendBtn.addEventListener("click", async () => {
     const message = inputElem.value.trim();
@@ -527,6 +648,7 @@ function addMessage(message, isHistory = false) {
 
   backBtn.addEventListener("click", () => {
     if (confirm("ルームを退出しますか？")) {
+      leavingRoom = true;
       ws.close();
       window.location.href = "/";
     }
@@ -602,14 +724,207 @@ function addMessage(message, isHistory = false) {
     }
   });
 
+  // --- 共有ノートの同期 (操作の変換: OT) ---
+  // 全文ではなく「サーバーのリビジョン noteRev の文書に対する操作」を送る。
+  // 操作は [残す文字数 (正の数), 削除する文字数 (負の数), 挿入する文字列] の並び (utils/notes.py と同じ形式)。
+  // サーバーからの確認を待つ操作は1つだけにし、待っている間の入力は確認が届いてからまとめて送る。
+  const noteClientId = (window.crypto && crypto.randomUUID)
+      ? crypto.randomUUID()
+      : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+  let noteRev = 0;                 // 反映済みのサーバーのリビジョン
+  let noteServerText = "";         // リビジョン noteRev のサーバーの文書
+  let noteOutstanding = null;      // 送信済みで確認待ちの操作
+  const notePendingOps = new Map(); // 順番が前後して届いた操作 (リビジョン -> フレーム)
+  let noteGapTimer = null;
+
+  function notePush(ops, component) {
+      if (component === 0 || component === "") return;
+      const last = ops[ops.length - 1];
+      if (typeof component === "string") {
+          if (typeof last === "string") {
+              ops[ops.length - 1] = last + component;
+          } else if (typeof last === "number" && last < 0) {
+              // 削除と挿入が並ぶ場合は挿入を先にする (サーバーと同じ表現にする)
+              if (typeof ops[ops.length - 2] === "string") {
+                  ops[ops.length - 2] += component;
+              } else {
+                  ops.splice(ops.length - 1, 0, component);
+              }
+          } else {
+              ops.push(component);
+          }
+      } else if (typeof last === "number" && ((component > 0 && last > 0) || (component < 0 && last < 0))) {
+          ops[ops.length - 1] = last + component;
+      } else {
+          ops.push(component);
+      }
+  }
+
+  function noteApply(text, ops) {
+      const parts = [];
+      let index = 0;
+      for (const component of ops) {
+          if (typeof component === "string") {
+              parts.push(component);
+          } else if (component > 0) {
+              parts.push(text.slice(index, index + component));
+              index += component;
+          } else {
+              index -= component;
+          }
+      }
+      return parts.join("");
+  }
+
+  // 同じ文書に対する操作 a, b を、互いの後に適用できる形 [a', b'] に変換する (同じ位置への挿入は a が先)
+  function noteTransform(a, b) {
+      const aPrime = [], bPrime = [];
+      let ia = 0, ib = 0;
+      let oa = a[ia++], ob = b[ib++];
+      while (oa !== undefined || ob !== undefined) {
+          if (typeof oa === "string") {
+              notePush(aPrime, oa);
+              notePush(bPrime, oa.length);
+              oa = a[ia++];
+              continue;
+          }
+          if (typeof ob === "string") {
+              notePush(aPrime, ob.length);
+              notePush(bPrime, ob);
+              ob = b[ib++];
+              continue;
+          }
+          if (oa === undefined || ob === undefined) {
+              throw new Error("操作の長さが一致しません。");
+          }
+          let length;
+          if (oa > 0 && ob > 0) {
+              length = Math.min(oa, ob);
+              notePush(aPrime, length);
+              notePush(bPrime, length);
+          } else if (oa < 0 && ob < 0) {
+              length = Math.min(-oa, -ob);
+          } else if (oa < 0) {
+              length = Math.min(-oa, ob);
+              notePush(aPrime, -length);
+          } else {
+              length = Math.min(oa, -ob);
+              notePush(bPrime, -length);
+          }
+          oa = (oa > 0 ? oa - length : oa + length) || a[ia++];
+          ob = (ob > 0 ? ob - length : ob + length) || b[ib++];
+      }
+      return [aPrime, bPrime];
+  }
+
+  function isHighSurrogate(code) {
+      return code >= 0xD800 && code <= 0xDBFF;
+  }
+
+  // 先頭・末尾の共通部分を除いた差分を1つの操作にする
+  function noteDiff(oldText, newText) {
+      const max = Math.min(oldText.length, newText.length);
+      let prefix = 0;
+      while (prefix < max && oldText.charCodeAt(prefix) === newText.charCodeAt(prefix)) prefix++;
+      let suffix = 0;
+      while (suffix < max - prefix &&
+             oldText.charCodeAt(oldText.length - suffix - 1) === newText.charCodeAt(newText.length - suffix - 1)) suffix++;
+      // サロゲートペア (絵文字など) の途中で区切らない
+      if (prefix > 0 && isHighSurrogate(oldText.charCodeAt(prefix - 1))) prefix--;
+      if (suffix > 0 && isHighSurrogate(oldText.charCodeAt(oldText.length - suffix - 1))) suffix--;
+      const ops = [];
+      notePush(ops, prefix);
+      notePush(ops, newText.slice(prefix, newText.length - suffix));
+      notePush(ops, -(oldText.length - prefix - suffix));
+      notePush(ops, suffix);
+      return ops;
+  }
+
+  // 操作を適用した後のカーソル位置
+  function noteTransformIndex(ops, index) {
+      let oldPos = 0, shift = 0;
+      for (const component of ops) {
+          if (oldPos > index) break;
+          if (typeof component === "string") {
+              if (oldPos < index) shift += component.length;
+          } else if (component > 0) {
+              oldPos += component;
+          } else {
+              shift -= Math.min(-component, Math.max(0, index - oldPos));
+              oldPos -= component;
+          }
+      }
+      return index + shift;
+  }
+
+  function resetNote(content, rev) {
+      noteServerText = content || "";
+      noteRev = rev || 0;
+      noteOutstanding = null;
+      notePendingOps.clear();
+      clearTimeout(noteGapTimer);
+      noteTextarea.value = noteServerText;
+  }
+
+  function sendNoteChanges() {
+      if (noteOutstanding || !ws || ws.readyState !== WebSocket.OPEN) return;
+      if (noteTextarea.value === noteServerText) return;
+      noteOutstanding = noteDiff(noteServerText, noteTextarea.value);
+      ws.send(JSON.stringify({ type: "note_op", rev: noteRev, ops: noteOutstanding, client_id: noteClientId }));
+  }
+
+  function applyServerNoteOp(data) {
+      if (data.client_id === noteClientId && noteOutstanding) {
+          // 自分の操作が確定した (他の操作に合わせて変換された形で返ってくる)
+          noteServerText = noteApply(noteServerText, data.ops);
+          noteRev = data.rev;
+          noteOutstanding = null;
+          sendNoteChanges();
+          return;
+      }
+
+      // 他の人の操作を、確認待ちの操作と未送信の入力の後に適用できる形に変換する
+      const local = noteTextarea.value;
+      const sentText = noteOutstanding ? noteApply(noteServerText, noteOutstanding) : noteServerText;
+      noteServerText = noteApply(noteServerText, data.ops);
+      noteRev = data.rev;
+      let remote = data.ops;
+      if (noteOutstanding) {
+          [remote, noteOutstanding] = noteTransform(remote, noteOutstanding);
+      }
+      if (local !== sentText) {
+          [remote] = noteTransform(remote, noteDiff(sentText, local));
+      }
+
+      const focused = document.activeElement === noteTextarea;
+      const selectionStart = noteTextarea.selectionStart;
+      const selectionEnd = noteTextarea.selectionEnd;
+      noteTextarea.value = noteApply(local, remote);
+      if (focused) {
+          noteTextarea.setSelectionRange(noteTransformIndex(remote, selectionStart), noteTransformIndex(remote, selectionEnd));
+      }
+  }
+
+  function receiveNoteOp(data) {
+      if (data.rev <= noteRev) return;
+      notePendingOps.set(data.rev, data);
+      while (notePendingOps.has(noteRev + 1)) {
+          const next = notePendingOps.get(noteRev + 1);
+          notePendingOps.delete(noteRev + 1);
+          applyServerNoteOp(next);
+      }
+      clearTimeout(noteGapTimer);
+      if (notePendingOps.size > 0) {
+          // 抜けている操作が届かない場合は全文を取り直す
+          noteGapTimer = setTimeout(() => {
+              if (ws && ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify({ type: "note_sync" }));
+          }, 3000);
+      }
+  }
+
   noteTextarea.addEventListener('input', () => {
       clearTimeout(noteTypingTimer);
-      noteTypingTimer = setTimeout(() => {
-          ws.send(JSON.stringify({
-              type: 'note_update',
-              content: noteTextarea.value
-          }));
-      }, 500); // ユーザーの入力が500ms止まったら送信
+      noteTypingTimer = setTimeout(sendNoteChanges, 500); // ユーザーの入力が500ms止まったら送信
   });
 
   proposalFormBtn.addEventListener('click', () => {
@@ -647,7 +962,7 @@ function addMessage(message, isHistory = false) {
   // 「新しい提案を追加」ボタン
   proposalAddBtn.addEventListener('click', () => {
     // 新しい空の提案オブジェクトを追加
-    allProposals.push({ ...defaultProposal });
+    allProposals.push(newProposal());
     // 新しく追加した提案（＝リストの末尾）に移動
     currentProposalIndex = allProposals.length - 1;
     // フォームを再描画
@@ -664,8 +979,90 @@ function addMessage(message, isHistory = false) {
     });
   });
 
+  // --- 提案フォームの同期 (項目単位) ---
+  // 変更した項目だけを「提案ID・項目・値・その項目のバージョン」として送る (utils/proposals.py)。
+  // 他の人が先に同じ項目を書き換えていた場合は反映されず、最新の値が返ってくる。
+  // 項目ごとに確認待ちの送信は1つだけにし、待っている間の入力は確認が届いてから送る。
+  function newProposalId() {
+      return (window.crypto && crypto.randomUUID)
+          ? crypto.randomUUID().replace(/-/g, "").slice(0, 12)
+          : `${Date.now().toString(36)}${Math.random().toString(36).slice(2, 8)}`;
+  }
+
+  function newProposal() {
+      return { id: newProposalId(), ...defaultProposal };
+  }
+
+  function resetProposals(proposals, versions) {
+      allProposals = (proposals || []).map(p => ({ ...defaultProposal, ...p }));
+      proposalVersions = versions || {};
+      proposalSynced = {};
+      allProposals.forEach(p => {
+          proposalSynced[p.id] = {};
+          Object.keys(defaultProposal).forEach(key => { proposalSynced[p.id][key] = p[key] || ""; });
+      });
+      proposalInFlight.clear();
+      currentProposalIndex = 0;
+      renderProposalForm();
+  }
+
+  function sendProposalField(proposal, key) {
+      const flightKey = `${proposal.id}:${key}`;
+      if (proposalInFlight.has(flightKey) || !ws || ws.readyState !== WebSocket.OPEN) return;
+      const synced = proposalSynced[proposal.id];
+      const value = proposal[key] || "";
+      // サーバーにまだない提案は、空でも1項目送って一覧に追加する
+      if (synced && synced[key] === value) return;
+      if (!synced && key !== "q1" && !value) return;
+      proposalInFlight.add(flightKey);
+      ws.send(JSON.stringify({
+          type: 'proposal_patch',
+          proposal_id: proposal.id,
+          field: key,
+          value: value,
+          version: (proposalVersions[proposal.id] || {})[key] || 0,
+          client_id: noteClientId
+      }));
+  }
+
+  function receiveProposalPatch(data, rejected) {
+      const versions = proposalVersions[data.proposal_id] || (proposalVersions[data.proposal_id] = {});
+      const flightKey = `${data.proposal_id}:${data.field}`;
+      const ownPatch = rejected || data.client_id === noteClientId;
+      if (ownPatch) proposalInFlight.delete(flightKey);
+      // 順番が前後して届いた古い変更は無視する
+      const known = versions[data.field] || 0;
+      if (known > data.version || (known === data.version && !rejected)) return;
+      versions[data.field] = data.version;
+
+      const currentId = allProposals[currentProposalIndex] && allProposals[currentProposalIndex].id;
+      let proposal = allProposals.find(p => p.id === data.proposal_id);
+      if (!proposal) {
+          proposal = { ...defaultProposal, id: data.proposal_id };
+          allProposals.push(proposal);
+      }
+      // 提案の並びはサーバーで確定した順にそろえる
+      const position = allProposals.indexOf(proposal);
+      if (position !== data.index && data.index < allProposals.length) {
+          allProposals.splice(position, 1);
+          allProposals.splice(data.index, 0, proposal);
+      }
+      const synced = proposalSynced[data.proposal_id] || (proposalSynced[data.proposal_id] = {});
+      synced[data.field] = data.value;
+
+      if (ownPatch && !rejected) {
+          // 自分の変更の確認: 待っている間に入力された分があれば続けて送る
+          sendProposalField(proposal, data.field);
+      } else {
+          proposal[data.field] = data.value;
+      }
+      const index = allProposals.findIndex(p => p.id === currentId);
+      if (index >= 0) currentProposalIndex = index;
+      renderProposalForm(rejected);
+  }
+
   /**
-   * [新規] 現在のフォームの入力値を読み取り、allProposalsを更新し、WebSocketで送信する
+   * [新規] 現在のフォームの入力値を読み取り、allProposalsを更新し、変更した項目をWebSocketで送信する
    */
   function sendProposalFormUpdate() {
       if (allProposals.length === 0) return; // 送信対象がなければ何もしない
@@ -683,17 +1080,14 @@ function addMessage(message, isHistory = false) {
           }
       });
       
-      // 更新された提案リスト全体をサーバーに送信
-      ws.send(JSON.stringify({
-          type: 'proposal_form_update',
-          proposals: allProposals
-      }));
+      // 変更された項目だけをサーバーに送信
+      Object.keys(defaultProposal).forEach(key => sendProposalField(currentProposal, key));
   }
 
-  function renderProposalForm() {
+  function renderProposalForm(force = false) {
       // 提案が1つもない場合は、デフォルトを作成
       if (allProposals.length === 0) {
-          allProposals.push({ ...defaultProposal });
+          allProposals.push(newProposal());
           currentProposalIndex = 0;
       }
 
@@ -707,8 +1101,8 @@ function addMessage(message, isHistory = false) {
           if (input.type === 'radio') {
               input.checked = (input.value === value);
           } else if (input.type !== 'checkbox') { 
-              // チェックボックスは別途処理、現在フォーカス中の要素は更新しない
-              if (document.activeElement !== input) {
+              // チェックボックスは別途処理、現在フォーカス中の要素は更新しない (変更が反映されなかった場合を除く)
+              if (force || document.activeElement !== input) {
                   input.value = value;
               }
           }
@@ -966,6 +1360,22 @@ function updateQ6HiddenInput() {
 // --- Wordダウンロード機能 ---
   const downloadWordBtn = document.getElementById("download-word-btn");
 
+  // サーバー側のジョブが終わるまで状態を確認し、完成したファイルのURLを返す
+  async function waitForJobResult(job) {
+      while (job.status !== "done") {
+          if (job.status === "failed") {
+              throw new Error(job.error || "ファイルの作成に失敗しました。");
+          }
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          const res = await fetch(`/jobs/${job.job_id}`);
+          if (!res.ok) {
+              throw new Error("ファイルの作成状況を確認できませんでした。");
+          }
+          job = await res.json();
+      }
+      return job.result.file_url;
+  }
+
   downloadWordBtn.addEventListener("click", async () => {
       if (allProposals.length === 0) {
           alert("提案がまだありません。");
@@ -1001,10 +1411,11 @@ function updateQ6HiddenInput() {
 
           const payload = {
               topic: topicText,
-              proposals: allProposals
+              proposals: allProposals,
+              room_id: roomId
           };
 
-          const response = await fetch("/download_proposals_word", {
+          let response = await fetch("/download_proposals_word", {
               method: "POST",
               headers: {
                   "Content-Type": "application/json"
@@ -1012,6 +1423,12 @@ function updateQ6HiddenInput() {
               body: JSON.stringify(payload)
           });
 
+          // 作成に時間がかかっている場合はジョブIDが返るので、完成するまで待ってから取得する
+          if (response.status === 202) {
+              const fileUrl = await waitForJobResult(await response.json());
+              response = await fetch(fileUrl);
+          }
+
           if (!response.ok) {
               throw new Error("ファイルの作成に失敗しました。");
           }
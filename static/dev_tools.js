@@ -1,15 +1,25 @@
-// static/dev_tools.js (v1.1.0)
-document.addEventListener("DOMContentLoaded", async () => {
+// static/dev_tools.js (v1.3.0)
+// 集計が変わっていなければサーバーは 304 を返すので、定期的に問い合わせても表を作り直さない
+const ANALYTICS_POLL_MS = 30000;
+let analyticsETag = null;
+// 参加者別の詳細はルームを開いたときだけ読む (開いているルームは表を作り直した後も開いたままにする)
+const openRoomDetails = new Set();
+
+async function loadAnalytics() {
     try {
-        const response = await fetch("/api/analytics");
+        const headers = analyticsETag ? { "If-None-Match": analyticsETag } : {};
+        const response = await fetch("/api/analytics", { headers, cache: "no-store" });
+        if (response.status === 304) return;
         if (!response.ok) {
             const errData = await response.json();
             throw new Error(errData.detail || "サーバーからのデータ取得に失敗しました。");
         }
         const data = await response.json();
+        analyticsETag = response.headers.get("ETag");
 
-        if (Object.keys(data.by_room_by_user).length === 0) {
-            document.getElementById("analytics-container").innerHTML = "<p>まだ分析データがありません。</p>";
+        if (Object.keys(data.by_room).length === 0) {
+            // 定期更新で後から表を描画できるよう、表の領域は残してその中に表示する
+            document.getElementById("analytics-tables-container").innerHTML = "<p>まだ分析データがありません。</p>";
             return;
         }
 
@@ -18,8 +28,13 @@ document.addEventListener("DOMContentLoaded", async () => {
 
     } catch (error) {
         console.error("分析データの取得に失敗:", error);
-        document.getElementById("analytics-container").innerHTML = `<p>データの表示に失敗しました: ${error.message}</p>`;
+        document.getElementById("analytics-tables-container").innerHTML = `<p>データの表示に失敗しました: ${error.message}</p>`;
     }
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+    loadAnalytics();
+    setInterval(loadAnalytics, ANALYTICS_POLL_MS);
 });
 
 /**
@@ -71,57 +86,91 @@ function renderAnalyticsTables(data) {
         );
     }
 
-    // 3. 参加者別データの表（ルームごと）
-if (data.by_room_by_user) {
+    // 3. 参加者別データの表（ルームごと、開いたときに読み込む）
+    if (roomIds.length > 0) {
         tableContainer.innerHTML += '<h2 style="margin-top: 40px;">参加者別データ（ルーム別詳細）</h2>';
-        
-        for (const [roomId, roomData] of Object.entries(data.by_room_by_user)) {
-            const users = roomData.users ? Object.keys(roomData.users).sort() : [];
-            if (users.length > 0) {
-                tableContainer.innerHTML += `<h3>ルーム: ${roomId}</h3>`;
-                
-                // ヘッダー定義：すべてのスタンス種類を網羅します
-                const headers = [
-                    '参加者', 
-                    '総発言', 
-                    '意見', 
-                    '質問', 
-                    '提案', 
-                    '情報提供',      // 追加
-                    '進行',          // 追加 (ファシリテーション)
-                    'G質問',         // 追加 (Geminiへの質問)
-                    'リアクション(した)', 
-                    '(された)', 
-                    'ノート編集', 
-                    'AI利用', 
-                    '5W1H編集',
-                    '進捗確認'
-                ];
+        roomIds.forEach(roomId => {
+            tableContainer.innerHTML += `<details class="room-user-details" data-room-id="${roomId}"${openRoomDetails.has(roomId) ? ' open' : ''}>`
+                + `<summary>ルーム: ${roomId}</summary><div class="room-user-table"></div></details>`;
+        });
+        tableContainer.querySelectorAll('.room-user-details').forEach(details => {
+            // open 属性付きで描画したルームも toggle が発生するので、そこで読み込む
+            details.addEventListener('toggle', () => {
+                const roomId = details.dataset.roomId;
+                if (details.open) {
+                    openRoomDetails.add(roomId);
+                    loadRoomUserTable(details);
+                } else {
+                    openRoomDetails.delete(roomId);
+                }
+            });
+        });
+    }
+}
 
-                const tableData = users.map(user => {
-                    const uData = roomData.users[user] || {};
-                    const stances = uData.stances || {};
-                    return [
-                        user,
-                        uData.posts || 0,
-                        stances['意見'] || 0,
-                        stances['質問'] || 0,
-                        stances['提案'] || 0,
-                        stances['情報提供'] || 0,          // 追加
-                        stances['ファシリテーション'] || 0, // 追加
-                        stances['Geminiへの質問'] || 0,    // 追加
-                        Object.values(uData.reactions_given || {}).reduce((a, b) => a + b, 0),
-                        Object.values(uData.reactions_received || {}).reduce((a, b) => a + b, 0),
-                        uData.note_edits || 0,
-                        uData.facilitator_uses || 0,
-                        uData.proposal_form_edits || 0,
-                        uData.progress_check_uses || 0
-                    ];
-                });
-                
-                createTable(tableContainer, headers, tableData);
-            }
-        }
+/**
+ * ルームの参加者別データを読み込んで表を描画する
+ */
+async function loadRoomUserTable(details) {
+    const container = details.querySelector('.room-user-table');
+    container.innerHTML = '<p>読み込み中...</p>';
+    try {
+        const response = await fetch(`/api/analytics/rooms/${encodeURIComponent(details.dataset.roomId)}`, { cache: "no-store" });
+        if (!response.ok) throw new Error("サーバーからのデータ取得に失敗しました。");
+        const roomData = await response.json();
+        container.innerHTML = '';
+        renderRoomUserTable(container, roomData);
+    } catch (error) {
+        console.error("参加者別データの取得に失敗:", error);
+        container.innerHTML = `<p>データの表示に失敗しました: ${error.message}</p>`;
+    }
+}
+
+function renderRoomUserTable(container, roomData) {
+    const users = roomData.users ? Object.keys(roomData.users).sort() : [];
+    if (users.length > 0) {
+        // ヘッダー定義：すべてのスタンス種類を網羅します
+        const headers = [
+            '参加者', 
+            '総発言', 
+            '意見', 
+            '質問', 
+            '提案', 
+            '情報提供',      // 追加
+            '進行',          // 追加 (ファシリテーション)
+            'G質問',         // 追加 (Geminiへの質問)
+            'リアクション(した)', 
+            '(された)', 
+            'ノート編集', 
+            'AI利用', 
+            '5W1H編集',
+            '進捗確認'
+        ];
+
+        const tableData = users.map(user => {
+            const uData = roomData.users[user] || {};
+            const stances = uData.stances || {};
+            return [
+                user,
+                uData.posts || 0,
+                stances['意見'] || 0,
+                stances['質問'] || 0,
+                stances['提案'] || 0,
+                stances['情報提供'] || 0,          // 追加
+                stances['ファシリテーション'] || 0, // 追加
+                stances['Geminiへの質問'] || 0,    // 追加
+                Object.values(uData.reactions_given || {}).reduce((a, b) => a + b, 0),
+                Object.values(uData.reactions_received || {}).reduce((a, b) => a + b, 0),
+                uData.note_edits || 0,
+                uData.facilitator_uses || 0,
+                uData.proposal_form_edits || 0,
+                uData.progress_check_uses || 0
+            ];
+        });
+        
+        createTable(container, headers, tableData);
+    } else {
+        container.innerHTML = '<p>参加者のデータがありません。</p>';
     }
 }
 
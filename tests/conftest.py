@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# リポジトリ直下のモジュール (utils/ など) を import できるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# models / database の import に必要 (DBを使うテストは、それぞれ一時ファイルの sqlite に作り直す)
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+from fake_gemini import FakeGeminiServer
+
+
+@pytest.fixture
+def fake_gemini():
+    with FakeGeminiServer() as server:
+        yield server
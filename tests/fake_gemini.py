@@ -0,0 +1,140 @@
+"""
+テスト用のローカルの Gemini API サーバー (generateContent / streamGenerateContent の最小限の実装)。
+GEMINI_BASE_URL をこのサーバーに向けると、APIキーなしで AI の呼び出しを確かめられる。
+
+    python tests/fake_gemini.py --port 8090
+    GEMINI_BASE_URL=http://127.0.0.1:8090 GEMINI_API_KEY=dummy uvicorn main:app
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGeminiServer:
+    """
+    別スレッドで動く偽の Gemini API サーバー。
+    - chunks: 応答のテキスト (ストリーミングでは1要素ずつ送る)
+    - delay: 応答を返し始めるまでの秒数 / chunk_delay: ストリーミングの断片の間の秒数
+    - requests に受け取った (モデル名, プロンプトのテキスト) を記録し、同時に処理中の数の最大値を max_active に残す
+    """
+
+    def __init__(self, chunks=("こんにちは", "、", "世界"), delay: float = 0.0, chunk_delay: float = 0.0, port: int = 0):
+        self.chunks = list(chunks)
+        self.delay = delay
+        self.chunk_delay = chunk_delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _begin(self, model: str, prompt: str):
+        with self._lock:
+            self.requests.append((model, prompt))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def _end(self):
+        with self._lock:
+            self.active -= 1
+
+    def response_body(self, text: str, prompt: str, final: bool = True) -> dict:
+        body = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}]}
+        if final:
+            body["candidates"][0]["finishReason"] = "STOP"
+            body["usageMetadata"] = {
+                "promptTokenCount": len(prompt),
+                "candidatesTokenCount": len("".join(self.chunks)),
+                "totalTokenCount": len(prompt) + len("".join(self.chunks)),
+            }
+        return body
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                path = self.path.split("?", 1)[0]
+                model, _, method = path.rsplit("/", 1)[-1].partition(":")
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                prompt = "".join(
+                    part.get("text", "") for content in request.get("contents", []) for part in content.get("parts", [])
+                )
+                server._begin(model, prompt)
+                try:
+                    time.sleep(server.delay)
+                    if method == "streamGenerateContent":
+                        self._stream(prompt)
+                    elif method == "generateContent":
+                        self._send_json(200, server.response_body("".join(server.chunks), prompt))
+                    else:
+                        self._send_json(404, {"error": {"code": 404, "message": f"unknown method {method}", "status": "NOT_FOUND"}})
+                except (BrokenPipeError, ConnectionResetError):
+                    # 呼び出し側が取り消した (接続を切った)
+                    pass
+                finally:
+                    server._end()
+
+            def _send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, prompt: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for idx, chunk in enumerate(server.chunks):
+                    if idx:
+                        time.sleep(server.chunk_delay)
+                    body = server.response_body(chunk, prompt, final=idx == len(server.chunks) - 1)
+                    self.wfile.write(f"data: {json.dumps(body)}\r\n\r\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ローカルの偽の Gemini API サーバー")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    args = parser.parse_args()
+    fake = FakeGeminiServer(delay=args.delay, chunk_delay=args.chunk_delay, port=args.port)
+    print(f"偽の Gemini API サーバーを起動しました: {fake.base_url}")
+    fake._httpd.serve_forever()
@@ -0,0 +1,175 @@
+import asyncio
+
+import pytest
+from google import genai
+from google.genai import types
+
+import utils.client
+from utils.llm import LLMGateway, LLMCancelledError, LLMTimeoutError
+from utils.summarizer import ask_gemini_simple
+
+MODEL = "gemini-test"
+
+
+def run_with_gateway(fake_gemini, scenario, **options):
+    """偽のサーバーに向けたクライアントとゲートウェイを作り、scenario(gateway) を実行する"""
+    async def main():
+        client = genai.Client(api_key="test", http_options=types.HttpOptions(base_url=fake_gemini.base_url))
+        try:
+            return await scenario(LLMGateway(lambda: client, **options))
+        finally:
+            await client.aio.aclose()
+    return asyncio.run(main())
+
+
+def test_generate_records_tokens(fake_gemini):
+    async def scenario(gateway):
+        response = await gateway.generate(MODEL, "質問", room_id="r1", purpose="question")
+        return response.text, gateway.stats()
+
+    text, stats = run_with_gateway(fake_gemini, scenario)
+    assert text == "こんにちは、世界"
+    assert fake_gemini.requests == [(MODEL, "質問")]
+    totals = stats["by_purpose"]["question"]
+    assert totals["calls"] == 1 and totals["errors"] == 0
+    assert totals["prompt_tokens"] == len("質問")
+    assert totals["output_tokens"] == len("こんにちは、世界")
+    assert stats["in_flight"] == 0 and stats["waiting"] == 0
+
+
+def test_global_concurrency_limit(fake_gemini):
+    fake_gemini.delay = 0.2
+
+    async def scenario(gateway):
+        await asyncio.gather(*(gateway.generate(MODEL, f"q{i}", room_id=f"room{i}") for i in range(6)))
+        return gateway.stats()
+
+    stats = run_with_gateway(fake_gemini, scenario, max_concurrency=2, per_room_concurrency=2)
+    assert len(fake_gemini.requests) == 6
+    assert fake_gemini.max_active == 2
+    # 枠が空くのを待った呼び出しは待ち時間が記録される
+    assert max(call["queue_ms"] for call in stats["recent"]) >= 150
+
+
+def test_per_room_concurrency_limit(fake_gemini):
+    fake_gemini.delay = 0.2
+
+    async def scenario(gateway):
+        await asyncio.gather(*(gateway.generate(MODEL, f"q{i}", room_id="busy") for i in range(3)))
+        busy_max = fake_gemini.max_active
+        fake_gemini.max_active = 0
+        await asyncio.gather(*(gateway.generate(MODEL, f"q{i}", room_id=f"room{i}") for i in range(3)))
+        return busy_max, gateway._room_slots
+
+    busy_max, room_slots = run_with_gateway(fake_gemini, scenario, max_concurrency=8, per_room_concurrency=1)
+    assert busy_max == 1
+    # 別々のルームは全体の枠の範囲で同時に実行される
+    assert fake_gemini.max_active == 3
+    # 使い終わったルームの枠は残さない
+    assert room_slots == {}
+
+
+def test_timeout(fake_gemini):
+    fake_gemini.delay = 1.0
+
+    async def scenario(gateway):
+        with pytest.raises(LLMTimeoutError):
+            await gateway.generate(MODEL, "遅い質問", room_id="r1", purpose="question", timeout=0.2)
+        return gateway.stats()
+
+    stats = run_with_gateway(fake_gemini, scenario)
+    assert stats["by_purpose"]["question"]["timeouts"] == 1
+    assert stats["recent"][-1]["status"] == "timeout"
+    assert stats["in_flight"] == 0
+
+
+def test_cancel_owner(fake_gemini):
+    fake_gemini.delay = 1.0
+
+    async def scenario(gateway):
+        # 全体の枠は1つなので、1つ目だけが実行中になり、残りは枠を待つ
+        running = asyncio.create_task(gateway.generate(MODEL, "q", room_id="r1", owner="conn-1", purpose="question"))
+        await asyncio.sleep(0.05)
+        queued = asyncio.create_task(gateway.generate(MODEL, "q", room_id="r2", owner="conn-1", purpose="question"))
+        other = asyncio.create_task(gateway.generate(MODEL, "q", room_id="r3", owner="conn-2", purpose="question"))
+        await asyncio.sleep(0.1)
+        assert gateway.stats()["in_flight"] == 1 and gateway.stats()["waiting"] == 2
+        assert gateway.cancel_owner("conn-1") == 2
+        results = await asyncio.gather(running, queued, other, return_exceptions=True)
+        return results, gateway.stats()
+
+    results, stats = run_with_gateway(fake_gemini, scenario, max_concurrency=1)
+    assert isinstance(results[0], LLMCancelledError)
+    assert isinstance(results[1], LLMCancelledError)
+    # 他の接続の呼び出しは取り消さず、空いた枠で実行される
+    assert results[2].text == "こんにちは、世界"
+    assert len(fake_gemini.requests) == 2
+    assert stats["by_purpose"]["question"]["cancelled"] == 2
+    assert stats["in_flight"] == 0 and stats["waiting"] == 0
+
+
+def test_stream_delivers_deltas_in_order(fake_gemini):
+    fake_gemini.chunks = ["一つ目", "二つ目", "三つ目"]
+    fake_gemini.chunk_delay = 0.05
+    deltas = []
+
+    async def on_text(delta):
+        deltas.append(delta)
+
+    async def scenario(gateway):
+        text = await gateway.generate_stream(MODEL, "質問", on_text, room_id="r1", purpose="question")
+        return text, gateway.stats()
+
+    text, stats = run_with_gateway(fake_gemini, scenario)
+    assert deltas == ["一つ目", "二つ目", "三つ目"]
+    assert text == "一つ目二つ目三つ目"
+    record = stats["recent"][-1]
+    assert record["ttft_ms"] is not None and record["ttft_ms"] <= record["model_ms"]
+    assert record["output_tokens"] == len(text)
+    assert stats["by_purpose"]["question"]["streamed"] == 1
+
+
+def test_stream_cancelled_by_owner_stops_deltas(fake_gemini):
+    fake_gemini.chunks = ["a", "b", "c", "d"]
+    fake_gemini.chunk_delay = 0.3
+    deltas = []
+
+    async def on_text(delta):
+        deltas.append(delta)
+
+    async def scenario(gateway):
+        task = asyncio.create_task(gateway.generate_stream(MODEL, "q", on_text, owner="conn-1", purpose="question"))
+        while not deltas:
+            await asyncio.sleep(0.01)
+        gateway.cancel_owner("conn-1")
+        with pytest.raises(LLMCancelledError):
+            await task
+        await asyncio.sleep(0.4)
+
+    run_with_gateway(fake_gemini, scenario)
+    # 取り消した後の断片は配信しない
+    assert deltas == ["a"]
+
+
+def test_ask_gemini_simple_streams_gemini_deltas(fake_gemini, monkeypatch):
+    """main.py の gemini_delta フレームの元になる断片が、アプリのクライアント設定のまま届くこと"""
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    monkeypatch.setenv("GEMINI_BASE_URL", fake_gemini.base_url)
+    monkeypatch.setattr(utils.client, "_client", None)
+    monkeypatch.setattr(utils.client, "_llm_gateway", None)
+    fake_gemini.chunks = ["回答", "です"]
+    deltas = []
+
+    async def on_text(delta):
+        deltas.append(delta)
+
+    async def main():
+        try:
+            return await ask_gemini_simple("質問", room_id="r1", owner="conn-1", on_text=on_text)
+        finally:
+            await utils.client.close_gemini_client()
+
+    answer = asyncio.run(main())
+    assert answer == "回答です"
+    assert deltas == ["回答", "です"]
+    assert "質問" in fake_gemini.requests[0][1]
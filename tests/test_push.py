@@ -0,0 +1,268 @@
+import asyncio
+import base64
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from database import Base
+from models import Room, PushSubscription
+from utils.push import PushDispatcher, webpush_sender
+
+ROOM_ID = "room1"
+
+
+class PushError(Exception):
+    """pywebpush の WebPushException と同じく response.status_code を持つ送信エラー"""
+
+    def __init__(self, status_code):
+        super().__init__(f"push failed: {status_code}")
+        self.response = SimpleNamespace(status_code=status_code)
+
+
+class RecordingSender:
+    """
+    PushDispatcher に渡す送信関数の代わり。送った (エンドポイント, ペイロード) を記録する。
+    failures[endpoint] に並べたステータスを、そのエンドポイントへの送信で順に返す (エラーにする)
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.sent = []
+        self.failures = {}
+        self.delay = delay
+        self.active = {}
+        self.max_active = {}
+
+    async def __call__(self, subscription_info, payload):
+        endpoint = subscription_info["endpoint"]
+        self.active[endpoint] = self.active.get(endpoint, 0) + 1
+        self.max_active[endpoint] = max(self.max_active.get(endpoint, 0), self.active[endpoint])
+        try:
+            await asyncio.sleep(self.delay)
+            statuses = self.failures.get(endpoint)
+            if statuses:
+                raise PushError(statuses.pop(0))
+            self.sent.append((endpoint, json.loads(payload)))
+        finally:
+            self.active[endpoint] -= 1
+
+
+def run_dispatcher(tmp_path, subscriptions, scenario, sender=None, **options):
+    """一時ファイルの sqlite に購読を登録し、起動したディスパッチャーで scenario(dispatcher, session_factory) を実行する"""
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.sqlite'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as db:
+            for room_id in {room_id for room_id, _, _ in subscriptions}:
+                db.add(Room(room_id=room_id, topic="議題"))
+            for room_id, username, endpoint in subscriptions:
+                db.add(PushSubscription(room_id=room_id, username=username, endpoint=endpoint, p256dh="key", auth="auth"))
+            await db.commit()
+
+        options.setdefault("coalesce_window", 0.1)
+        options.setdefault("retry_base_delay", 0.01)
+        dispatcher = PushDispatcher(session_factory, sender=sender or RecordingSender(), **options)
+        dispatcher.start()
+        try:
+            return await scenario(dispatcher, session_factory)
+        finally:
+            await dispatcher.stop()
+            await engine.dispose()
+    return asyncio.run(main())
+
+
+async def wait_idle(dispatcher, timeout: float = 3.0):
+    """通知がまとめられて送信し終わるまで待つ"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    await asyncio.sleep(dispatcher.coalesce_window)
+    while loop.time() < deadline:
+        stats = dispatcher.stats()
+        if (not stats["events_waiting"] and not stats["deliveries_waiting"] and not stats["pending_users"]
+                and not dispatcher._endpoint_slots and not dispatcher._retry_tasks):
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"通知の送信が終わりませんでした: {dispatcher.stats()}")
+
+
+async def remaining_endpoints(session_factory):
+    async with session_factory() as db:
+        result = await db.execute(select(PushSubscription.endpoint).order_by(PushSubscription.endpoint))
+        return result.scalars().all()
+
+
+SUBSCRIPTIONS = [
+    (ROOM_ID, "alice", "https://push.example/alice"),
+    (ROOM_ID, "bob", "https://push.example/bob-phone"),
+    (ROOM_ID, "bob", "https://push.example/bob-laptop"),
+    (ROOM_ID, "carol", "https://push.example/carol"),
+]
+
+
+def test_burst_is_coalesced_into_one_push_per_device(tmp_path):
+    sender = RecordingSender()
+
+    async def scenario(dispatcher, session_factory):
+        for i in range(20):
+            assert dispatcher.notify(ROOM_ID, "alice", f"発言{i}")
+        await wait_idle(dispatcher)
+        return dispatcher.stats()
+
+    stats = run_dispatcher(tmp_path, SUBSCRIPTIONS, scenario, sender=sender)
+    # 送信者本人には送らず、他の参加者の端末ごとに1回だけ送る
+    assert sorted(endpoint for endpoint, _ in sender.sent) == [
+        "https://push.example/bob-laptop", "https://push.example/bob-phone", "https://push.example/carol",
+    ]
+    for endpoint, payload in sender.sent:
+        assert payload["title"] == "20件の新しいメッセージ"
+        assert payload["body"] == "alice: 発言19"
+    assert {payload["url"] for _, payload in sender.sent} == {
+        f"/room/{ROOM_ID}?username=bob", f"/room/{ROOM_ID}?username=carol",
+    }
+    assert stats["queued"] == 20 and stats["coalesced"] == 19 * 2 and stats["sent"] == 3
+
+
+def test_single_message_names_the_sender(tmp_path):
+    sender = RecordingSender()
+
+    async def scenario(dispatcher, session_factory):
+        dispatcher.notify(ROOM_ID, "bob", "こんにちは")
+        await wait_idle(dispatcher)
+
+    run_dispatcher(tmp_path, SUBSCRIPTIONS, scenario, sender=sender)
+    assert sorted(endpoint for endpoint, _ in sender.sent) == ["https://push.example/alice", "https://push.example/carol"]
+    assert {(payload["title"], payload["body"]) for _, payload in sender.sent} == {("bobさんからのメッセージ", "こんにちは")}
+
+
+def test_gone_subscriptions_are_pruned(tmp_path):
+    sender = RecordingSender()
+    sender.failures = {"https://push.example/bob-phone": [404], "https://push.example/carol": [410]}
+
+    async def scenario(dispatcher, session_factory):
+        dispatcher.notify(ROOM_ID, "alice", "1回目")
+        await wait_idle(dispatcher)
+        after_first = await remaining_endpoints(session_factory)
+        # 削除した購読はキャッシュからも消え、次の通知では送らない
+        dispatcher.notify(ROOM_ID, "alice", "2回目")
+        await wait_idle(dispatcher)
+        return after_first, dispatcher.stats()
+
+    after_first, stats = run_dispatcher(tmp_path, SUBSCRIPTIONS, scenario, sender=sender)
+    assert after_first == ["https://push.example/alice", "https://push.example/bob-laptop"]
+    assert stats["pruned"] == 2 and stats["retried"] == 0 and stats["failed"] == 0
+    assert [(endpoint, payload["body"]) for endpoint, payload in sender.sent] == [
+        ("https://push.example/bob-laptop", "1回目"), ("https://push.example/bob-laptop", "2回目"),
+    ]
+
+
+def test_transient_errors_are_retried_but_not_pruned(tmp_path):
+    sender = RecordingSender()
+    sender.failures = {"https://push.example/carol": [503, 429], "https://push.example/bob-phone": [400]}
+
+    async def scenario(dispatcher, session_factory):
+        dispatcher.notify(ROOM_ID, "alice", "こんにちは")
+        await wait_idle(dispatcher)
+        return await remaining_endpoints(session_factory), dispatcher.stats()
+
+    endpoints, stats = run_dispatcher(tmp_path, SUBSCRIPTIONS, scenario, sender=sender)
+    assert len(endpoints) == len(SUBSCRIPTIONS)
+    assert sorted(endpoint for endpoint, _ in sender.sent) == ["https://push.example/bob-laptop", "https://push.example/carol"]
+    assert stats["retried"] == 2 and stats["failed"] == 1 and stats["pruned"] == 0
+
+
+def test_one_send_at_a_time_per_endpoint(tmp_path):
+    sender = RecordingSender(delay=0.05)
+    shared = "https://push.example/shared"
+    subscriptions = [(f"room{i}", "bob", shared) for i in range(4)] + [(f"room{i}", "carol", f"https://push.example/carol{i}") for i in range(4)]
+
+    async def scenario(dispatcher, session_factory):
+        for i in range(4):
+            dispatcher.notify(f"room{i}", "alice", "こんにちは")
+        await wait_idle(dispatcher)
+
+    run_dispatcher(tmp_path, subscriptions, scenario, sender=sender, workers=4)
+    assert len(sender.sent) == 8
+    assert sender.max_active[shared] == 1
+
+
+class StubPushService:
+    """ローカルの Web Push サービスの代わり。パスごとに返すステータスを決め、受け取ったリクエストを記録する"""
+
+    def __init__(self, statuses: dict):
+        self.statuses = statuses
+        self.received = []
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                service.received.append((self.path, {key.lower(): value for key, value in self.headers.items()}, body))
+                self.send_response(service.statuses.get(self.path, 201))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}{path}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").strip("=")
+
+
+def test_webpush_sender_against_stub_endpoint(tmp_path):
+    """実際の pywebpush での送信 (暗号化・VAPID署名) と、410 を返した購読の削除"""
+    vapid_key = ec.generate_private_key(ec.SECP256R1())
+    # pywebpush が文字列で受け付ける形式 (DER の URL セーフ Base64)
+    vapid_private_key = _b64(vapid_key.private_bytes(
+        serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ))
+    browser_key = ec.generate_private_key(ec.SECP256R1()).public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+
+    with StubPushService({"/gone": 410}) as service:
+        subscriptions = [(ROOM_ID, "bob", service.url("/ok")), (ROOM_ID, "carol", service.url("/gone"))]
+
+        async def scenario(dispatcher, session_factory):
+            async with session_factory() as db:
+                for sub in (await db.execute(select(PushSubscription))).scalars().all():
+                    sub.p256dh, sub.auth = _b64(browser_key), _b64(os.urandom(16))
+                await db.commit()
+            dispatcher.notify(ROOM_ID, "alice", "こんにちは")
+            await wait_idle(dispatcher, timeout=10.0)
+            return await remaining_endpoints(session_factory), dispatcher.stats()
+
+        sender = webpush_sender(vapid_private_key, {"sub": "mailto:test@example.com"})
+        endpoints, stats = run_dispatcher(tmp_path, subscriptions, scenario, sender=sender)
+
+    assert sorted(path for path, _, _ in service.received) == ["/gone", "/ok"]
+    for _, headers, body in service.received:
+        assert headers["content-encoding"] == "aes128gcm"
+        assert headers["authorization"].startswith("vapid t=")
+        # 本文は暗号化されている
+        assert "こんにちは".encode("utf-8") not in body
+    assert endpoints == [service.url("/ok")]
+    assert stats["sent"] == 1 and stats["pruned"] == 1
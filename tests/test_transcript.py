@@ -0,0 +1,198 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from database import Base
+from models import Room, Message, TranscriptSegment
+from utils.transcript import TranscriptCache, TranscriptCompactor, format_chat_line
+
+ROOM_ID = "room1"
+TOPIC = "議題"
+START = datetime(2024, 1, 1, 9, 0, 0)
+
+
+class StubHub:
+    """購読のない room_hub (TranscriptCache は毎回DBから議論ログを作る)"""
+
+    def add_observer(self, observer):
+        pass
+
+    def is_live(self, room_id):
+        return False
+
+
+class StubModel:
+    """要約を返す代わりのモデル。渡された議論ログ・要約を記録し、fail が真なら失敗する"""
+
+    def __init__(self):
+        self.summaries = []
+        self.merges = []
+        self.fail = False
+
+    async def summarize(self, chat_history, topic, room_id=None):
+        if self.fail:
+            raise RuntimeError("model unavailable")
+        self.summaries.append(chat_history)
+        return f"要約{len(self.summaries)}"
+
+    async def merge(self, summaries, topic, room_id=None):
+        if self.fail:
+            raise RuntimeError("model unavailable")
+        self.merges.append(list(summaries))
+        return "+".join(summaries)
+
+
+def message_line(idx):
+    return format_chat_line({"username": f"user{idx % 3}", "stance": "意見", "content": f"発言{idx}"})
+
+
+def run_scenario(tmp_path, scenario, **options):
+    """一時ファイルの sqlite にルームを作り、scenario(compactor, add_messages, model) を実行する"""
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.sqlite'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as db:
+            db.add(Room(room_id=ROOM_ID, topic=TOPIC))
+            await db.commit()
+
+        count = 0
+
+        async def add_messages(n):
+            nonlocal count
+            async with session_factory() as db:
+                for _ in range(n):
+                    db.add(Message(
+                        message_id=f"m{count:03d}", room_id=ROOM_ID, username=f"user{count % 3}",
+                        content=f"発言{count}", stance="意見", created_at=START + timedelta(seconds=count),
+                    ))
+                    count += 1
+                await db.commit()
+
+        model = StubModel()
+        compactor = TranscriptCompactor(
+            session_factory, TranscriptCache(session_factory, StubHub()), model.summarize, model.merge, **options
+        )
+        try:
+            return await scenario(compactor, add_messages, model)
+        finally:
+            await engine.dispose()
+    return asyncio.run(main())
+
+
+def test_short_room_is_sent_raw(tmp_path):
+    async def scenario(compactor, add_messages, model):
+        await add_messages(5)
+        rolling = await compactor.rolling(ROOM_ID)
+        return compactor.needs_compaction(rolling), rolling.text(), rolling.transcript.text()
+
+    needs, text, raw = run_scenario(tmp_path, scenario, tail_size=3, segment_size=4)
+    assert not needs
+    # 区間がまだなく、要約を待つ必要のない長さなら従来どおり全文を渡す
+    assert text == raw
+    assert text.splitlines() == [message_line(i) for i in range(5)]
+
+
+def test_segments_cover_oldest_messages_in_order(tmp_path):
+    async def scenario(compactor, add_messages, model):
+        await add_messages(10)
+        assert compactor.needs_compaction(await compactor.rolling(ROOM_ID))
+        await compactor.compact(ROOM_ID, TOPIC)
+        first = await compactor.rolling(ROOM_ID)
+        await add_messages(1)
+        await compactor.compact(ROOM_ID, TOPIC)
+        second = await compactor.rolling(ROOM_ID)
+        return first, second
+
+    first, second = run_scenario(tmp_path, scenario, tail_size=3, segment_size=4)
+    # 10件 (tail 3 + segment 4 以上) -> 古い4件が1区間になり、残りの6件では次の区間を作らない
+    assert [(s.seq, s.message_count, s.last_message_id) for s in first.segments] == [(0, 4, "m003")]
+    assert len(first.transcript.entries_after(first.boundary())) == 6
+    # 11件目で7件溜まり、その古い4件 (m004-m007) が次の区間になる
+    assert [(s.seq, s.message_count, s.last_message_id) for s in second.segments] == [(0, 4, "m003"), (1, 4, "m007")]
+    assert [entry["message_id"] for entry, _ in second.transcript.entries_after(second.boundary())] == ["m008", "m009", "m010"]
+
+
+def test_rolling_text_has_summaries_and_raw_tail(tmp_path):
+    async def scenario(compactor, add_messages, model):
+        await add_messages(11)
+        await compactor.compact(ROOM_ID, TOPIC)
+        return (await compactor.rolling(ROOM_ID)).text(), model
+
+    text, model = run_scenario(tmp_path, scenario, tail_size=3, segment_size=4)
+    # スタブには区間ごとに、その区間の発言の行だけが渡される
+    assert model.summaries == [
+        "\n".join(message_line(i) for i in range(0, 4)),
+        "\n".join(message_line(i) for i in range(4, 8)),
+    ]
+    assert text.splitlines() == [
+        "[これまでの議論の要約]",
+        "(1) 要約1",
+        "(2) 要約2",
+        "[直近の発言]",
+        message_line(8), message_line(9), message_line(10),
+    ]
+
+
+def test_old_segments_are_merged(tmp_path):
+    async def scenario(compactor, add_messages, model):
+        await add_messages(3 * 4 + 3)
+        await compactor.compact(ROOM_ID, TOPIC)
+        rolling = await compactor.rolling(ROOM_ID)
+        return rolling, model, compactor.stats()
+
+    rolling, model, stats = run_scenario(tmp_path, scenario, tail_size=3, segment_size=4, max_segments=2)
+    # 3区間目で max_segments を超え、古い2区間が1つにまとめ直される
+    assert model.merges == [["要約1", "要約2"]]
+    assert [(s.seq, s.level, s.message_count, s.summary) for s in rolling.segments] == [
+        (0, 1, 8, "要約1+要約2"), (2, 0, 4, "要約3"),
+    ]
+    assert stats["segments"] == 3 and stats["merges"] == 1
+    assert rolling.text().splitlines()[:3] == ["[これまでの議論の要約]", "(1) 要約1+要約2", "(2) 要約3"]
+
+
+def test_model_failure_keeps_prompt_bounded(tmp_path):
+    async def scenario(compactor, add_messages, model):
+        model.fail = True
+        await add_messages(20)
+        await compactor.compact(ROOM_ID, TOPIC)
+        failed = await compactor.rolling(ROOM_ID)
+        failed_stats = compactor.stats()
+        # モデルが戻れば、次の要約で追いつく
+        model.fail = False
+        await compactor.compact(ROOM_ID, TOPIC)
+        recovered = await compactor.rolling(ROOM_ID)
+        return failed, failed_stats, recovered
+
+    failed, failed_stats, recovered = run_scenario(tmp_path, scenario, tail_size=3, segment_size=4)
+    assert failed.segments == []
+    assert failed_stats["errors"] == 1 and failed_stats["running"] == 0
+    # 要約が追いついていない分は省略し、直近の発言 (tail_size + segment_size - 1 件) だけを渡す
+    lines = failed.text().splitlines()
+    assert lines[0] == "（中略: 14件の発言）"
+    assert lines[1] == "[直近の発言]"
+    assert lines[2:] == [message_line(i) for i in range(14, 20)]
+    assert [s.message_count for s in recovered.segments] == [4, 4, 4, 4]
+    assert len(recovered.transcript.entries_after(recovered.boundary())) == 4
+
+
+def test_concurrent_compaction_saves_each_segment_once(tmp_path):
+    async def scenario(compactor, add_messages, model):
+        other = TranscriptCompactor(
+            compactor.session_factory, compactor.cache, model.summarize, model.merge,
+            tail_size=compactor.tail_size, segment_size=compactor.segment_size,
+        )
+        await add_messages(10)
+        await asyncio.gather(compactor.compact(ROOM_ID, TOPIC), other.compact(ROOM_ID, TOPIC))
+        async with compactor.session_factory() as db:
+            segments = (await db.execute(select(TranscriptSegment).order_by(TranscriptSegment.seq))).scalars().all()
+        return segments, compactor.stats()["conflicts"] + other.stats()["conflicts"]
+
+    segments, conflicts = run_scenario(tmp_path, scenario, tail_size=3, segment_size=4)
+    # 2つのワーカーが同じ区間を作っても、(room_id, seq) の一意制約で1つだけが保存される
+    assert [(s.seq, s.last_message_id) for s in segments] == [(0, "m003")]
+    assert conflicts == 1
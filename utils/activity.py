@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import json
+from collections import Counter
+
+from sqlalchemy import select, func, distinct
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import UserActivity
+
+# リアクションの種類
+REACTION_TYPES = ("agree", "partial", "disagree")
+
+# 参加者として集計しないユーザー (AIやシステムの発言)
+NON_PARTICIPANT_USERNAMES = {"Gemini", "Gemini（AIファシリテーター）", "System"}
+
+def stance_metric(stance: str) -> str:
+    return f"stances:{stance}"
+
+def reactions_given_metric(reaction_type: str) -> str:
+    return f"reactions_given:{reaction_type}"
+
+def reactions_received_metric(reaction_type: str) -> str:
+    return f"reactions_received:{reaction_type}"
+
+async def bump_activity(db, room_id: str, entries):
+    """
+    活動カウンタを原子的に加算する。entries は (username, metric, amount) のリスト。
+    同じキーは事前に合算し、1回の INSERT ... ON CONFLICT DO UPDATE で反映する。
+    """
+    totals = Counter()
+    for username, metric, amount in entries:
+        totals[(username, metric)] += amount
+    # 同じ行を更新するトランザクション同士が同じ順番で行ロックを取るよう、キーの順に並べる (デッドロックの防止)
+    rows = [
+        {"room_id": room_id, "username": username, "metric": metric, "n": amount}
+        for (username, metric), amount in sorted(totals.items())
+    ]
+    if not rows:
+        return
+
+    stmt = pg_insert(UserActivity).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserActivity.room_id, UserActivity.username, UserActivity.metric],
+        set_={"n": UserActivity.n + stmt.excluded.n}
+    )
+    await db.execute(stmt)
+    # ルーム別・全体の合計はここでは更新しない (同じルームの書き込みが合計の行を奪い合わないように)。
+    # 呼び出し元はコミット後に AnalyticsSnapshot.bump() を呼び、分析画面の作り直しを知らせる
+
+async def build_analytics_report(db) -> dict:
+    """
+    開発者ツールの分析画面のデータ。user_activity をルームごとに GROUP BY して合計し、全体の合計はそれを足し合わせる。
+    参加者別の詳細は含めない (build_room_user_report でルームごとに読む)
+    """
+    by_room = {}
+    overall = empty_activity_summary()
+    result = await db.execute(
+        select(UserActivity.room_id, UserActivity.metric, func.sum(UserActivity.n))
+        .group_by(UserActivity.room_id, UserActivity.metric)
+    )
+    for room_id, metric, n in result.all():
+        room_summary = by_room.get(room_id)
+        if room_summary is None:
+            room_summary = by_room[room_id] = empty_activity_summary()
+            room_summary["participants"] = 0
+        add_metric(room_summary, metric, int(n or 0))
+        add_metric(overall, metric, int(n or 0))
+
+    participant_filter = UserActivity.username.notin_(NON_PARTICIPANT_USERNAMES)
+    result = await db.execute(
+        select(UserActivity.room_id, func.count(distinct(UserActivity.username)))
+        .filter(participant_filter)
+        .group_by(UserActivity.room_id)
+    )
+    for room_id, n in result.all():
+        if room_id in by_room:
+            by_room[room_id]["participants"] = n
+    # 複数のルームに参加した人を1人と数えるため、全体の参加者数はルーム別の参加者数を足さずに数える
+    overall["participants"] = await db.scalar(
+        select(func.count(distinct(UserActivity.username))).filter(participant_filter)
+    ) or 0
+    return {"by_room": by_room, "overall": overall}
+
+async def build_room_user_report(db, room_id: str) -> dict:
+    """ルームの参加者別の詳細 (行をそのまま入れ子の辞書に並べ替えるだけで、集計はしない)"""
+    users = {}
+    result = await db.execute(
+        select(UserActivity.username, UserActivity.metric, UserActivity.n)
+        .filter(UserActivity.room_id == room_id, UserActivity.username.notin_(NON_PARTICIPANT_USERNAMES))
+    )
+    for username, metric, n in result.all():
+        add_metric(users.setdefault(username, empty_activity_summary()), metric, n)
+    return {"room_id": room_id, "users": users}
+
+class AnalyticsSnapshot:
+    """
+    /api/analytics のレスポンス。活動カウンタを変えた側はコミット後に bump() で Redis の集計バージョンを進め、
+    各ワーカーは refresh_interval 秒ごとにバージョンを確認して、変わっていたときだけ build_analytics_report で作り直す。
+    ETag はバージョンから作るため、どのワーカーに届いた If-None-Match でも同じように 304 を返せる。
+    リクエストはメモリ上の本文を返すだけで、DBを読まない。
+    (Redis がない場合は毎回作り直し、ETag は本文のハッシュにする)
+    """
+
+    VERSION_KEY = "analytics:version"
+
+    def __init__(self, session_factory, refresh_interval: float = 15.0):
+        self.session_factory = session_factory
+        self.refresh_interval = refresh_interval
+        self.redis = None
+        self.body = None
+        self.etag = None
+        self.version = None
+        self._task = None
+        self._refresh_lock = asyncio.Lock()
+        self.counters = {"refreshed": 0, "skipped": 0, "bumped": 0, "failures": 0}
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    def start(self):
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def bump(self):
+        """活動カウンタが変わったことを全ワーカーに知らせる (コミット後に呼ぶ)。失敗しても呼び出し元の処理は止めない"""
+        if not self.redis:
+            return
+        try:
+            await self.redis.incr(self.VERSION_KEY)
+            self.counters["bumped"] += 1
+        except Exception as e:
+            print(f"分析データのバージョンを更新できませんでした: {e}")
+
+    async def refresh(self):
+        async with self._refresh_lock:
+            version = None
+            if self.redis:
+                # 集計する前にバージョンを読む (集計中に進んだ場合は、次の確認で作り直す)
+                version = int(await self.redis.get(self.VERSION_KEY) or 0)
+                if self.body is not None and version == self.version:
+                    self.counters["skipped"] += 1
+                    return
+            async with self.session_factory() as db:
+                report = await build_analytics_report(db)
+            body = json.dumps(report, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+            if version is None:
+                etag = f'W/"analytics-{hashlib.sha256(body).hexdigest()[:16]}"'
+            else:
+                etag = f'W/"analytics-v{version}"'
+            self.body, self.etag, self.version = body, etag, version
+            self.counters["refreshed"] += 1
+
+    async def current(self) -> tuple:
+        """(本文, ETag)。起動直後でまだ読んでいなければ、その場で1回読む"""
+        if self.body is None:
+            await self.refresh()
+        return self.body, self.etag
+
+    def stats(self) -> dict:
+        return {**self.counters, "version": self.version}
+
+    async def _refresh_loop(self):
+        # 起動時の移行や、コミット後に bump() できずに落ちたワーカーの変更を反映させるため、起動時に1回進める
+        await self.bump()
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.counters["failures"] += 1
+                print(f"分析データの定期集計でエラーが発生しました: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+def empty_activity_summary() -> dict:
+    """集計結果の初期構造 (開発者ツールが期待する形)"""
+    return {
+        "posts": 0, "stances": {},
+        "reactions_given": {r_type: 0 for r_type in REACTION_TYPES},
+        "reactions_received": {r_type: 0 for r_type in REACTION_TYPES},
+        "note_edits": 0, "facilitator_uses": 0, "proposal_form_edits": 0, "progress_check_uses": 0
+    }
+
+def add_metric(summary: dict, metric: str, value: int):
+    """"stances:意見" のような metric 名を、集計結果の入れ子の辞書に反映する"""
+    if ":" in metric:
+        group, key = metric.split(":", 1)
+        bucket = summary.setdefault(group, {})
+        bucket[key] = bucket.get(key, 0) + value
+    else:
+        summary[metric] = summary.get(metric, 0) + value
+
+def flatten_legacy_analytics(analytics: dict):
+    """旧形式の Room.analytics (JSON) を (username, metric, n) のリストに変換する"""
+    rows = []
+    for username, u_data in (analytics or {}).get("users", {}).items():
+        # 一度も操作していない参加者も参加者数に含めるため、接続回数の行を必ず作る
+        rows.append((username, "sessions", 1))
+        for key, value in u_data.items():
+            if isinstance(value, dict):
+                for sub_key, count in value.items():
+                    if count:
+                        rows.append((username, f"{key}:{sub_key}", count))
+            elif value:
+                rows.append((username, key, value))
+    return rows
@@ -0,0 +1,112 @@
+import asyncio
+import time
+import uuid
+
+# ロックの解放は「自分が取得したロックの場合のみ削除」をアトミックに行う
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class AIResponseCache:
+    """
+    ファシリテーション・進捗確認などのAIの結果を、ルームの状態バージョンごとに Redis にキャッシュする。
+    - 状態バージョンはルームの内容 (発言・リアクション・ノート・提案フォームなど) が変わるたびに bump() で進める
+    - キーは (ルーム, 種別, バージョン) で、ttl 秒で期限切れになる
+    - 同じキーの同時の問い合わせは1回にまとめる
+      (ワーカー内は実行中のタスクを共有し、ワーカー間は Redis のロックを持つワーカーの結果を待つ)
+    """
+
+    def __init__(self, ttl: int = 300, lock_ttl_ms: int = 200000, poll_interval: float = 0.2):
+        self.redis = None
+        self.ttl = ttl
+        self.lock_ttl_ms = lock_ttl_ms
+        self.poll_interval = poll_interval
+        self._inflight = {}
+        self.counters = {"hits": 0, "misses": 0, "shared": 0, "waited": 0, "stored": 0, "uncacheable": 0, "bypass": 0}
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def _version_key(room_id: str) -> str:
+        return f"room_state_version:{room_id}"
+
+    async def bump(self, room_id: str):
+        """ルームの状態バージョンを進める (以前のバージョンのキャッシュは使われなくなる)"""
+        if self.redis:
+            await self.redis.incr(self._version_key(room_id))
+
+    async def version(self, room_id: str) -> int:
+        value = await self.redis.get(self._version_key(room_id))
+        return int(value or 0)
+
+    async def get_or_compute(self, room_id: str, kind: str, compute):
+        """
+        キャッシュがあればそれを、なければ compute() (戻り値は (結果の文字列, キャッシュしてよいか)) を実行して返す。
+        戻り値は (結果, キャッシュまたは他の問い合わせの結果を使ったか)。
+        """
+        if not self.redis:
+            self.counters["bypass"] += 1
+            value, _ = await compute()
+            return value, False
+
+        key = f"ai_cache:{room_id}:{kind}:{await self.version(room_id)}"
+        cached = await self.redis.get(key)
+        if cached is not None:
+            self.counters["hits"] += 1
+            return cached, True
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.counters["shared"] += 1
+            value, _ = await asyncio.shield(task)
+            return value, True
+
+        self.counters["misses"] += 1
+        # 要求元が切断しても、同じ結果を待っている他の要求のために実行を続ける
+        task = asyncio.create_task(self._compute(key, compute))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {**self.counters, "in_flight": len(self._inflight)}
+
+    async def _compute(self, key: str, compute):
+        lock_key = f"{key}:lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_ttl_ms / 1000
+        while not await self.redis.set(lock_key, token, nx=True, px=self.lock_ttl_ms):
+            # 他のワーカーが問い合わせ中なので、その結果が保存されるのを待つ
+            cached = await self.redis.get(key)
+            if cached is not None:
+                self.counters["waited"] += 1
+                return cached, True
+            if time.monotonic() >= deadline:
+                # 待ちきれない場合は自分で問い合わせる (キャッシュには保存しない)
+                value, _ = await compute()
+                return value, False
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            # ロックを待つ間に他のワーカーが保存した場合はそれを使う
+            cached = await self.redis.get(key)
+            if cached is not None:
+                self.counters["waited"] += 1
+                return cached, True
+            value, cacheable = await compute()
+            if cacheable:
+                await self.redis.set(key, value, ex=self.ttl)
+                self.counters["stored"] += 1
+            else:
+                self.counters["uncacheable"] += 1
+            return value, False
+        finally:
+            try:
+                await self.redis.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+            except Exception as e:
+                print(f"AIキャッシュのロック解放に失敗しました ({key}): {e}")
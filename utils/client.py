@@ -2,13 +2,17 @@
 
 import os
 from google import genai
+from google.genai import types
 from dotenv import load_dotenv
 
+from .llm import LLMGateway
+
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
 # グローバル変数としてクライアントを保持
 _client = None
+_llm_gateway = None
 
 def get_gemini_client():
     """
@@ -21,6 +25,31 @@ def get_gemini_client():
             raise ValueError("エラー: 環境変数に GEMINI_API_KEY が設定されていません。")
         
         # 新しい作法でクライアントを初期化
-        _client = genai.Client(api_key=gemini_api_key)
+        # (GEMINI_BASE_URL を指定すると、検証用のローカルのモックサーバーなどに向けられる)
+        base_url = os.getenv("GEMINI_BASE_URL")
+        http_options = types.HttpOptions(base_url=base_url) if base_url else None
+        _client = genai.Client(api_key=gemini_api_key, http_options=http_options)
     
-    return _client
\ No newline at end of file
+    return _client
+
+async def close_gemini_client():
+    """アプリケーション終了時に、非同期クライアントのHTTP接続を閉じる"""
+    global _client
+    if _client is not None:
+        await _client.aio.aclose()
+        _client = None
+
+def get_llm_gateway():
+    """
+    Geminiへの問い合わせに使うゲートウェイ (utils/llm.py) のシングルトンを返す関数。
+    同時実行数やタイムアウトは環境変数で調整する。
+    """
+    global _llm_gateway
+    if _llm_gateway is None:
+        _llm_gateway = LLMGateway(
+            get_gemini_client,
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+            per_room_concurrency=int(os.getenv("LLM_ROOM_CONCURRENCY", "2")),
+            timeout=float(os.getenv("LLM_TIMEOUT_SECONDS", "180")),
+        )
+    return _llm_gateway
\ No newline at end of file
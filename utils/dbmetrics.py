@@ -0,0 +1,125 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# ヒストグラムの区切り (ミリ秒)。各区切り以下の件数を累積で数える (Prometheus の le と同じ)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# 実行中のクエリをどこから呼んだか (エンドポイント・フレームの種類など)
+_query_site = ContextVar("query_site", default="other")
+
+
+@contextmanager
+def query_site(name: str):
+    """この中で実行したクエリの所要時間を name ごとに集計する"""
+    token = _query_site.set(name)
+    try:
+        yield
+    finally:
+        _query_site.reset(token)
+
+
+def set_query_site(name: str):
+    """リクエストの処理全体 (タスクのコンテキスト) のクエリを name として集計する"""
+    _query_site.set(name)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def snapshot(self) -> dict:
+        cumulative, buckets = 0, {}
+        for bound, n in zip(LATENCY_BUCKETS_MS + ("+Inf",), self.buckets):
+            cumulative += n
+            buckets[str(bound)] = cumulative
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max_ms, 3),
+            "le_ms": buckets,
+        }
+
+
+class DatabaseMetrics:
+    """
+    接続プールとクエリの計測 (このワーカー分)。
+    - プール: 貸し出し中・待機中の接続数と、接続を借りるまでの待ち時間 (InstrumentedQueuePool)
+    - クエリ: 呼び出し元 (query_site) ごとの所要時間のヒストグラム
+    """
+
+    def __init__(self):
+        self.engine = None
+        self.pool_wait = LatencyHistogram()
+        self.pool_timeouts = 0
+        self.queries = {}
+
+    def instrument(self, engine):
+        self.engine = engine
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", self._before_execute)
+        event.listen(sync_engine, "after_cursor_execute", self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_started", None)
+        if started is None:
+            return
+        site = _query_site.get()
+        histogram = self.queries.get(site)
+        if histogram is None:
+            histogram = self.queries[site] = LatencyHistogram()
+        histogram.observe(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        pool = self.engine.pool if self.engine else None
+        pool_stats = {"class": type(pool).__name__ if pool else None}
+        if isinstance(pool, AsyncAdaptedQueuePool):
+            pool_stats.update({
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+                "timeout": pool.timeout(),
+            })
+        pool_stats["wait"] = self.pool_wait.snapshot()
+        pool_stats["timeouts"] = self.pool_timeouts
+        return {
+            "pool": pool_stats,
+            "queries": {site: histogram.snapshot() for site, histogram in sorted(self.queries.items())},
+        }
+
+
+db_metrics = DatabaseMetrics()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """接続を借りるまでの待ち時間とタイムアウトの回数を db_metrics に記録する接続プール"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            db_metrics.pool_timeouts += 1
+            raise
+        finally:
+            db_metrics.pool_wait.observe(time.perf_counter() - started)
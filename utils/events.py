@@ -0,0 +1,298 @@
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import select, or_, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import RoomEvent
+from .activity import (
+    stance_metric, reactions_given_metric, reactions_received_metric, empty_activity_summary, add_metric,
+    REACTION_TYPES, NON_PARTICIPANT_USERNAMES,
+)
+from .notes import apply_operation, NoteOperationError
+from .proposals import PROPOSAL_FIELDS
+from .transcript import RoomTranscript
+
+# --- ルームの出来事の記録 (room_events) ---
+# 発言・削除・解決は発言と同じトランザクションで、ノート・提案フォーム・リアクションは
+# 書き込みの記録 (utils/writebehind.py) を反映するときにまとめて追記する。
+# 書き込みの記録の行は source_id に Stream のIDを持ち、同じ記録を二度反映しないための目印を兼ねる。
+# 期間を指定した分析と、ある時点のルームの状態 (発言・ノート・提案フォーム・議論ログ) の再現はこの記録から作る。
+# ただし正本ではなく、元の表への書き込みと並べて追記する監査用の記録で、分析画面 (user_activity)・接続時の履歴 (messages)・
+# AIに渡す議論ログ (TranscriptCache) はそれぞれの表から読む。記録を導入する前からあるノートは再現できない。
+
+# 1回の SELECT で読む記録の件数
+EVENT_CHUNK = 1000
+
+
+def event_row(room_id: str, kind: str, username: str = None, message_id: str = None, payload: dict = None,
+              created_at: datetime = None, source_id: str = None) -> dict:
+    """room_events に追記する1行 (まとめて INSERT するため、全ての行で同じ列を持たせる)"""
+    return {
+        "room_id": room_id, "kind": kind, "username": username, "message_id": message_id,
+        "payload": payload or {}, "created_at": created_at or datetime.utcnow(), "source_id": source_id,
+    }
+
+
+def message_event(message) -> dict:
+    """保存した Message の行から発言の記録を作る"""
+    return event_row(message.room_id, "message", message.username, message.message_id, {
+        "content": message.content,
+        "stance": message.stance,
+        "file_url": message.file_url,
+        "original_filename": message.original_filename,
+        "reply_to_id": message.reply_to_id,
+    }, message.created_at)
+
+
+async def append_events(db, rows: list):
+    """記録をまとめて追記する (書き込みの記録を再反映して同じ source_id が来た場合は追記しない)"""
+    if not rows:
+        return
+    stmt = pg_insert(RoomEvent).on_conflict_do_nothing(index_elements=[RoomEvent.source_id])
+    await db.execute(stmt, rows)
+
+
+def _journal_time(entry_id: str) -> datetime:
+    """Redis Stream のID (ミリ秒-連番) から、変更が確定した時刻を得る"""
+    return datetime.utcfromtimestamp(int(entry_id.split("-")[0]) / 1000)
+
+
+def journal_event(entry: dict) -> dict:
+    """書き込みの記録1件を room_events の行にする"""
+    kind = entry["kind"]
+    message_id = None
+    if kind == "note":
+        # {"rev": 確定したリビジョン, "ops": 操作}
+        payload = json.loads(entry["op"]) if entry.get("op") else {}
+    elif kind == "proposal":
+        payload = {
+            "proposal_id": entry.get("proposal_id"), "field": entry.get("field"),
+            "value": entry.get("value"), "version": int(entry.get("version") or 0),
+        }
+    elif kind == "reaction":
+        message_id = entry.get("message_id")
+        payload = {"reaction": entry.get("reaction"), "previous": entry.get("previous"), "author": entry.get("author")}
+    else:
+        payload = {}
+    return event_row(
+        entry["room_id"], kind, entry.get("username"), message_id, payload,
+        _journal_time(entry["entry_id"]), entry["entry_id"],
+    )
+
+
+async def claim_journal_entries(db, entries: list) -> list:
+    """
+    書き込みの記録 (ノート・提案フォーム・リアクション) を room_events にまとめて追記し、
+    今回初めて追記できた (まだ反映していない) 記録だけを返す。
+    他のワーカーが同じ記録を反映中の場合は、一意制約の待ちでそちらのコミットを待ってから除かれる
+    """
+    if not entries:
+        return []
+    stmt = (
+        pg_insert(RoomEvent).values([journal_event(entry) for entry in entries])
+        .on_conflict_do_nothing(index_elements=[RoomEvent.source_id])
+        .returning(RoomEvent.source_id)
+    )
+    inserted = set((await db.execute(stmt)).scalars().all())
+    return [entry for entry in entries if entry["entry_id"] in inserted]
+
+
+async def iter_events(db, room_id: str = None, start: datetime = None, end: datetime = None):
+    """記録を (created_at, id) の順に EVENT_CHUNK 件ずつ読む。期間は [start, end)"""
+    query = select(RoomEvent)
+    if room_id is not None:
+        query = query.filter(RoomEvent.room_id == room_id)
+    if start is not None:
+        query = query.filter(RoomEvent.created_at >= start)
+    if end is not None:
+        query = query.filter(RoomEvent.created_at < end)
+    query = query.order_by(RoomEvent.created_at, RoomEvent.id).limit(EVENT_CHUNK)
+
+    cursor = None
+    while True:
+        page = query
+        if cursor:
+            page = page.filter(or_(
+                RoomEvent.created_at > cursor[0],
+                and_(RoomEvent.created_at == cursor[0], RoomEvent.id > cursor[1])
+            ))
+        events = (await db.execute(page)).scalars().all()
+        for event in events:
+            yield event
+        if len(events) < EVENT_CHUNK:
+            return
+        cursor = (events[-1].created_at, events[-1].id)
+
+
+# --- 投影: 活動カウンタ ---
+
+def event_metrics(event) -> list:
+    """記録1件が表す活動カウンタの増減 (username, metric, amount) のリスト (bump_activity と同じ数え方)"""
+    payload = event.payload or {}
+    username = event.username
+    if event.kind in ("message", "delete"):
+        # AIやシステムの発言は活動カウンタに数えない
+        if username in NON_PARTICIPANT_USERNAMES:
+            return []
+        amount = 1 if event.kind == "message" else -1
+        return [(username, "posts", amount), (username, stance_metric(payload.get("stance")), amount)]
+    if event.kind == "reaction":
+        author = payload.get("author")
+        count_received = author and author not in NON_PARTICIPANT_USERNAMES
+        rows = []
+        for r_type, amount in ((payload.get("previous"), -1), (payload.get("reaction"), 1)):
+            if r_type:
+                rows.append((username, reactions_given_metric(r_type), amount))
+                if count_received:
+                    rows.append((author, reactions_received_metric(r_type), amount))
+        return rows
+    if event.kind == "note":
+        return [(username, "note_edits", 1)]
+    if event.kind == "proposal":
+        return [(username, "proposal_form_edits", 1)]
+    return []
+
+
+async def build_range_analytics(db, start: datetime = None, end: datetime = None, room_id: str = None) -> dict:
+    """
+    期間 [start, end) の分析データを記録から集計する (build_analytics_report と同じ形)。
+    接続回数・ファシリテーター・進捗確認の利用回数は記録に含まれないため数えない。
+    """
+    by_room, by_room_by_user = {}, {}
+    overall = empty_activity_summary()
+    room_participants, all_participants = {}, set()
+    async for event in iter_events(db, room_id=room_id, start=start, end=end):
+        rows = event_metrics(event)
+        if not rows:
+            continue
+        room_summary = by_room.get(event.room_id)
+        if room_summary is None:
+            room_summary = by_room[event.room_id] = empty_activity_summary()
+        users = by_room_by_user.setdefault(event.room_id, {"users": {}})["users"]
+        for username, metric, amount in rows:
+            add_metric(overall, metric, amount)
+            add_metric(room_summary, metric, amount)
+            if username in NON_PARTICIPANT_USERNAMES:
+                continue
+            add_metric(users.setdefault(username, empty_activity_summary()), metric, amount)
+            room_participants.setdefault(event.room_id, set()).add(username)
+            all_participants.add(username)
+
+    for scope, room_summary in by_room.items():
+        room_summary["participants"] = len(room_participants.get(scope, ()))
+    overall["participants"] = len(all_participants)
+    return {
+        "start": start.isoformat() if start else None,
+        "end": end.isoformat() if end else None,
+        "by_room_by_user": by_room_by_user, "by_room": by_room, "overall": overall,
+    }
+
+
+# --- 投影: ある時点のルームの状態 ---
+
+def _replay_note(note_events: list):
+    """ノートの操作をリビジョン順に適用する。最初のリビジョンからの操作が揃っていなければ None"""
+    doc, rev = "", 0
+    for payload in sorted(note_events, key=lambda p: p.get("rev") or 0):
+        if payload.get("rev") != rev + 1:
+            return None, rev
+        try:
+            doc = apply_operation(doc, payload.get("ops") or [])
+        except NoteOperationError:
+            return None, rev
+        rev += 1
+    return doc, rev
+
+
+async def replay_room(db, room_id: str, until: datetime = None) -> dict:
+    """
+    記録を until の直前まで順に適用し、その時点のルームの状態を返す。
+    messages は Message.to_dict と同じ形 (+ reacted_by) で、transcript は AI に渡す議論ログと同じ形式。
+    """
+    messages = OrderedDict()
+    reactions = {}
+    note_events = []
+    proposals = OrderedDict()
+    finished_at = None
+    count = 0
+    async for event in iter_events(db, room_id=room_id, end=until):
+        count += 1
+        payload = event.payload or {}
+        if event.kind == "message":
+            messages[event.message_id] = {
+                "message_id": event.message_id,
+                "username": event.username,
+                "content": payload.get("content"),
+                "stance": payload.get("stance"),
+                "file_url": payload.get("file_url"),
+                "original_filename": payload.get("original_filename"),
+                "gemini_file_ref": None,
+                "reply_to_id": payload.get("reply_to_id"),
+                "created_at": event.created_at.isoformat(),
+                "is_resolved": bool(payload.get("is_resolved")),
+            }
+            # 記録を導入する前の発言は、移行時点のリアクションを持つ
+            users = reactions.setdefault(event.message_id, {})
+            for r_type, usernames in (payload.get("reactions") or {}).items():
+                for username in usernames:
+                    users[username] = r_type
+        elif event.kind == "delete":
+            messages.pop(event.message_id, None)
+        elif event.kind == "resolve":
+            if event.message_id in messages:
+                messages[event.message_id]["is_resolved"] = True
+        elif event.kind == "reaction":
+            users = reactions.setdefault(event.message_id, {})
+            if payload.get("reaction"):
+                users[event.username] = payload["reaction"]
+            else:
+                users.pop(event.username, None)
+        elif event.kind == "note":
+            note_events.append(payload)
+        elif event.kind == "proposal":
+            proposal_id = payload.get("proposal_id")
+            field = payload.get("field")
+            if not proposal_id or field not in PROPOSAL_FIELDS:
+                continue
+            proposal = proposals.setdefault(proposal_id, {"id": proposal_id, "versions": {}})
+            # 同じ項目は最も新しいバージョンの値にする
+            if payload.get("version", 0) >= proposal["versions"].get(field, 0):
+                proposal[field] = payload.get("value") or ""
+                proposal["versions"][field] = payload.get("version", 0)
+        elif event.kind == "finish":
+            finished_at = finished_at or event.created_at
+
+    transcript = RoomTranscript()
+    message_list = []
+    for message in messages.values():
+        reply_to_id = message.pop("reply_to_id")
+        parent = messages.get(reply_to_id) if reply_to_id else None
+        message["reply_to"] = (
+            {"id": parent["message_id"], "username": parent["username"], "content": parent["content"]}
+            if parent else None
+        )
+        # reactions は種類ごとの件数、reacted_by はリアクションした参加者 (種類 -> ユーザー名のリスト)
+        message["reacted_by"] = {r_type: [] for r_type in REACTION_TYPES}
+        for username, r_type in reactions.get(message["message_id"], {}).items():
+            message["reacted_by"].setdefault(r_type, []).append(username)
+        message["reactions"] = {r_type: len(users) for r_type, users in message["reacted_by"].items()}
+        transcript.add(message)
+        message_list.append(message)
+
+    note, note_rev = _replay_note(note_events)
+    return {
+        "room_id": room_id,
+        "until": until.isoformat() if until else None,
+        "event_count": count,
+        "finished_at": finished_at.isoformat() if finished_at else None,
+        "messages": message_list,
+        # 記録を導入する前からあるノートは最初の状態が分からないため再現できない (None)
+        "note": note,
+        "note_revision": note_rev,
+        "proposals": [
+            {"id": p["id"], **{field: p.get(field, "") for field in PROPOSAL_FIELDS}} for p in proposals.values()
+        ],
+        "transcript": transcript.text(),
+    }
@@ -0,0 +1,252 @@
+"""
+議事録 (Excel)・提言案 (Word) の書き出し。
+ジョブのプロセスプールで実行するため、どの関数も ORM オブジェクトではなく
+辞書・リストなどの pickle できる値だけを受け取る。
+"""
+import os
+import uuid
+from io import BytesIO
+
+from docx import Document
+from docx.shared import Pt, Cm, RGBColor
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.table import WD_TABLE_ALIGNMENT
+from docx.oxml.ns import qn
+from docx.oxml import OxmlElement
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, Side, NamedStyle
+
+# 提言案フォームの質問項目 (Word の表に出力する順)
+PROPOSAL_LABELS = {
+    "q1": "【What】 提案内容",
+    "q2": "【Why】 なぜ大切か",
+    "q6": "【How】 実施手法",
+    "q3": "【When】 実施時期",
+    "q4": "【Where】 実施場所",
+    "q5": "【Who】 実施主体・対象",
+    "q7": "思考法"
+}
+PROPOSAL_ORDER = ["q1", "q2", "q6", "q3", "q4", "q5", "q7"]
+
+
+def minutes_rows(messages) -> list:
+    """Message の一覧を、議事録の Excel に書き出す行 (辞書) の一覧に変換する"""
+    return [
+        {
+            "username": msg.username,
+            "stance": msg.stance,
+            "content": msg.content,
+            "reaction_count": (msg.agree_count or 0) + (msg.partial_count or 0) + (msg.disagree_count or 0),
+        }
+        for msg in messages
+    ]
+
+
+def _minutes_styles() -> dict:
+    """議事録で使うセルの書式 (名前付きスタイル)。セルごとに Font などを作らず、ブック内で共有する"""
+    thin_border = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
+    bold_font = Font(bold=True, name="Meiryo UI")
+    normal_font = Font(name="Meiryo UI")
+    return {
+        "minutes_label": NamedStyle(name="minutes_label", font=bold_font),
+        "minutes_meta": NamedStyle(name="minutes_meta", font=normal_font),
+        "minutes_header": NamedStyle(
+            name="minutes_header", font=bold_font, border=thin_border,
+            alignment=Alignment(horizontal="center", vertical="center"),
+        ),
+        # No.・発言者・発言の種類・リアクション数
+        "minutes_center": NamedStyle(
+            name="minutes_center", font=normal_font, border=thin_border,
+            alignment=Alignment(horizontal="center", vertical="top"),
+        ),
+        # 発言内容
+        "minutes_text": NamedStyle(
+            name="minutes_text", font=normal_font, border=thin_border,
+            alignment=Alignment(horizontal="left", vertical="top", wrap_text=True),
+        ),
+    }
+
+
+def create_meeting_minutes_excel(rows, topic, participants, file_path):
+    """
+    議事録の Excel を書き出す。
+    行数が多くてもメモリを使わないよう write-only モードで1行ずつ書き出し、
+    書き終えた一時ファイルを file_path に置き換える (ダウンロード中に書きかけのファイルを返さないため)。
+    """
+    wb = Workbook(write_only=True)
+    styles = _minutes_styles()
+    for style in styles.values():
+        wb.add_named_style(style)
+    ws = wb.create_sheet("議事録")
+
+    # 列幅調整 (write-only モードでは行を書く前に設定する)
+    ws.column_dimensions["A"].width = 6
+    ws.column_dimensions["B"].width = 15
+    ws.column_dimensions["C"].width = 15
+    ws.column_dimensions["D"].width = 60
+    ws.column_dimensions["E"].width = 15
+
+    def cell(value, style):
+        c = WriteOnlyCell(ws, value=value)
+        c.style = style
+        return c
+
+    # ヘッダー情報
+    ws.append([cell("議題", "minutes_label"), cell(topic, "minutes_meta")])
+    ws.append([cell("参加者", "minutes_label"), cell(", ".join(participants) if participants else "なし", "minutes_meta")])
+    ws.append([])
+
+    # テーブルヘッダー
+    headers = ["No.", "発言者", "発言の種類", "発言内容", "リアクション数"]
+    ws.append([cell(header, "minutes_header") for header in headers])
+
+    # データ行
+    for i, row in enumerate(rows, 1):
+        ws.append([
+            cell(i, "minutes_center"),
+            cell(row["username"], "minutes_center"),
+            cell(row["stance"], "minutes_center"),
+            cell(row["content"], "minutes_text"),
+            cell(row["reaction_count"], "minutes_center"),
+        ])
+
+    tmp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        wb.save(tmp_path)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# テンプレートの書式を変えたら上げる (作成済みの Word のキャッシュを使わないようにするため)
+PROPOSALS_TEMPLATE_VERSION = 1
+PROPOSALS_FONT = "Meiryo"
+
+# プロセスごとに1度だけ作るテンプレート (書式設定済みの空の文書)
+_proposals_template = None
+
+
+def _set_style_font(style, font_name):
+    """スタイルのフォントを日本語（東アジア）を含めて設定する (テーマのフォント指定は外す)"""
+    style.font.name = font_name
+    rFonts = style.element.get_or_add_rPr().find(qn('w:rFonts'))
+    if rFonts is None:
+        rFonts = OxmlElement('w:rFonts')
+        style.element.get_or_add_rPr().append(rFonts)
+    for attr in ('w:asciiTheme', 'w:hAnsiTheme', 'w:eastAsiaTheme', 'w:cstheme'):
+        rFonts.attrib.pop(qn(attr), None)
+    rFonts.set(qn('w:eastAsia'), font_name)
+
+
+def _build_proposals_template() -> bytes:
+    """提言案の Word のテンプレート。フォント・色・配置はすべてスタイルで指定し、文書を作るときは文字を入れるだけにする"""
+    doc = Document()
+
+    # 標準スタイルのフォント設定
+    normal = doc.styles['Normal']
+    _set_style_font(normal, PROPOSALS_FONT)
+    normal.font.size = Pt(10.5)
+
+    # タイトル (黒・中央揃え)
+    title = doc.styles['Title']
+    _set_style_font(title, PROPOSALS_FONT)
+    title.font.color.rgb = RGBColor(0, 0, 0)
+    title.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+    _set_style_font(doc.styles['Heading 1'], PROPOSALS_FONT)
+
+    # サブタイトル（議題）
+    topic = doc.styles.add_style('ProposalTopic', WD_STYLE_TYPE.PARAGRAPH)
+    topic.base_style = normal
+    topic.font.size = Pt(14)
+    topic.font.bold = True
+    topic.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+    # 表の項目名
+    label = doc.styles.add_style('ProposalLabel', WD_STYLE_TYPE.CHARACTER)
+    label.font.bold = True
+    label.font.size = Pt(10)
+
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def load_proposals_template() -> bytes:
+    """テンプレートを作って保持する (プロセスプールの各プロセスの起動時に呼ぶ)"""
+    global _proposals_template
+    if _proposals_template is None:
+        _proposals_template = _build_proposals_template()
+    return _proposals_template
+
+
+def build_proposals_docx(topic: str, proposals: list) -> bytes:
+    """提言案の一覧を Word 文書にして、その内容 (bytes) を返す"""
+    # テンプレートを複製して使う
+    doc = Document(BytesIO(load_proposals_template()))
+    # python-docx のスタイル指定は毎回全スタイルを検索するので、スタイルIDを直接設定する
+    heading_style_id = doc.styles["Heading 1"].style_id
+    label_style_id = doc.styles["ProposalLabel"].style_id
+
+    # --- タイトル・サブタイトル（議題） ---
+    doc.add_paragraph("気候市民会議 提言案一覧", style="Title")
+    doc.add_paragraph(f"議題: {topic}", style="ProposalTopic")
+    doc.add_paragraph("") # スペーサー
+
+    # --- 各提案のループ ---
+    for idx, prop in enumerate(proposals, 1):
+        # 提案ヘッダー
+        heading = doc.add_paragraph(f"提案 {idx}")
+        heading._p.get_or_add_pPr().style = heading_style_id
+
+        # テーブル作成 (2列: 項目名, 内容)
+        table = doc.add_table(rows=0, cols=2)
+        table.style = 'Table Grid'
+        table.alignment = WD_TABLE_ALIGNMENT.CENTER
+        table.autofit = False
+        table.allow_autofit = False
+
+        # 各項目の行を追加
+        for key in PROPOSAL_ORDER:
+            cell_label, cell_content = table.add_row().cells
+
+            # ラベル列の設定
+            cell_label.width = Cm(6)
+            run_label = cell_label.paragraphs[0].add_run(PROPOSAL_LABELS[key])
+            run_label._r.get_or_add_rPr().style = label_style_id
+
+            # 内容列の設定
+            content_text = prop.get(key, "")
+
+            # Q7（思考法）の特別な処理
+            if key == "q7":
+                if content_text == "forecast":
+                    content_text = "フォアキャスティング"
+                elif content_text == "backcast":
+                    content_text = "バックキャスティング"
+                else:
+                    content_text = "未選択"
+
+            cell_content.paragraphs[0].add_run(content_text if content_text else "（未記入）")
+
+        doc.add_paragraph("") # 提案間のスペース
+
+        # 最後の提案以外は改ページを入れる
+        if idx < len(proposals):
+            doc.add_page_break()
+
+    # --- ファイル書き出し ---
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def write_proposals_docx(topic: str, proposals: list, file_path: str):
+    """提言案の Word 文書を作成し、書き終えてから file_path に置く (書きかけのファイルを返さないため)"""
+    tmp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(build_proposals_docx(topic, proposals))
+    os.replace(tmp_path, file_path)
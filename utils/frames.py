@@ -0,0 +1,17 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_frame(frame: dict) -> str:
+    """
+    WebSocketに配るフレームをJSON文字列にする。
+    publish 時に1度だけエンコードし、受信側はこの文字列をデコードせずにそのまま送る。
+    orjson があれば使い、なければ標準の json で同じ形式 (非ASCIIはエスケープしない) にする。
+    """
+    if orjson is not None:
+        return orjson.dumps(frame).decode("utf-8")
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
@@ -0,0 +1,175 @@
+import asyncio
+
+
+class RoomSubscriber:
+    """
+    1つのWebSocket接続ぶんの受信口。ハブから届いたフレームを上限付きのキューに溜める。
+    キューが溢れた (送信が追いつかない) 場合は lagging になり、以降のフレームは受け取らない。
+    """
+
+    def __init__(self, room_id: str, maxsize: int):
+        self.room_id = room_id
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.lagging = False
+        self.closed = False
+
+    def deliver(self, frame) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            # 溜まっているフレームは捨て、接続を閉じる合図だけを残す
+            # (クライアントは再接続時に ?after= で取りこぼした分を受け取り直す)
+            self.lagging = True
+            self.close()
+            return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self):
+        """次のフレームを返す。閉じられた場合は None を返す"""
+        return await self.queue.get()
+
+
+class _RoomChannel:
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.subscribers = set()
+        self.pubsub = None
+        self.task = None
+        self.ready = asyncio.Event()
+        self.error = None
+
+
+class RoomHub:
+    """
+    ワーカー内でルームごとに1つだけ Redis の pub/sub を購読し、受け取ったフレームを
+    そのルームに接続している全ソケットのキューに配る。
+    フレームは publish 時にエンコードされた文字列のまま配り、ここではデコードしない。
+    購読は参照カウント方式で、最後の接続が抜けたルームの購読はすぐに解除する。
+    オブザーバー (on_frame / on_room_closed を持つオブジェクト) を登録すると、
+    購読中のルームに届いたフレームをソケットと同じ順番で受け取れる。
+    """
+
+    def __init__(self, queue_size: int = 256):
+        self.redis = None
+        self.queue_size = queue_size
+        self._channels = {}
+        self._observers = []
+        self.lagging_drops = 0
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    def is_live(self, room_id: str) -> bool:
+        """このワーカーがルームを購読中か (フレームを取りこぼさずに受け取れる状態か)"""
+        channel = self._channels.get(room_id)
+        return channel is not None and channel.ready.is_set() and channel.error is None
+
+    @staticmethod
+    def channel_name(room_id: str) -> str:
+        return f"room:{room_id}"
+
+    async def subscribe(self, room_id: str) -> RoomSubscriber:
+        """ルームの購読に参加する。戻った時点で Redis 側の購読は完了している"""
+        channel = self._channels.get(room_id)
+        if channel is None:
+            channel = _RoomChannel(room_id)
+            self._channels[room_id] = channel
+            channel.task = asyncio.create_task(self._room_reader(channel))
+
+        subscriber = RoomSubscriber(room_id, self.queue_size)
+        channel.subscribers.add(subscriber)
+        await channel.ready.wait()
+        if channel.error:
+            channel.subscribers.discard(subscriber)
+            raise channel.error
+        return subscriber
+
+    async def unsubscribe(self, subscriber: RoomSubscriber):
+        subscriber.close()
+        channel = self._channels.get(subscriber.room_id)
+        if channel is None:
+            return
+        channel.subscribers.discard(subscriber)
+        if not channel.subscribers:
+            # 先に辞書から外しておくことで、解除中に来た新しい接続は新しい購読を作る
+            del self._channels[subscriber.room_id]
+            await self._close_channel(channel)
+
+    async def stop(self):
+        channels = list(self._channels.values())
+        self._channels = {}
+        for channel in channels:
+            for subscriber in list(channel.subscribers):
+                subscriber.close()
+            await self._close_channel(channel)
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._channels),
+            "subscribers": sum(len(c.subscribers) for c in self._channels.values()),
+            "lagging_drops": self.lagging_drops,
+        }
+
+    async def _close_channel(self, channel: _RoomChannel):
+        if channel.task:
+            channel.task.cancel()
+            await asyncio.gather(channel.task, return_exceptions=True)
+
+    async def _room_reader(self, channel: _RoomChannel):
+        room_channel = self.channel_name(channel.room_id)
+        pubsub = self.redis.pubsub()
+        channel.pubsub = pubsub
+        try:
+            try:
+                await pubsub.subscribe(room_channel)
+            except Exception as e:
+                channel.error = e
+                raise
+            finally:
+                channel.ready.set()
+
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+                if not message or not message.get("data"):
+                    continue
+                frame = message["data"]
+                for observer in self._observers:
+                    try:
+                        observer.on_frame(channel.room_id, frame)
+                    except Exception as e:
+                        print(f"フレームのオブザーバーでエラーが発生 (Room: {channel.room_id}): {e}")
+                for subscriber in list(channel.subscribers):
+                    if not subscriber.deliver(frame) and subscriber.lagging:
+                        self.lagging_drops += 1
+                        channel.subscribers.discard(subscriber)
+                        print(f"送信が追いつかない接続を切断します (Room: {channel.room_id})")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"ルームの購読でエラーが発生 (Room: {channel.room_id}): {e}")
+        finally:
+            # 購読が切れた場合は接続中のソケットも閉じ、クライアントの再接続に任せる
+            if self._channels.get(channel.room_id) is channel:
+                del self._channels[channel.room_id]
+            for observer in self._observers:
+                observer.on_room_closed(channel.room_id)
+            for subscriber in list(channel.subscribers):
+                subscriber.close()
+            try:
+                await pubsub.unsubscribe(room_channel)
+                await pubsub.close()
+            except Exception:
+                pass
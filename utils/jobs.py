@@ -0,0 +1,352 @@
+import asyncio
+import multiprocessing
+import os
+import socket
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, and_, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import Job
+from .dbmetrics import query_site
+from .frames import encode_frame
+
+
+class BackgroundJobQueue:
+    """
+    Gemini呼び出しなどの重い処理を、DBロックを保持しないままバックグラウンドで実行するジョブキュー。
+    WebSocketのwriterはジョブを投入するだけで、すぐに次のフレームの処理に戻れる。
+    """
+
+    def __init__(self, workers: int = 4, maxsize: int = 100):
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._worker_count = workers
+        self._tasks = []
+
+    def start(self):
+        """ワーカータスクを起動する (アプリケーション起動時に1度だけ呼ぶ)"""
+        for idx in range(self._worker_count):
+            self._tasks.append(asyncio.create_task(self._worker(idx)))
+
+    async def stop(self):
+        """ワーカータスクを停止する"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job_name: str, coro_func, *args, **kwargs) -> bool:
+        """
+        ジョブをキューに投入する。キューが満杯の場合は待たずに False を返す。
+        (呼び出し側を待たせないことが目的なので、ここでブロックしてはいけない)
+        """
+        try:
+            self._queue.put_nowait((job_name, coro_func, args, kwargs))
+            return True
+        except asyncio.QueueFull:
+            print(f"ジョブキューが満杯のため '{job_name}' を受け付けられませんでした。")
+            return False
+
+    async def _worker(self, idx: int):
+        while True:
+            job_name, coro_func, args, kwargs = await self._queue.get()
+            try:
+                with query_site(f"job:{job_name}"):
+                    await coro_func(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"バックグラウンドジョブ '{job_name}' でエラーが発生 (worker {idx}): {e}")
+            finally:
+                self._queue.task_done()
+
+
+class DurableJobQueue:
+    """
+    議事録・Excel・Word などの成果物を作るジョブを DB (jobs テーブル) に記録して実行するジョブキュー。
+    - ジョブは idempotency_key ごとに1つだけ作り、同じキーの投入は既存のジョブを返す (失敗したジョブのみ再投入する)
+    - 各ワーカーは実行待ちのジョブを取り合い、実行中はリース (locked_until) を延長する
+      ワーカーが落ちた・再起動した場合も、リースが切れたジョブは他のワーカーが引き継ぐ
+    - 文書の生成など CPU を使う処理は run_in_process() でプロセスプールに渡し、イベントループを止めない
+    - 状態が変わるたびに job_status フレームをルームに配信する
+    """
+
+    def __init__(self, session_factory, workers: int = 2, processes: int = 2, lease_seconds: float = 60.0,
+                 poll_interval: float = 1.0, max_attempts: int = 3, retry_delay: float = 5.0,
+                 process_initializer=None):
+        self.session_factory = session_factory
+        self.redis = None
+        self.processes = processes
+        self.process_initializer = process_initializer
+        self.lease = timedelta(seconds=lease_seconds)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._worker_count = workers
+        self._handlers = {}
+        self._tasks = []
+        self._running = {}
+        self._pool = None
+        self._wakeup = asyncio.Event()
+        self.counters = {
+            "enqueued": 0, "deduplicated": 0, "requeued": 0, "claimed": 0, "recovered": 0,
+            "done": 0, "retried": 0, "failed": 0, "lease_lost": 0,
+        }
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    def register(self, kind: str, handler):
+        """ジョブ種別ごとの処理 (async def handler(job: dict) -> 結果の dict) を登録する"""
+        self._handlers[kind] = handler
+
+    def start(self):
+        """プロセスプールとワーカータスクを起動する (アプリケーション起動時に1度だけ呼ぶ)"""
+        if self.processes > 0:
+            # スレッドを持つプロセスから fork すると子プロセスがロックを抱えたまま止まることがあるため spawn を使う
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                initializer=self.process_initializer,
+            )
+        for idx in range(self._worker_count):
+            self._tasks.append(asyncio.create_task(self._worker(idx)))
+
+    async def stop(self):
+        """ワーカーを停止し、実行途中のジョブを他のワーカー (再起動後を含む) がすぐに引き継げるよう戻す"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._running:
+            try:
+                async with self.session_factory() as db:
+                    await db.execute(
+                        update(Job)
+                        .where(Job.job_id.in_(list(self._running)), Job.locked_by == self.worker_id, Job.status == "running")
+                        .values(status="queued", attempts=Job.attempts - 1, locked_by=None, locked_until=None)
+                    )
+                    await db.commit()
+            except Exception as e:
+                print(f"実行途中のジョブを戻せませんでした: {e}")
+            self._running = {}
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def enqueue(self, db, kind: str, room_id: str, idempotency_key: str, payload: dict = None) -> dict:
+        """
+        呼び出し元のトランザクション内でジョブを登録する (コミットされるまで実行されない)。
+        同じキーのジョブがあればそれを返し、失敗していた場合だけ実行待ちに戻す。
+        コミット後に wake() と publish_status() を呼ぶ。戻り値の "created" は新しく実行待ちになったかどうか。
+        """
+        job_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        await db.execute(
+            pg_insert(Job)
+            .values(
+                job_id=job_id, kind=kind, room_id=room_id, idempotency_key=idempotency_key,
+                status="queued", payload=payload or {}, attempts=0, created_at=now, updated_at=now,
+            )
+            .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        )
+        result = await db.execute(select(Job).filter_by(idempotency_key=idempotency_key))
+        job = result.scalars().first()
+
+        if job.job_id == job_id:
+            self.counters["enqueued"] += 1
+            return {**job.to_dict(), "created": True}
+        if job.status == "failed":
+            job.status = "queued"
+            job.payload = payload or {}
+            job.attempts = 0
+            job.error = None
+            job.locked_by = None
+            job.locked_until = None
+            self.counters["requeued"] += 1
+            return {**job.to_dict(), "created": True}
+        self.counters["deduplicated"] += 1
+        return {**job.to_dict(), "created": False}
+
+    async def submit(self, kind: str, room_id: str, idempotency_key: str, payload: dict = None) -> dict:
+        """ジョブを登録してコミットし、ワーカーを起こす"""
+        async with self.session_factory() as db:
+            async with db.begin():
+                job = await self.enqueue(db, kind, room_id, idempotency_key, payload)
+        if job["created"]:
+            self.wake()
+            await self.publish_status(job)
+        return job
+
+    def wake(self):
+        """実行待ちのジョブが増えたことをこのワーカーに知らせる (他のワーカーは poll_interval ごとに確認する)"""
+        self._wakeup.set()
+
+    async def get(self, job_id: str):
+        async with self.session_factory() as db:
+            job = await db.get(Job, job_id)
+            return job.to_dict() if job else None
+
+    async def wait(self, job_id: str, timeout: float):
+        """ジョブが終わる (done / failed) まで待って、その状態を返す。timeout 秒で打ち切り、その時点の状態を返す"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            job = await self.get(job_id)
+            if job is None or job["status"] in ("done", "failed"):
+                return job
+            if asyncio.get_running_loop().time() >= deadline:
+                return job
+            await asyncio.sleep(min(self.poll_interval, 0.25))
+
+    async def run_in_process(self, func, *args):
+        """CPU を使う処理をプロセスプールで実行する (func と引数は pickle できること)"""
+        if self._pool is None:
+            return await asyncio.to_thread(func, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+
+    async def publish_status(self, job: dict):
+        if not self.redis or not job.get("room_id"):
+            return
+        frame = {
+            "type": "job_status",
+            "job_id": job["job_id"],
+            "kind": job["kind"],
+            "status": job["status"],
+            "attempts": job.get("attempts", 0),
+        }
+        if job["status"] == "done":
+            frame["result"] = job.get("result")
+        elif job.get("error"):
+            frame["error"] = job["error"]
+        try:
+            await self.redis.publish(f"room:{job['room_id']}", encode_frame(frame))
+        except Exception as e:
+            print(f"ジョブの状態を配信できませんでした ({job['job_id']}): {e}")
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "running": len(self._running),
+            "workers": self._worker_count,
+            "processes": self.processes,
+        }
+
+    async def _worker(self, idx: int):
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ジョブの取得に失敗しました (worker {idx}): {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(job)
+
+    async def _claim(self):
+        """実行待ち、またはリースが切れたジョブを1つ取り出して自分のものにする"""
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(Job.job_id, Job.status, Job.attempts)
+                .where(or_(
+                    and_(Job.status == "queued", or_(Job.locked_until.is_(None), Job.locked_until <= now)),
+                    and_(Job.status == "running", Job.locked_until < now),
+                ))
+                .order_by(Job.created_at)
+                .limit(self._worker_count)
+            )
+            for job_id, status, attempts in result.all():
+                # 実行回数を比較条件にして更新することで、他のワーカーと同じジョブを取り合わないようにする
+                values = {"status": "running", "attempts": attempts + 1, "locked_by": self.worker_id,
+                          "locked_until": now + self.lease, "updated_at": now}
+                if status == "running" and attempts >= self.max_attempts:
+                    # 実行中のワーカーが落ちるのを繰り返したジョブは諦める
+                    values = {"status": "failed", "error": "ジョブの実行中にワーカーが停止しました。",
+                              "locked_by": None, "locked_until": None, "updated_at": now}
+                claimed = await db.execute(
+                    update(Job)
+                    .where(Job.job_id == job_id, Job.status == status, Job.attempts == attempts)
+                    .values(**values)
+                )
+                await db.commit()
+                if claimed.rowcount != 1:
+                    continue
+                job_obj = (await db.execute(
+                    select(Job).filter_by(job_id=job_id).execution_options(populate_existing=True)
+                )).scalars().first()
+                job = {**job_obj.to_dict(), "payload": job_obj.payload or {}}
+                if values["status"] == "failed":
+                    self.counters["failed"] += 1
+                    await self.publish_status(job)
+                    continue
+                self.counters["claimed"] += 1
+                if status == "running":
+                    self.counters["recovered"] += 1
+                    print(f"リースの切れたジョブを引き継ぎます: {job['kind']} ({job_id})")
+                return job
+        return None
+
+    async def _execute(self, job: dict):
+        job_id = job["job_id"]
+        self._running[job_id] = job["kind"]
+        await self.publish_status(job)
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            handler = self._handlers.get(job["kind"])
+            if handler is None:
+                raise RuntimeError(f"未登録のジョブ種別です: {job['kind']}")
+            with query_site(f"artifact:{job['kind']}"):
+                result = await handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"ジョブ '{job['kind']}' ({job_id}) でエラーが発生しました ({job['attempts']}回目): {e}")
+            await self._finish(job, "failed" if job["attempts"] >= self.max_attempts else "queued", error=str(e))
+        else:
+            await self._finish(job, "done", result=result or {})
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+
+    async def _finish(self, job: dict, status: str, result: dict = None, error: str = None):
+        values = {"status": status, "result": result, "error": error, "locked_by": None, "locked_until": None}
+        if status == "queued":
+            # 再実行までは少し間を空ける (回数が増えるほど長くする)
+            values["locked_until"] = datetime.utcnow() + timedelta(seconds=self.retry_delay * job["attempts"])
+        async with self.session_factory() as db:
+            updated = await db.execute(
+                update(Job).where(Job.job_id == job["job_id"], Job.locked_by == self.worker_id).values(**values)
+            )
+            await db.commit()
+        if updated.rowcount != 1:
+            # リースが切れて他のワーカーが引き継いだ場合は、そちらの結果を正とする
+            self.counters["lease_lost"] += 1
+            print(f"ジョブ ({job['job_id']}) のリースが切れていたため、結果を保存しませんでした。")
+            return
+        self.counters["retried" if status == "queued" else status] += 1
+        await self.publish_status({**job, "status": "retrying" if status == "queued" else status,
+                                   "result": result, "error": error})
+
+    async def _heartbeat(self, job_id: str):
+        interval = self.lease.total_seconds() / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with self.session_factory() as db:
+                    await db.execute(
+                        update(Job)
+                        .where(Job.job_id == job_id, Job.locked_by == self.worker_id)
+                        .values(locked_until=datetime.utcnow() + self.lease)
+                    )
+                    await db.commit()
+            except Exception as e:
+                print(f"ジョブ ({job_id}) のリースを延長できませんでした: {e}")
@@ -0,0 +1,210 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import nullcontext
+
+
+class LLMCancelledError(Exception):
+    """呼び出し元 (WebSocket接続など) が切断されたため、生成を取り消した場合の例外"""
+
+
+class LLMTimeoutError(Exception):
+    """モデルの応答が制限時間内に返らなかった場合の例外"""
+
+
+class StreamedResponse:
+    """ストリーミングで受け取った応答をまとめたもの (generate の応答と同じく text / usage_metadata を持つ)"""
+
+    def __init__(self):
+        self.text = ""
+        self.usage_metadata = None
+
+
+class LLMGateway:
+    """
+    Gemini への問い合わせをまとめて管理するゲートウェイ。
+    - SDK の非同期API (client.aio) を使い、スレッドを消費せずに待つ
+    - 全体とルームごとの同時実行数を制限する (ルームの枠 → 全体の枠の順に取得)
+    - 呼び出しごとにタイムアウトを設け、owner 単位 (接続ID) でまとめて取り消せる
+    - 呼び出しごとの待ち時間・モデルの応答時間・トークン数 (ストリーミングでは最初の応答までの時間も) を記録する
+    """
+
+    def __init__(self, client_getter, max_concurrency: int = 8, per_room_concurrency: int = 2,
+                 timeout: float = 180.0, recent_size: int = 200):
+        self._client_getter = client_getter
+        self.timeout = timeout
+        self.per_room_concurrency = per_room_concurrency
+        self._global_slots = asyncio.Semaphore(max_concurrency)
+        self._room_slots = {}
+        self._owners = {}
+        self._cancelled_by_owner = set()
+        self.in_flight = 0
+        self.waiting = 0
+        self.recent_calls = deque(maxlen=recent_size)
+        self.totals = {}
+
+    @property
+    def client(self):
+        return self._client_getter()
+
+    async def generate(self, model: str, contents, room_id: str = None, owner: str = None,
+                       purpose: str = "generate", timeout: float = None):
+        """モデルに問い合わせ、応答オブジェクトを返す"""
+        return await self._submit(self._run(model, contents, room_id, purpose, timeout or self.timeout), owner, purpose)
+
+    async def generate_stream(self, model: str, contents, on_text, room_id: str = None, owner: str = None,
+                              purpose: str = "generate", timeout: float = None) -> str:
+        """
+        ストリーミングで問い合わせ、テキストの断片を受け取るたびに on_text(断片) を待つ。
+        戻り値は応答全体のテキスト。
+        """
+        return (await self._submit(
+            self._run(model, contents, room_id, purpose, timeout or self.timeout, on_text=on_text), owner, purpose
+        )).text
+
+    async def _submit(self, coro, owner: str, purpose: str):
+        task = asyncio.create_task(coro)
+        if owner:
+            self._owners.setdefault(owner, set()).add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task in self._cancelled_by_owner:
+                raise LLMCancelledError(f"{purpose} の生成は呼び出し元の切断により取り消されました。")
+            task.cancel()
+            raise
+        finally:
+            self._cancelled_by_owner.discard(task)
+            if owner:
+                tasks = self._owners.get(owner)
+                if tasks is not None:
+                    tasks.discard(task)
+                    if not tasks:
+                        del self._owners[owner]
+
+    def cancel_owner(self, owner: str) -> int:
+        """owner が依頼した実行中・待機中の呼び出しをすべて取り消す"""
+        tasks = self._owners.pop(owner, set())
+        for task in tasks:
+            if not task.done():
+                self._cancelled_by_owner.add(task)
+                task.cancel()
+        return len(tasks)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "by_purpose": self.totals,
+            "recent": list(self.recent_calls)[-20:],
+        }
+
+    async def _run(self, model: str, contents, room_id: str, purpose: str, timeout: float, on_text=None):
+        record = {"purpose": purpose, "room_id": room_id, "model": model, "status": "ok",
+                  "queue_ms": 0.0, "model_ms": 0.0, "ttft_ms": None, "prompt_tokens": 0, "output_tokens": 0}
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        waiting = True
+        room_slot = self._acquire_room_slot(room_id)
+        try:
+            async with room_slot[0] if room_slot else nullcontext():
+                async with self._global_slots:
+                    self.waiting -= 1
+                    waiting = False
+                    started_at = time.perf_counter()
+                    record["queue_ms"] = round((started_at - queued_at) * 1000, 1)
+                    self.in_flight += 1
+                    try:
+                        if on_text:
+                            call = self._stream(model, contents, on_text, record, started_at)
+                        else:
+                            call = self.client.aio.models.generate_content(model=model, contents=contents)
+                        response = await asyncio.wait_for(call, timeout=timeout)
+                    except asyncio.TimeoutError:
+                        record["status"] = "timeout"
+                        raise LLMTimeoutError(f"{purpose} の応答が {timeout} 秒以内に返りませんでした。")
+                    finally:
+                        self.in_flight -= 1
+                        record["model_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+
+            usage = getattr(response, "usage_metadata", None)
+            if usage:
+                record["prompt_tokens"] = usage.prompt_token_count or 0
+                record["output_tokens"] = usage.candidates_token_count or 0
+            return response
+        except asyncio.CancelledError:
+            record["status"] = "cancelled"
+            raise
+        except LLMTimeoutError:
+            raise
+        except Exception:
+            record["status"] = "error"
+            raise
+        finally:
+            if waiting:
+                self.waiting -= 1
+            self._release_room_slot(room_id, room_slot)
+            self._record(record)
+
+    async def _stream(self, model: str, contents, on_text, record: dict, started_at: float) -> StreamedResponse:
+        result = StreamedResponse()
+        parts = []
+        stream = await self.client.aio.models.generate_content_stream(model=model, contents=contents)
+        async for chunk in stream:
+            if chunk.usage_metadata:
+                result.usage_metadata = chunk.usage_metadata
+            text = chunk.text
+            if not text:
+                continue
+            if not parts:
+                record["ttft_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+            parts.append(text)
+            await on_text(text)
+        result.text = "".join(parts)
+        return result
+
+    def _acquire_room_slot(self, room_id: str):
+        if not room_id:
+            return None
+        slot = self._room_slots.get(room_id)
+        if slot is None:
+            slot = [asyncio.Semaphore(self.per_room_concurrency), 0]
+            self._room_slots[room_id] = slot
+        slot[1] += 1
+        return slot
+
+    def _release_room_slot(self, room_id: str, slot):
+        if slot is None:
+            return
+        slot[1] -= 1
+        if slot[1] == 0 and self._room_slots.get(room_id) is slot:
+            del self._room_slots[room_id]
+
+    def _record(self, record: dict):
+        self.recent_calls.append(record)
+        totals = self.totals.setdefault(record["purpose"], {
+            "calls": 0, "errors": 0, "timeouts": 0, "cancelled": 0,
+            "queue_ms": 0.0, "model_ms": 0.0, "prompt_tokens": 0, "output_tokens": 0,
+            "streamed": 0, "ttft_ms": 0.0,
+        })
+        totals["calls"] += 1
+        if record["status"] == "error":
+            totals["errors"] += 1
+        elif record["status"] == "timeout":
+            totals["timeouts"] += 1
+        elif record["status"] == "cancelled":
+            totals["cancelled"] += 1
+        for key in ("queue_ms", "model_ms", "prompt_tokens", "output_tokens"):
+            totals[key] = round(totals[key] + record[key], 1)
+        ttft_info = ""
+        if record["ttft_ms"] is not None:
+            # 平均は ttft_ms / streamed で求める
+            totals["streamed"] += 1
+            totals["ttft_ms"] = round(totals["ttft_ms"] + record["ttft_ms"], 1)
+            ttft_info = f" ttft={record['ttft_ms']}ms"
+        print(
+            f"LLM {record['purpose']} ({record['status']}) room={record['room_id']} "
+            f"queue={record['queue_ms']}ms model={record['model_ms']}ms{ttft_info} "
+            f"tokens={record['prompt_tokens']}+{record['output_tokens']}"
+        )
+
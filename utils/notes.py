@@ -0,0 +1,368 @@
+import json
+from collections import Counter
+
+from sqlalchemy import select, update
+
+from models import Room
+from .activity import bump_activity
+
+# --- テキスト操作 (OT) ---
+# 操作は要素のリストで、正の整数は「その文字数だけそのまま残す」、負の整数は「その文字数を削除」、
+# 文字列は「その位置に挿入」を表す。要素を順にたどると操作前の文書全体をちょうど1回なめる。
+# 位置・長さはブラウザの文字列と同じ UTF-16 のコード単位で数える (絵文字などは2文字になる)。
+
+
+class NoteOperationError(ValueError):
+    """操作が文書の長さと合わない・形式が不正な場合の例外"""
+
+
+def text_units(text: str) -> int:
+    """UTF-16 のコード単位での長さ"""
+    return len(text.encode("utf-16-le", "surrogatepass")) // 2
+
+
+def _push(ops: list, component):
+    """操作に要素を追加する (同じ種類の要素はまとめ、挿入は削除より前に置く)"""
+    if component == 0 or component == "":
+        return
+    if not ops:
+        ops.append(component)
+        return
+    last = ops[-1]
+    if isinstance(component, str):
+        if isinstance(last, str):
+            ops[-1] = last + component
+        elif last < 0:
+            # 削除と挿入が並ぶ場合は挿入を先にして、同じ操作の表現を1通りにする
+            if len(ops) >= 2 and isinstance(ops[-2], str):
+                ops[-2] = ops[-2] + component
+            else:
+                ops.insert(len(ops) - 1, component)
+        else:
+            ops.append(component)
+    elif component > 0 and isinstance(last, int) and last > 0:
+        ops[-1] = last + component
+    elif component < 0 and isinstance(last, int) and last < 0:
+        ops[-1] = last + component
+    else:
+        ops.append(component)
+
+
+def normalize(ops) -> list:
+    """受け取った操作を検査して正規化する"""
+    if not isinstance(ops, list):
+        raise NoteOperationError("操作はリストで指定してください。")
+    normalized = []
+    for component in ops:
+        if isinstance(component, bool) or not isinstance(component, (int, str)):
+            raise NoteOperationError(f"不正な操作の要素です: {component!r}")
+        _push(normalized, component)
+    return normalized
+
+
+def base_length(ops: list) -> int:
+    return sum(abs(c) for c in ops if isinstance(c, int))
+
+
+def apply_operation(text: str, ops: list) -> str:
+    """文書に操作を適用した結果を返す"""
+    if base_length(ops) != text_units(text):
+        raise NoteOperationError("操作の長さが文書と一致しません。")
+    units = text.encode("utf-16-le", "surrogatepass")
+    parts = []
+    index = 0
+    for component in ops:
+        if isinstance(component, str):
+            parts.append(component.encode("utf-16-le", "surrogatepass"))
+        elif component > 0:
+            parts.append(units[index * 2:(index + component) * 2])
+            index += component
+        else:
+            index -= component
+    result = b"".join(parts).decode("utf-16-le", "surrogatepass")
+    try:
+        # サロゲートペアの途中で分けるような操作は受け付けない
+        result.encode("utf-8")
+    except UnicodeEncodeError:
+        raise NoteOperationError("文字の途中を編集する操作です。")
+    return result
+
+
+def _is_high_surrogate(units: bytes, index: int) -> bool:
+    return 0xD800 <= int.from_bytes(units[index * 2:index * 2 + 2], "little") <= 0xDBFF
+
+
+def transform(a: list, b: list):
+    """
+    同じ文書に対する2つの操作 a, b を、互いの後に適用できる形 (a', b') に変換する。
+    apply(apply(doc, a), b') == apply(apply(doc, b), a') になる。同じ位置への挿入は a を先にする。
+    """
+    if base_length(a) != base_length(b):
+        raise NoteOperationError("同じ文書に対する操作ではありません。")
+    a_prime, b_prime = [], []
+    ia, ib = iter(a), iter(b)
+    oa, ob = next(ia, None), next(ib, None)
+    while oa is not None or ob is not None:
+        if isinstance(oa, str):
+            _push(a_prime, oa)
+            _push(b_prime, text_units(oa))
+            oa = next(ia, None)
+            continue
+        if isinstance(ob, str):
+            _push(a_prime, text_units(ob))
+            _push(b_prime, ob)
+            ob = next(ib, None)
+            continue
+        if oa is None or ob is None:
+            raise NoteOperationError("操作の長さが一致しません。")
+
+        if oa > 0 and ob > 0:
+            length = min(oa, ob)
+            _push(a_prime, length)
+            _push(b_prime, length)
+        elif oa < 0 and ob < 0:
+            # 両方が削除した範囲は、どちらの変換後の操作にも含めない
+            length = min(-oa, -ob)
+        elif oa < 0:
+            length = min(-oa, ob)
+            _push(a_prime, -length)
+        else:
+            length = min(oa, -ob)
+            _push(b_prime, -length)
+
+        # 消費した分だけ残りを減らす (使い切った要素は次へ進む)
+        oa = (oa - length if oa > 0 else oa + length) or next(ia, None)
+        ob = (ob - length if ob > 0 else ob + length) or next(ib, None)
+    return a_prime, b_prime
+
+
+def diff_operation(old: str, new: str) -> list:
+    """2つの文書の先頭・末尾の共通部分を除いた差分を、1つの操作として返す"""
+    old_units = old.encode("utf-16-le", "surrogatepass")
+    new_units = new.encode("utf-16-le", "surrogatepass")
+    old_len, new_len = len(old_units) // 2, len(new_units) // 2
+    prefix = 0
+    while prefix < min(old_len, new_len) and old_units[prefix * 2:prefix * 2 + 2] == new_units[prefix * 2:prefix * 2 + 2]:
+        prefix += 1
+    suffix = 0
+    while (suffix < min(old_len, new_len) - prefix
+           and old_units[(old_len - suffix - 1) * 2:(old_len - suffix) * 2]
+           == new_units[(new_len - suffix - 1) * 2:(new_len - suffix) * 2]):
+        suffix += 1
+    # サロゲートペア (絵文字など) の途中で区切らない
+    if prefix and _is_high_surrogate(old_units, prefix - 1):
+        prefix -= 1
+    if suffix and _is_high_surrogate(old_units, old_len - suffix - 1):
+        suffix -= 1
+    ops = []
+    _push(ops, prefix)
+    _push(ops, new_units[prefix * 2:(new_len - suffix) * 2].decode("utf-16-le", "surrogatepass"))
+    _push(ops, -(old_len - prefix - suffix))
+    _push(ops, suffix)
+    return ops
+
+
+# --- 共有ノートの正本 (Redis) ---
+
+# まだ Redis に文書がなければ、DB から読んだ内容で初期化する
+_LOAD_SCRIPT = """
+if redis.call("exists", KEYS[2]) == 0 then
+    redis.call("set", KEYS[1], ARGV[1], "EX", ARGV[3])
+    redis.call("set", KEYS[2], ARGV[2], "EX", ARGV[3])
+    redis.call("del", KEYS[3])
+end
+return {redis.call("get", KEYS[1]), redis.call("get", KEYS[2])}
+"""
+
+# 読み込んだ時点からリビジョンが進んでいなければ、新しい文書と操作を保存してリビジョンを1つ進める
+# (DBへの保存用に、同じスクリプトの中で書き込みの記録 (WriteBehindJournal) に操作ごと追記する)
+_COMMIT_SCRIPT = """
+local current = tonumber(redis.call("get", KEYS[2]) or "-1")
+if current ~= tonumber(ARGV[1]) then
+    return -1
+end
+redis.call("set", KEYS[1], ARGV[2], "EX", ARGV[5])
+local rev = redis.call("incr", KEYS[2])
+redis.call("expire", KEYS[2], ARGV[5])
+redis.call("rpush", KEYS[3], ARGV[3])
+redis.call("ltrim", KEYS[3], -tonumber(ARGV[4]), -1)
+redis.call("expire", KEYS[3], ARGV[5])
+redis.call("xadd", KEYS[4], "*", "kind", "note", "room_id", ARGV[6], "username", ARGV[7], "op", ARGV[3])
+return rev
+"""
+
+
+class NoteResyncRequired(Exception):
+    """クライアントの文書が古すぎる・不正なため、全文を送り直す必要がある場合の例外"""
+
+
+class NoteClosedError(Exception):
+    """議論が終了したルームのノートは編集できない"""
+
+
+class SharedNoteStore:
+    """
+    共有ノートを操作 (OT) 単位で同期する。
+    - 正本 (文書・リビジョン・直近の操作の履歴) は Redis に置き、全ワーカーで共有する
+    - クライアントは「リビジョン r の文書に対する操作」を送る。r より後に確定した操作があれば、それに合わせて変換してから適用する
+    - 確定した操作は (リビジョン, 操作, 送信元) としてルームに配信し、全文は配信しない
+    - Postgres (Room.shared_note) には、書き込みの記録 (utils/writebehind.py) を反映するときに
+      変更のあったルームごとに最新の文書を1回だけ保存する (ノートの編集回数の活動カウンタもまとめて加算する)
+    """
+
+    def __init__(self, session_factory, journal, history_size: int = 500,
+                 ttl: int = 7 * 24 * 3600, retries: int = 10):
+        self.session_factory = session_factory
+        self.journal = journal
+        self.redis = None
+        self.history_size = history_size
+        self.ttl = ttl
+        self.retries = retries
+        self.counters = {
+            "applied": 0, "transformed": 0, "conflicts": 0, "resyncs": 0, "rejected": 0,
+            "snapshots": 0,
+        }
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def _keys(room_id: str):
+        return (f"note:{room_id}:doc", f"note:{room_id}:rev", f"note:{room_id}:ops")
+
+    @staticmethod
+    def _closed_key(room_id: str) -> str:
+        return f"note:{room_id}:closed"
+
+    async def load(self, room_id: str):
+        """(文書, リビジョン) を返す。Redis になければ DB の内容で初期化する。ルームがなければ None"""
+        doc_key, rev_key, ops_key = self._keys(room_id)
+        state = await self.redis.mget(doc_key, rev_key)
+        if state[1] is not None:
+            return state[0] or "", int(state[1])
+
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(Room.shared_note, Room.note_revision, Room.status).filter_by(room_id=room_id)
+            )
+            row = result.first()
+        if row is None:
+            return None
+        if row.status == "終了":
+            await self.redis.set(self._closed_key(room_id), "1", ex=self.ttl)
+        doc, rev = await self.redis.eval(
+            _LOAD_SCRIPT, 3, doc_key, rev_key, ops_key, row.shared_note or "", row.note_revision or 0, self.ttl
+        )
+        return doc or "", int(rev)
+
+    async def text(self, room_id: str, fallback: str = "") -> str:
+        """AIなどに渡す最新のノートの内容 (Redis に正本がなければ DB の値 fallback を使う)"""
+        if not self.redis:
+            return fallback or ""
+        doc = await self.redis.get(self._keys(room_id)[0])
+        return (fallback or "") if doc is None else doc
+
+    async def close(self, room_id: str):
+        """議論の終了後はノートを編集できないようにする"""
+        if self.redis:
+            await self.redis.set(self._closed_key(room_id), "1", ex=self.ttl)
+
+    async def apply(self, room_id: str, base_rev: int, ops, username: str, client_id: str) -> dict:
+        """
+        リビジョン base_rev の文書に対する操作を確定させ、配信するフレームを返す。
+        他の操作と競合した場合は、確定済みの操作に合わせて変換し直して再試行する。
+        """
+        if await self.redis.exists(self._closed_key(room_id)):
+            raise NoteClosedError(room_id)
+        try:
+            ops = normalize(ops)
+            base_rev = int(base_rev)
+        except (NoteOperationError, TypeError, ValueError):
+            self.counters["rejected"] += 1
+            raise NoteResyncRequired(room_id)
+
+        doc_key, rev_key, ops_key = self._keys(room_id)
+        for _ in range(self.retries):
+            state = await self.load(room_id)
+            if state is None:
+                raise NoteResyncRequired(room_id)
+            doc, rev = state
+            transformed = ops
+            if base_rev > rev:
+                self.counters["resyncs"] += 1
+                raise NoteResyncRequired(room_id)
+            if base_rev < rev:
+                # クライアントがまだ受け取っていない確定済みの操作に合わせて変換する (確定済みの挿入を先にする)
+                history = await self.redis.lrange(ops_key, -(rev - base_rev), -1)
+                entries = [json.loads(item) for item in history]
+                if len(entries) < rev - base_rev or entries[0]["rev"] != base_rev + 1:
+                    # 履歴が残っていないほど古いリビジョンからの操作
+                    self.counters["resyncs"] += 1
+                    raise NoteResyncRequired(room_id)
+                try:
+                    for entry in entries:
+                        _, transformed = transform(entry["ops"], transformed)
+                except NoteOperationError:
+                    self.counters["rejected"] += 1
+                    raise NoteResyncRequired(room_id)
+            try:
+                new_doc = apply_operation(doc, transformed)
+            except NoteOperationError:
+                self.counters["rejected"] += 1
+                raise NoteResyncRequired(room_id)
+
+            entry = json.dumps({"rev": rev + 1, "ops": transformed}, ensure_ascii=False)
+            committed = await self.redis.eval(
+                _COMMIT_SCRIPT, 4, doc_key, rev_key, ops_key, self.journal.stream_key,
+                rev, new_doc, entry, self.history_size, self.ttl, room_id, username
+            )
+            if committed == -1:
+                # 読み込んでから確定するまでに他の操作が確定した
+                self.counters["conflicts"] += 1
+                continue
+            self.counters["applied"] += 1
+            if base_rev < rev:
+                self.counters["transformed"] += 1
+            return {"type": "note_op", "rev": int(committed), "ops": transformed, "client_id": client_id, "sender": username}
+        raise NoteResyncRequired(room_id)
+
+    async def replace(self, room_id: str, content: str, username: str, client_id: str = None) -> dict:
+        """全文を受け取った場合 (旧形式のクライアント) は、最新の文書との差分の操作として適用する"""
+        for _ in range(self.retries):
+            state = await self.load(room_id)
+            if state is None:
+                return None
+            doc, rev = state
+            if doc == content:
+                return None
+            try:
+                return await self.apply(room_id, rev, diff_operation(doc, content), username, client_id)
+            except NoteResyncRequired:
+                continue
+        return None
+
+    async def persist(self, db, entries: list):
+        """書き込みの記録をDBに反映する (ルームごとに Redis の最新の文書を1回だけ保存し、編集回数を加算する)"""
+        edits = {}
+        for entry in entries:
+            edits.setdefault(entry["room_id"], Counter())[entry["username"]] += 1
+        for room_id, counts in edits.items():
+            doc_key, rev_key, _ = self._keys(room_id)
+            doc, rev = await self.redis.mget(doc_key, rev_key)
+            if rev is not None:
+                # 他のワーカーが先に新しいリビジョンを保存していた場合は上書きしない
+                await db.execute(
+                    update(Room.__table__)
+                    .where(Room.room_id == room_id, Room.note_revision < int(rev))
+                    .values(shared_note=doc or "", note_revision=int(rev))
+                )
+            await bump_activity(db, room_id, [(username, "note_edits", n) for username, n in counts.items()])
+            self.counters["snapshots"] += 1
+
+    async def forget(self, room_id: str):
+        """ルームの削除時に Redis 上のノートを消す"""
+        if self.redis:
+            await self.redis.delete(*self._keys(room_id), self._closed_key(room_id))
+
+    def stats(self) -> dict:
+        return dict(self.counters)
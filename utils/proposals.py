@@ -0,0 +1,300 @@
+import re
+import uuid
+from collections import Counter
+
+from sqlalchemy import select, update
+
+from models import Room
+from .activity import bump_activity
+
+# 5W1H 提案フォームの項目
+PROPOSAL_FIELDS = ("q1", "q2", "q3", "q4", "q5", "q6", "q7")
+MAX_PROPOSALS = 100
+MAX_FIELD_LENGTH = 10000
+# 提案のID (Redis のハッシュのフィールド名と、カンマ区切りの並び順に使うため英数字のみ)
+PROPOSAL_ID_PATTERN = re.compile(r"^[0-9A-Za-z_-]{1,40}$")
+
+# --- 提案フォームの正本 (Redis) ---
+# ルームごとに1つのハッシュに、並び順 ("order": カンマ区切りのID)・全体のリビジョン ("rev")・
+# 項目の値 ("f:<ID>:<項目>")・項目ごとのバージョン ("v:<ID>:<項目>") を置く。
+# HGETALL 1回で全項目が揃った一貫した状態を読める。
+
+# まだ Redis になければ、DB から読んだ内容で初期化する
+_LOAD_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 0 then
+    redis.call("hset", KEYS[1], unpack(ARGV, 2))
+    redis.call("expire", KEYS[1], ARGV[1])
+end
+return redis.call("hgetall", KEYS[1])
+"""
+
+# 項目のバージョンがクライアントの知っている値のままなら書き換え、バージョンを1つ進める。
+# 知らない提案IDなら末尾に追加する (提案は追加のみで、一度決まった位置は変わらない)。
+# DBへの保存用に、同じスクリプトの中で書き込みの記録 (WriteBehindJournal) に追記する
+_PATCH_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return {-1}
+end
+local order = redis.call("hget", KEYS[1], "order") or ""
+local index = 0
+local found = false
+for id in string.gmatch(order, "[^,]+") do
+    if id == ARGV[1] then
+        found = true
+        break
+    end
+    index = index + 1
+end
+local value_key = "f:" .. ARGV[1] .. ":" .. ARGV[2]
+local version_key = "v:" .. ARGV[1] .. ":" .. ARGV[2]
+local version = tonumber(redis.call("hget", KEYS[1], version_key) or "0")
+if version ~= tonumber(ARGV[4]) then
+    return {0, version, index, redis.call("hget", KEYS[1], value_key) or ""}
+end
+if not found then
+    if index >= tonumber(ARGV[8]) then
+        return {-2}
+    end
+    if order == "" then
+        order = ARGV[1]
+    else
+        order = order .. "," .. ARGV[1]
+    end
+    redis.call("hset", KEYS[1], "order", order)
+end
+redis.call("hset", KEYS[1], value_key, ARGV[3], version_key, version + 1)
+local rev = redis.call("hincrby", KEYS[1], "rev", 1)
+redis.call("expire", KEYS[1], ARGV[5])
+redis.call("xadd", KEYS[2], "*", "kind", "proposal", "room_id", ARGV[6], "username", ARGV[7],
+    "proposal_id", ARGV[1], "field", ARGV[2], "value", ARGV[3], "version", version + 1)
+return {1, version + 1, index, rev}
+"""
+
+
+class ProposalPatchError(ValueError):
+    """項目の指定が不正・提案が多すぎる・議論が終了しているなど、適用できない変更"""
+
+
+class ProposalConflictError(Exception):
+    """クライアントが知らない変更が先に確定していた。frame は送信元に返す最新の値"""
+
+    def __init__(self, frame: dict):
+        super().__init__(frame.get("proposal_id"))
+        self.frame = frame
+
+
+def _decode_form(flat: list) -> dict:
+    """HGETALL の結果 (フラットなリスト or 辞書) を辞書にする"""
+    if isinstance(flat, dict):
+        return flat
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def form_snapshot(data: dict):
+    """ハッシュの内容を (提案のリスト, 項目ごとのバージョン, リビジョン) にする"""
+    proposals, versions = [], {}
+    for proposal_id in (data.get("order") or "").split(","):
+        if not proposal_id:
+            continue
+        proposal = {"id": proposal_id}
+        field_versions = {}
+        for field in PROPOSAL_FIELDS:
+            proposal[field] = data.get(f"f:{proposal_id}:{field}", "")
+            version = data.get(f"v:{proposal_id}:{field}")
+            if version is not None:
+                field_versions[field] = int(version)
+        proposals.append(proposal)
+        versions[proposal_id] = field_versions
+    return proposals, versions, int(data.get("rev") or 0)
+
+
+def _initial_fields(proposals_data: list, rev: int) -> list:
+    """DB に保存されている提案のリストを、ハッシュに書き込むフィールドと値の列にする"""
+    order, fields = [], []
+    for index, proposal in enumerate((proposals_data or [])[:MAX_PROPOSALS]):
+        if not isinstance(proposal, dict):
+            continue
+        proposal_id = proposal.get("id")
+        # IDのない以前の形式のデータは位置から決める (Redis から消えて読み直しても同じIDになるように)
+        if not isinstance(proposal_id, str) or not PROPOSAL_ID_PATTERN.match(proposal_id) or proposal_id in order:
+            proposal_id = f"p{index}"
+        order.append(proposal_id)
+        for field in PROPOSAL_FIELDS:
+            value = proposal.get(field)
+            if value:
+                fields += [f"f:{proposal_id}:{field}", str(value)]
+    return ["order", ",".join(order), "rev", rev] + fields
+
+
+class ProposalFormStore:
+    """
+    5W1H 提案フォームを項目単位で同期する。
+    - 正本は Redis に置き、全ワーカーで共有する
+    - クライアントは (提案ID, 項目, 値, その項目のバージョン) を送り、バージョンが一致したときだけ確定する
+      (他の人が先に同じ項目を書き換えていた場合は確定せず、最新の値を送信元に返す)
+    - 確定した変更はその項目だけを配信し、提案の一覧全体は配信しない
+    - Postgres (Room.proposals_data) には、書き込みの記録 (utils/writebehind.py) を反映するときに
+      変更のあったルームごとに最新の状態を1回だけ保存する
+    """
+
+    def __init__(self, session_factory, journal, ttl: int = 7 * 24 * 3600, retries: int = 5):
+        self.session_factory = session_factory
+        self.journal = journal
+        self.redis = None
+        self.ttl = ttl
+        self.retries = retries
+        self.counters = {"applied": 0, "conflicts": 0, "rejected": 0, "snapshots": 0}
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def _form_key(room_id: str) -> str:
+        return f"proposals:{room_id}:form"
+
+    @staticmethod
+    def _closed_key(room_id: str) -> str:
+        return f"proposals:{room_id}:closed"
+
+    async def load(self, room_id: str):
+        """(提案のリスト, 項目ごとのバージョン, リビジョン) を返す。Redis になければ DB の内容で初期化する。ルームがなければ None"""
+        data = await self.redis.hgetall(self._form_key(room_id))
+        if data:
+            return form_snapshot(data)
+
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(Room.proposals_data, Room.proposals_revision, Room.status).filter_by(room_id=room_id)
+            )
+            row = result.first()
+        if row is None:
+            return None
+        if row.status == "終了":
+            await self.redis.set(self._closed_key(room_id), "1", ex=self.ttl)
+        flat = await self.redis.eval(
+            _LOAD_SCRIPT, 1, self._form_key(room_id), self.ttl, *_initial_fields(row.proposals_data, row.proposals_revision or 0)
+        )
+        return form_snapshot(_decode_form(flat))
+
+    async def snapshot(self, room_id: str, fallback: list = None) -> list:
+        """AIなどに渡す最新の提案の一覧 (Redis に正本がなければ DB の値 fallback を使う)"""
+        if not self.redis:
+            return fallback or []
+        data = await self.redis.hgetall(self._form_key(room_id))
+        if not data:
+            return fallback or []
+        return form_snapshot(data)[0]
+
+    async def close(self, room_id: str):
+        """議論の終了後はフォームを編集できないようにする"""
+        if self.redis:
+            await self.redis.set(self._closed_key(room_id), "1", ex=self.ttl)
+
+    async def patch(self, room_id: str, proposal_id, field, value, version, username: str, client_id: str = None) -> dict:
+        """
+        提案 proposal_id の項目 field を value にし、配信するフレームを返す。
+        version はクライアントが最後に見たその項目のバージョン (新しい提案なら 0)。
+        """
+        if await self.redis.exists(self._closed_key(room_id)):
+            raise ProposalPatchError("closed")
+        try:
+            version = int(version)
+        except (TypeError, ValueError):
+            version = -1
+        if (not isinstance(proposal_id, str) or not PROPOSAL_ID_PATTERN.match(proposal_id)
+                or field not in PROPOSAL_FIELDS or not isinstance(value, str)
+                or len(value) > MAX_FIELD_LENGTH or version < 0):
+            self.counters["rejected"] += 1
+            raise ProposalPatchError("invalid")
+
+        for _ in range(2):
+            result = await self.redis.eval(
+                _PATCH_SCRIPT, 2, self._form_key(room_id), self.journal.stream_key,
+                proposal_id, field, value, version, self.ttl, room_id, username, MAX_PROPOSALS
+            )
+            status = int(result[0])
+            if status == -1:
+                # Redis にまだ読み込まれていない
+                if await self.load(room_id) is None:
+                    raise ProposalPatchError("room not found")
+                continue
+            if status == -2:
+                self.counters["rejected"] += 1
+                raise ProposalPatchError("too many proposals")
+            if status == 0:
+                self.counters["conflicts"] += 1
+                raise ProposalConflictError({
+                    "type": "proposal_patch_rejected", "proposal_id": proposal_id, "index": int(result[2]),
+                    "field": field, "value": result[3], "version": int(result[1]), "client_id": client_id,
+                })
+            self.counters["applied"] += 1
+            return {
+                "type": "proposal_patch", "proposal_id": proposal_id, "index": int(result[2]), "field": field,
+                "value": value, "version": int(result[1]), "client_id": client_id, "sender": username,
+            }
+        raise ProposalPatchError("room not found")
+
+    async def replace(self, room_id: str, proposals_list, username: str) -> list:
+        """
+        一覧全体を受け取った場合 (旧形式のクライアント) は、最新の状態と異なる項目だけを変更として適用する。
+        旧形式にはバージョンがないため、後から届いた値で上書きする。
+        """
+        frames = []
+        if not isinstance(proposals_list, list):
+            return frames
+        state = await self.load(room_id)
+        if state is None:
+            return frames
+        current, versions, _ = state
+        for index, proposal in enumerate(proposals_list[:MAX_PROPOSALS]):
+            if not isinstance(proposal, dict):
+                continue
+            if index < len(current):
+                proposal_id = current[index]["id"]
+                existing = current[index]
+            else:
+                proposal_id = uuid.uuid4().hex[:12]
+                existing = None
+            for field in PROPOSAL_FIELDS:
+                value = str(proposal.get(field) or "")
+                # 新しい提案は空でも1項目は書き込んで一覧に追加する
+                if existing is not None and existing[field] == value:
+                    continue
+                if existing is None and not value and field != PROPOSAL_FIELDS[0]:
+                    continue
+                field_version = versions.get(proposal_id, {}).get(field, 0)
+                for _ in range(self.retries):
+                    try:
+                        frames.append(await self.patch(room_id, proposal_id, field, value, field_version, username))
+                        break
+                    except ProposalConflictError as e:
+                        field_version = e.frame["version"]
+                    except ProposalPatchError:
+                        return frames
+        return frames
+
+    async def persist(self, db, entries: list):
+        """書き込みの記録をDBに反映する (ルームごとに Redis の最新の状態を1回だけ保存し、編集回数を加算する)"""
+        edits = {}
+        for entry in entries:
+            edits.setdefault(entry["room_id"], Counter())[entry["username"]] += 1
+        for room_id, counts in edits.items():
+            data = await self.redis.hgetall(self._form_key(room_id))
+            if data:
+                proposals, _, rev = form_snapshot(data)
+                # 他のワーカーが先に新しいリビジョンを保存していた場合は上書きしない
+                await db.execute(
+                    update(Room.__table__)
+                    .where(Room.room_id == room_id, Room.proposals_revision < rev)
+                    .values(proposals_data=proposals, proposals_revision=rev)
+                )
+            await bump_activity(db, room_id, [(username, "proposal_form_edits", n) for username, n in counts.items()])
+            self.counters["snapshots"] += 1
+
+    async def forget(self, room_id: str):
+        """ルームの削除時に Redis 上のフォームを消す"""
+        if self.redis:
+            await self.redis.delete(self._form_key(room_id), self._closed_key(room_id))
+
+    def stats(self) -> dict:
+        return dict(self.counters)
@@ -0,0 +1,272 @@
+import asyncio
+import json
+
+import requests
+from pywebpush import webpush
+from sqlalchemy import select, delete
+
+from models import PushSubscription
+
+# このステータスが返った購読は失効しているため削除する
+GONE_STATUS_CODES = {404, 410}
+# このステータス (または通信エラー) の場合は時間をおいて再送する
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def webpush_sender(vapid_private_key: str, vapid_claims: dict, timeout: float = 10.0):
+    """
+    pywebpush で1件送信する既定の送信関数を作る。
+    HTTP接続はセッションで使い回す。webpush は claims に aud/exp を書き込むため、毎回コピーを渡す。
+    """
+    session = requests.Session()
+
+    async def send(subscription_info: dict, payload: str):
+        await asyncio.to_thread(
+            webpush,
+            subscription_info=subscription_info,
+            data=payload,
+            vapid_private_key=vapid_private_key,
+            vapid_claims=dict(vapid_claims),
+            timeout=timeout,
+            requests_session=session,
+        )
+
+    return send
+
+
+def _status_code(error: Exception):
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+class _PendingPush:
+    def __init__(self, subscriptions):
+        self.subscriptions = subscriptions
+        self.count = 0
+        self.last_sender = None
+        self.last_content = ""
+
+
+class PushDispatcher:
+    """
+    Web Push の送信を受け持つディスパッチャー。
+    - notify() はキューに積むだけで待たない (キューが満杯なら破棄する)
+    - 同じ参加者への通知は coalesce_window 秒の間まとめ、「N件の新しいメッセージ」として1回だけ送る
+    - 送信はワーカーで並行に行い、同じエンドポイントへの同時送信数は per_endpoint_limit までにする
+    - 429/5xx/通信エラーは指数バックオフで再送し、404/410 が返った購読は削除する
+    - ルームごとの購読一覧はキャッシュし、/subscribe 時に invalidate() で破棄する
+      (ワーカー間では Redis 上のバージョン番号で無効化を伝える)
+    """
+
+    def __init__(self, session_factory, sender=None, workers: int = 4, maxsize: int = 1000,
+                 coalesce_window: float = 3.0, max_retries: int = 3, retry_base_delay: float = 1.0,
+                 per_endpoint_limit: int = 1):
+        self.session_factory = session_factory
+        self.sender = sender
+        self.redis = None
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.per_endpoint_limit = per_endpoint_limit
+        self._worker_count = workers
+        self._events = asyncio.Queue(maxsize=maxsize)
+        self._deliveries = asyncio.Queue(maxsize=maxsize)
+        self._tasks = []
+        self._pending = {}
+        self._flush_handles = {}
+        self._endpoint_slots = {}
+        self._subscription_cache = {}
+        self._retry_tasks = set()
+        self.counters = {"queued": 0, "dropped": 0, "coalesced": 0, "sent": 0, "failed": 0, "retried": 0, "pruned": 0}
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    def start(self):
+        self._tasks.append(asyncio.create_task(self._collector()))
+        for idx in range(self._worker_count):
+            self._tasks.append(asyncio.create_task(self._delivery_worker(idx)))
+
+    async def stop(self):
+        for handle in self._flush_handles.values():
+            handle.cancel()
+        self._flush_handles = {}
+        tasks = self._tasks + list(self._retry_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self, room_id: str, sender_name: str, content: str) -> bool:
+        """チャットのメッセージ1件ぶんの通知を依頼する。呼び出し側を待たせない"""
+        if self.sender is None:
+            return False
+        try:
+            self._events.put_nowait((room_id, sender_name, content))
+            self.counters["queued"] += 1
+            return True
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+            print(f"通知キューが満杯のため通知を破棄しました (Room: {room_id})")
+            return False
+
+    async def invalidate(self, room_id: str):
+        """ルームの購読一覧のキャッシュを破棄する (全ワーカー)"""
+        self._subscription_cache.pop(room_id, None)
+        if self.redis:
+            await self.redis.incr(self._version_key(room_id))
+
+    async def invalidate_all(self):
+        """全ルームの購読一覧のキャッシュを破棄する (全ワーカー)"""
+        self._subscription_cache = {}
+        if self.redis:
+            await self.redis.incr(self._version_key("*"))
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "events_waiting": self._events.qsize(),
+            "deliveries_waiting": self._deliveries.qsize(),
+            "pending_users": len(self._pending),
+        }
+
+    @staticmethod
+    def _version_key(room_id: str) -> str:
+        return f"push_subs_version:{room_id}"
+
+    async def _get_subscriptions(self, room_id: str) -> list:
+        version = None
+        if self.redis:
+            version = tuple(await self.redis.mget(self._version_key(room_id), self._version_key("*")))
+        cached = self._subscription_cache.get(room_id)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        async with self.session_factory() as db:
+            result = await db.execute(select(PushSubscription).filter_by(room_id=room_id))
+            subscriptions = [
+                {
+                    "id": sub.id, "room_id": sub.room_id, "username": sub.username,
+                    "endpoint": sub.endpoint, "p256dh": sub.p256dh, "auth": sub.auth,
+                }
+                for sub in result.scalars().all()
+            ]
+        self._subscription_cache[room_id] = (version, subscriptions)
+        return subscriptions
+
+    async def _collector(self):
+        while True:
+            room_id, sender_name, content = await self._events.get()
+            try:
+                subscriptions = await self._get_subscriptions(room_id)
+                if not subscriptions:
+                    continue
+                # ルームに接続中の参加者には通知しない
+                online_users = set(await self.redis.smembers(f"participants:{room_id}")) if self.redis else set()
+
+                by_user = {}
+                for sub in subscriptions:
+                    if sub["username"] == sender_name or sub["username"] in online_users:
+                        continue
+                    by_user.setdefault(sub["username"], []).append(sub)
+
+                for recipient, user_subscriptions in by_user.items():
+                    key = (room_id, recipient)
+                    pending = self._pending.get(key)
+                    if pending is None:
+                        pending = _PendingPush(user_subscriptions)
+                        self._pending[key] = pending
+                        self._flush_handles[key] = asyncio.get_running_loop().call_later(
+                            self.coalesce_window, self._flush, key
+                        )
+                    else:
+                        pending.subscriptions = user_subscriptions
+                        self.counters["coalesced"] += 1
+                    pending.count += 1
+                    pending.last_sender = sender_name
+                    pending.last_content = content
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"通知の準備でエラーが発生しました (Room: {room_id}): {e}")
+
+    def _flush(self, key):
+        self._flush_handles.pop(key, None)
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        room_id, recipient = key
+        if pending.count == 1:
+            title = f"{pending.last_sender}さんからのメッセージ"
+            body = pending.last_content[:100]
+        else:
+            title = f"{pending.count}件の新しいメッセージ"
+            body = f"{pending.last_sender}: {pending.last_content[:100]}"
+        payload = json.dumps({
+            "title": title,
+            "body": body,
+            "url": f"/room/{room_id}?username={recipient}",
+        })
+        for sub in pending.subscriptions:
+            self._enqueue_delivery(sub, payload, 0)
+
+    def _enqueue_delivery(self, sub: dict, payload: str, attempt: int):
+        try:
+            self._deliveries.put_nowait((sub, payload, attempt))
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+            print(f"通知の送信キューが満杯のため破棄しました ({sub['username']})")
+
+    async def _retry_later(self, sub: dict, payload: str, attempt: int):
+        await asyncio.sleep(self.retry_base_delay * (2 ** (attempt - 1)))
+        self._enqueue_delivery(sub, payload, attempt)
+
+    async def _delivery_worker(self, idx: int):
+        while True:
+            sub, payload, attempt = await self._deliveries.get()
+            try:
+                await self._deliver(sub, payload, attempt)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"通知の送信でエラーが発生しました (worker {idx}): {e}")
+
+    async def _deliver(self, sub: dict, payload: str, attempt: int):
+        endpoint = sub["endpoint"]
+        slot = self._endpoint_slots.get(endpoint)
+        if slot is None:
+            slot = [asyncio.Semaphore(self.per_endpoint_limit), 0]
+            self._endpoint_slots[endpoint] = slot
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                await self.sender(
+                    {"endpoint": endpoint, "keys": {"p256dh": sub["p256dh"], "auth": sub["auth"]}},
+                    payload,
+                )
+            self.counters["sent"] += 1
+        except Exception as e:
+            status = _status_code(e)
+            if status in GONE_STATUS_CODES:
+                await self._prune(sub)
+            elif (status is None or status in RETRY_STATUS_CODES) and attempt < self.max_retries:
+                self.counters["retried"] += 1
+                task = asyncio.create_task(self._retry_later(sub, payload, attempt + 1))
+                self._retry_tasks.add(task)
+                task.add_done_callback(self._retry_tasks.discard)
+            else:
+                self.counters["failed"] += 1
+                print(f"Notification Error for {sub['username']}: {e}")
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                self._endpoint_slots.pop(endpoint, None)
+
+    async def _prune(self, sub: dict):
+        """失効した購読 (404/410) を削除する"""
+        async with self.session_factory() as db:
+            await db.execute(delete(PushSubscription).where(PushSubscription.id == sub["id"]))
+            await db.commit()
+        self.counters["pruned"] += 1
+        print(f"失効した通知の購読を削除しました ({sub['username']})")
+        await self.invalidate(sub["room_id"])
@@ -0,0 +1,230 @@
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import select, update, delete, func, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import Message, MessageReaction
+from .activity import (
+    bump_activity, reactions_given_metric, reactions_received_metric, REACTION_TYPES, NON_PARTICIPANT_USERNAMES,
+)
+
+# --- メッセージへのリアクションの正本 (Redis) ---
+# メッセージごとに「ユーザー名 -> リアクションの種類」のハッシュと、ルーム・投稿者を持つハッシュを置く。
+
+# まだ Redis になければ、DB から読んだ内容で初期化する
+_LOAD_SCRIPT = """
+if redis.call("exists", KEYS[2]) == 0 then
+    if #ARGV > 3 then
+        redis.call("hset", KEYS[1], unpack(ARGV, 4))
+        redis.call("expire", KEYS[1], ARGV[1])
+    end
+    redis.call("hset", KEYS[2], "room_id", ARGV[2], "author", ARGV[3])
+    redis.call("expire", KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+# 同じ種類なら取り消し、違う種類なら付け替える。
+# DBへの保存用に、同じスクリプトの中で書き込みの記録 (WriteBehindJournal) に追記し、ルームのリアクションのバージョンを進める
+_TOGGLE_SCRIPT = """
+if redis.call("exists", KEYS[2]) == 0 then
+    return {-1}
+end
+local previous = redis.call("hget", KEYS[1], ARGV[1]) or ""
+local current = ARGV[2]
+if previous == current then
+    redis.call("hdel", KEYS[1], ARGV[1])
+    current = ""
+else
+    redis.call("hset", KEYS[1], ARGV[1], current)
+end
+redis.call("expire", KEYS[1], ARGV[3])
+redis.call("expire", KEYS[2], ARGV[3])
+local author = redis.call("hget", KEYS[2], "author") or ""
+redis.call("xadd", KEYS[3], "*", "kind", "reaction", "room_id", ARGV[4], "message_id", ARGV[5],
+    "username", ARGV[1], "author", author, "previous", previous, "reaction", current)
+redis.call("incr", KEYS[4])
+local result = {1, previous, current}
+for _, value in ipairs(redis.call("hvals", KEYS[1])) do
+    table.insert(result, value)
+end
+return result
+"""
+
+
+def _counts_from_users(users: dict) -> dict:
+    """「ユーザー名 -> 種類」を種類ごとの件数 (reaction_update フレームと同じ形) にする"""
+    counts = {r_type: 0 for r_type in REACTION_TYPES}
+    counts.update(Counter(users.values()))
+    return counts
+
+
+class MessageReactionStore:
+    """
+    リアクションの付け外しを Redis 上で原子的に行い、すぐに配信する。
+    Postgres (message_reactions・Message の件数の列・活動カウンタ) には、書き込みの記録 (utils/writebehind.py) を
+    反映するときに、変更のあった (メッセージ, 参加者) ごとに最新の状態を upsert / delete する。
+    """
+
+    def __init__(self, session_factory, journal, ttl: int = 24 * 3600):
+        self.session_factory = session_factory
+        self.journal = journal
+        self.redis = None
+        self.ttl = ttl
+        self.counters = {"toggled": 0, "snapshots": 0}
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def _keys(message_id: str):
+        return (f"reactions:{message_id}:users", f"reactions:{message_id}:meta")
+
+    @staticmethod
+    def _room_version_key(room_id: str) -> str:
+        return f"reactions:room:{room_id}:version"
+
+    async def room_version(self, room_id: str) -> int:
+        """ルームのリアクションが変わるたびに進む番号 (議事録の Excel のキャッシュキーに使う)"""
+        if not self.redis:
+            return 0
+        return int(await self.redis.get(self._room_version_key(room_id)) or 0)
+
+    async def _load(self, room_id: str, message_id: str) -> bool:
+        """Redis になければ DB の内容で初期化する。メッセージがこのルームになければ False"""
+        users_key, meta_key = self._keys(message_id)
+        meta_room = await self.redis.hget(meta_key, "room_id")
+        if meta_room is None:
+            async with self.session_factory() as db:
+                result = await db.execute(
+                    select(Message.room_id, Message.username).filter_by(message_id=message_id)
+                )
+                row = result.first()
+                if row is None:
+                    return False
+                result = await db.execute(
+                    select(MessageReaction.username, MessageReaction.type).filter_by(message_id=message_id)
+                )
+                pairs = [value for reaction in result.all() for value in reaction]
+            await self.redis.eval(
+                _LOAD_SCRIPT, 2, users_key, meta_key, self.ttl, row.room_id, row.username or "", *pairs
+            )
+            meta_room = row.room_id
+        return meta_room == room_id
+
+    async def toggle(self, room_id: str, message_id, username: str, reaction_type) -> dict:
+        """リアクションを付け外しし、配信する reaction_update フレームを返す (対象がなければ None)"""
+        if not isinstance(message_id, str) or reaction_type not in REACTION_TYPES:
+            return None
+        users_key, meta_key = self._keys(message_id)
+        for _ in range(2):
+            if not await self._load(room_id, message_id):
+                return None
+            result = await self.redis.eval(
+                _TOGGLE_SCRIPT, 4, users_key, meta_key, self.journal.stream_key, self._room_version_key(room_id),
+                username, reaction_type, self.ttl, room_id, message_id
+            )
+            if int(result[0]) == -1:
+                # 読み込んでから期限切れになった
+                continue
+            self.counters["toggled"] += 1
+            counts = {r_type: 0 for r_type in REACTION_TYPES}
+            counts.update(Counter(result[3:]))
+            return {"type": "reaction_update", "message_id": message_id, "reactions": counts}
+        return None
+
+    async def _users(self, message_ids) -> dict:
+        """Redis にあるメッセージのリアクション。message_id -> {ユーザー名: 種類}"""
+        message_ids = list(message_ids)
+        if not self.redis or not message_ids:
+            return {}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for message_id in message_ids:
+                users_key, meta_key = self._keys(message_id)
+                pipe.exists(meta_key)
+                pipe.hgetall(users_key)
+            results = await pipe.execute()
+        return {
+            message_id: users
+            for message_id, exists, users in zip(message_ids, results[::2], results[1::2])
+            if exists
+        }
+
+    async def current(self, message_ids) -> dict:
+        """Redis にあるメッセージの種類ごとのリアクション数 (DBにまだ反映されていないものを含む)"""
+        return {message_id: _counts_from_users(users) for message_id, users in (await self._users(message_ids)).items()}
+
+    async def persist(self, db, entries: list):
+        """
+        書き込みの記録をDBに反映する。(メッセージ, 参加者) ごとに Redis の最新の状態を
+        message_reactions に upsert / delete し、変更のあったメッセージの件数の列を数え直して、活動カウンタを加算する
+        """
+        activity = {}
+        latest = {}
+        for entry in entries:
+            room_activity = activity.setdefault(entry["room_id"], [])
+            username, author = entry["username"], entry.get("author")
+            count_received = author and author not in NON_PARTICIPANT_USERNAMES
+            if entry.get("previous"):
+                room_activity.append((username, reactions_given_metric(entry["previous"]), -1))
+                if count_received:
+                    room_activity.append((author, reactions_received_metric(entry["previous"]), -1))
+            if entry.get("reaction"):
+                room_activity.append((username, reactions_given_metric(entry["reaction"]), 1))
+                if count_received:
+                    room_activity.append((author, reactions_received_metric(entry["reaction"]), 1))
+            # 同じ参加者の記録は後のものほど新しい (Redis から消えていた場合はこの値を使う)
+            latest[(entry["message_id"], username)] = entry.get("reaction") or ""
+
+        # 反映する前に削除されたメッセージの分は捨てる
+        result = await db.execute(
+            select(Message.message_id).where(Message.message_id.in_({message_id for message_id, _ in latest}))
+        )
+        message_ids = set(result.scalars().all())
+        current_users = await self._users(message_ids)
+        upserts, deletes = [], []
+        for (message_id, username), reaction in latest.items():
+            if message_id not in message_ids:
+                continue
+            if message_id in current_users:
+                reaction = current_users[message_id].get(username, "")
+            if reaction:
+                upserts.append({"message_id": message_id, "username": username, "type": reaction})
+            else:
+                deletes.append((message_id, username))
+
+        if upserts:
+            stmt = pg_insert(MessageReaction).values(upserts)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[MessageReaction.message_id, MessageReaction.username],
+                set_={"type": stmt.excluded.type, "updated_at": datetime.utcnow()}
+            )
+            await db.execute(stmt)
+        if deletes:
+            await db.execute(
+                delete(MessageReaction).where(tuple_(MessageReaction.message_id, MessageReaction.username).in_(deletes))
+            )
+        if message_ids:
+            # 加算ではなく行数から数え直すため、同じ記録を2回反映しても件数はずれない
+            await db.execute(
+                update(Message.__table__)
+                .where(Message.message_id.in_(message_ids))
+                .values({
+                    f"{r_type}_count": select(func.count()).where(
+                        MessageReaction.message_id == Message.message_id, MessageReaction.type == r_type
+                    ).scalar_subquery()
+                    for r_type in REACTION_TYPES
+                })
+            )
+            self.counters["snapshots"] += len(message_ids)
+        for room_id, rows in activity.items():
+            await bump_activity(db, room_id, rows)
+
+    async def forget(self, message_id: str):
+        """メッセージの削除時に Redis 上のリアクションを消す"""
+        if self.redis:
+            await self.redis.delete(*self._keys(message_id))
+
+    def stats(self) -> dict:
+        return dict(self.counters)
@@ -0,0 +1,77 @@
+import json
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from models import Message
+
+
+def parent_summary(message_id: str, username: str, content: str) -> dict:
+    """返信の引用 (Message.to_dict の reply_to) に載せる返信元の情報 (内容は省略せずに載せ、画面側で冒頭だけを表示する)"""
+    return {"id": message_id, "username": username, "content": content}
+
+
+class ReplyParentCache:
+    """
+    返信元になりうる直近の発言の要約 (ID・投稿者・内容) を、ワーカー内でルームごとに max_per_room 件まで保持する LRU。
+    room_hub の購読が生きているルームだけをキャッシュし、配信されたフレームで追加 (message / gemini_response)・
+    削除 (message_deleted) する。返信の投稿時に、直近の発言への返信ならDBを読まずに引用を作れる。
+    """
+
+    def __init__(self, session_factory, hub, max_per_room: int = 500):
+        self.session_factory = session_factory
+        self.hub = hub
+        self.max_per_room = max_per_room
+        self._rooms = {}
+        self.counters = {"hits": 0, "misses": 0}
+        hub.add_observer(self)
+
+    def put(self, room_id: str, message_id: str, username: str, content: str):
+        if not message_id or not self.hub.is_live(room_id):
+            return
+        entries = self._rooms.setdefault(room_id, OrderedDict())
+        entries[message_id] = parent_summary(message_id, username, content)
+        entries.move_to_end(message_id)
+        while len(entries) > self.max_per_room:
+            entries.popitem(last=False)
+
+    def discard(self, room_id: str, message_id: str):
+        entries = self._rooms.get(room_id)
+        if entries is not None:
+            entries.pop(message_id, None)
+
+    async def get(self, db, room_id: str, message_id: str) -> dict:
+        """返信元の要約。キャッシュになければ必要な列だけをDBから読む (このルームの発言でなければ None)"""
+        entries = self._rooms.get(room_id)
+        if entries is not None and message_id in entries:
+            entries.move_to_end(message_id)
+            self.counters["hits"] += 1
+            return entries[message_id]
+        self.counters["misses"] += 1
+        result = await db.execute(
+            select(Message.message_id, Message.username, Message.content)
+            .filter(Message.message_id == message_id, Message.room_id == room_id)
+        )
+        row = result.first()
+        if row is None:
+            return None
+        self.put(room_id, *row)
+        return parent_summary(*row)
+
+    def on_frame(self, room_id: str, raw: str):
+        """room_hub が受け取ったフレーム (エンコード済みの文字列)"""
+        # 配信されるフレームは type を先頭に書くため、ストリーミングの差分などはデコードせずに読み飛ばす
+        if not raw.startswith('{"type":"message') and not raw.startswith('{"type":"gemini_response"'):
+            return
+        frame = json.loads(raw)
+        if frame["type"] in ("message", "gemini_response"):
+            self.put(room_id, frame.get("message_id"), frame.get("username"), frame.get("content"))
+        elif frame["type"] == "message_deleted":
+            self.discard(room_id, frame.get("message_id"))
+
+    def on_room_closed(self, room_id: str):
+        # 購読が切れたルームは削除を受け取れないため破棄する
+        self._rooms.pop(room_id, None)
+
+    def stats(self) -> dict:
+        return {"rooms": len(self._rooms), "entries": sum(len(e) for e in self._rooms.values()), **self.counters}
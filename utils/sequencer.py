@@ -0,0 +1,132 @@
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+# リースの解放は「自分が取得したリースの場合のみ削除」をアトミックに行う
+_RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseTimeoutError(Exception):
+    """ルームのリースを時間内に取得できなかった場合の例外"""
+
+
+class RoomSequencer:
+    """
+    ルームごとの書き込みを直列化するシーケンサー。
+    - 同一ワーカー内: ルームごとの asyncio キューと専用タスクで順番に実行する
+    - ワーカー間 (gunicorn -w 4): Redis 上の短いリースで排他する
+    DBの行ロック (SELECT ... FOR UPDATE) の代わりに使い、キューに溜まった処理は
+    1回のリース取得でまとめて実行する。
+    """
+
+    def __init__(self, lease_ttl_ms: int = 5000, lease_wait_timeout: float = 10.0,
+                 idle_timeout: float = 30.0, max_batch: int = 32):
+        self.redis = None
+        self.lease_ttl_ms = lease_ttl_ms
+        self.lease_wait_timeout = lease_wait_timeout
+        self.idle_timeout = idle_timeout
+        self.max_batch = max_batch
+        self._queues = {}
+        self._workers = {}
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    async def run_exclusive(self, room_id: str, func):
+        """func (引数なしのコルーチン関数) をルーム内で排他的に実行し、その戻り値を返す"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(room_id)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._queues[room_id] = queue
+            self._workers[room_id] = asyncio.create_task(self._room_worker(room_id, queue))
+        queue.put_nowait((func, future))
+        return await future
+
+    async def stop(self):
+        for task in self._workers.values():
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers = {}
+        self._queues = {}
+
+    async def _room_worker(self, room_id: str, queue: asyncio.Queue):
+        try:
+            while True:
+                try:
+                    first = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # 暇になったルームのキューとタスクは片付ける
+                    if queue.empty():
+                        return
+                    continue
+
+                batch = [first]
+                try:
+                    async with self.lease(room_id) as acquired_at:
+                        while batch:
+                            func, future = batch.pop(0)
+                            await self._run_item(func, future)
+                            # リースの有効期限に余裕があるうちは、溜まっている処理を続けて実行する
+                            elapsed_ms = (time.monotonic() - acquired_at) * 1000
+                            if (not queue.empty() and len(batch) < self.max_batch
+                                    and elapsed_ms < self.lease_ttl_ms / 2):
+                                batch.append(queue.get_nowait())
+                except LeaseTimeoutError as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            if self._queues.get(room_id) is queue:
+                del self._queues[room_id]
+                self._workers.pop(room_id, None)
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                future.cancel()
+
+    @staticmethod
+    async def _run_item(func, future):
+        if future.cancelled():
+            return
+        try:
+            result = await func()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    @asynccontextmanager
+    async def lease(self, room_id: str):
+        """ワーカー間で共有されるルームのリースを取得する (Redis未接続時はワーカー内の直列化のみ)"""
+        acquired_at = time.monotonic()
+        if self.redis is None:
+            yield acquired_at
+            return
+
+        key = f"lease:room:{room_id}"
+        token = uuid.uuid4().hex
+        deadline = acquired_at + self.lease_wait_timeout
+        delay = 0.002
+        while not await self.redis.set(key, token, nx=True, px=self.lease_ttl_ms):
+            if time.monotonic() > deadline:
+                raise LeaseTimeoutError(f"ルーム {room_id} のリースを取得できませんでした。")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+        acquired_at = time.monotonic()
+        try:
+            yield acquired_at
+        finally:
+            try:
+                await self.redis.eval(_RELEASE_LEASE_SCRIPT, 1, key, token)
+            except Exception as e:
+                # 解放に失敗してもTTLで自然に失効する
+                print(f"ルームリースの解放に失敗しました (Room: {room_id}): {e}")
@@ -1,8 +1,25 @@
 from google import genai
 import os
-from .client import get_gemini_client
+import asyncio
+from .client import get_gemini_client, get_llm_gateway
+from .llm import LLMCancelledError
 import json
 
+# 失敗時に各関数が返すエラー文の書き出し (結果をキャッシュしてよいかの判定に使う)
+AI_ERROR_PREFIXES = ("申し訳ありません、", "エラー: ")
+
+def is_ai_error_reply(text: str) -> bool:
+    return text.startswith(AI_ERROR_PREFIXES)
+
+async def get_file_objects(client, files: list) -> list:
+    """
+    Geminiにアップロード済みのファイルのリストを、APIが認識できるファイルオブジェクトのリストに変換する。
+    ファイル名 (文字列) だけを問い合わせ、解決済みのファイルオブジェクトはそのまま使う。
+    """
+    names = [file for file in files if isinstance(file, str)]
+    fetched = iter(await asyncio.gather(*(client.aio.files.get(name=file_name) for file_name in names)))
+    return [next(fetched) if isinstance(file, str) else file for file in files]
+
 def format_proposals_for_prompt(proposals_list):
     """提案リストをAIが読めるテキスト形式に整形するヘルパー関数"""
     if not proposals_list:
@@ -20,7 +37,36 @@ def format_proposals_for_prompt(proposals_list):
         formatted_text += f"思考法: {prop.get('q7', '未記入')}\n"
     return formatted_text
 
-def ask_gemini_simple(question: str, files: list = None) -> str:
+def build_meeting_context(title: str, topic: str, transcript, note_content: str, proposals_data: list,
+                          log_label: str, empty_note: str, participants: list = None, empty_log: str = "") -> str:
+    """
+    各プロンプト共通の「会議情報」ブロックを作る。
+    議論ログは transcript (utils/transcript.py の RoomTranscript) の整形済みの行をそのまま使う。
+    """
+    lines = ["---", f"**{title}**", f"* 議題: {topic}"]
+    if participants is not None:
+        lines.append(f"* 参加者: {', '.join(participants)}")
+    lines.append(f"* 共有ノート: {note_content if note_content else empty_note}")
+    lines.append("* 5W1H提案フォームの入力状況:")
+    lines.append(format_proposals_for_prompt(proposals_data))
+    lines.append(f"* {log_label}:")
+    lines.append(transcript.text() or empty_log)
+    lines.append("---")
+    return "\n".join(lines)
+
+async def generate_text(model: str, contents, room_id: str = None, owner: str = None, purpose: str = "generate", on_text=None) -> str:
+    """
+    モデルの応答テキストを返す。on_text を渡すとストリーミングで問い合わせ、
+    断片を受け取るたびに on_text(断片) を呼ぶ (ルームへの逐次配信用)。
+    """
+    gateway = get_llm_gateway()
+    if on_text:
+        text = await gateway.generate_stream(model, contents, on_text, room_id=room_id, owner=owner, purpose=purpose)
+        return text.strip()
+    response = await gateway.generate(model, contents, room_id=room_id, owner=owner, purpose=purpose)
+    return response.text.strip()
+
+async def ask_gemini_simple(question: str, files: list = None, room_id: str = None, owner: str = None, on_text=None) -> str:
     """Geminiに文脈なしで簡単な質問を投げ、回答を得る"""
     try:
         # 新しい作法でクライアントを取得
@@ -33,49 +79,31 @@ def ask_gemini_simple(question: str, files: list = None) -> str:
         if files:
             try:
                 # APIが認識できるファイルオブジェクトのリストに変換
-                file_objects = [client.files.get(name=file_name) for file_name in files]
+                file_objects = await get_file_objects(client, files)
                 content_to_send.extend(file_objects)
             except Exception as e:
                 print(f"File retrieval error for ask_gemini_simple: {e}")
                 return "エラー: 添付ファイルの取得に失敗しました。"
 
-        response = client.models.generate_content(
-            model='models/gemini-flash-latest', # モデル名を文字列で指定
-            contents=content_to_send
+        return await generate_text(
+            'models/gemini-flash-latest', # モデル名を文字列で指定
+            content_to_send,
+            room_id=room_id, owner=owner, purpose="gemini_question", on_text=on_text
         )
-        return response.text.strip()
+    except LLMCancelledError:
+        raise
     except Exception as e:
         print(f"Geminiへの質問でエラーが発生: {e}")
         return f"申し訳ありません、質問への回答中にエラーが発生しました: {e}"
 
-def analyze_discussion_progress(messages: list, topic: str, files: list = None, note_content: str = "", proposals_data: list = []) -> str:
+async def analyze_discussion_progress(transcript, topic: str, files: list = None, note_content: str = "", proposals_data: list = [], room_id: str = None, owner: str = None) -> str:
     """Geminiに現在の議論の状況を分析・要約させる"""
     try:
         client = get_gemini_client()
-        
-        chat_log = []
-        for msg in messages:
-            username = "🤖 Gemini" if msg.get('username') == "Gemini" else msg.get('username', '不明')
-            content = msg.get('content', '')
-            stance = msg.get('stance', '')
-            
-            reply_info = ""
-            if msg.get('reply_to'):
-                reply_to_user = msg['reply_to'].get('username', '不明')
-                reply_info = f" (返信 to {reply_to_user})"
-
-            reaction_info = ""
-            if stance == '意見' and msg.get('reactions'):
-                reactions = msg['reactions']
-                agree_count = len(reactions.get('agree', []))
-                partial_count = len(reactions.get('partial', []))
-                disagree_count = len(reactions.get('disagree', []))
-                if agree_count + partial_count + disagree_count > 0:
-                    reaction_info = f" [リアクション: 👍{agree_count}, 🤔{partial_count}, 👎{disagree_count}]"
-
-            chat_log.append(f"{username} ({stance}){reply_info}: {content}{reaction_info}")
-        chat_log_string = "\n".join(chat_log)
-        proposals_text = format_proposals_for_prompt(proposals_data)
+        meeting_context = build_meeting_context(
+            "現在の会議情報", topic, transcript, note_content, proposals_data,
+            log_label="議論ログ", empty_note="（まだ記入されていません）"
+        )
 
         prompt = f"""
 あなたの役割
@@ -118,69 +146,39 @@ Where（どこでその提案を実施するか）: （未定）
 （提言が複数ある場合は、この形式を繰り返す）
 
 
----
-**現在の会議情報**
-* 議題: {topic}
-* 共有ノート: {note_content if note_content else "（まだ記入されていません）"}
-* 5W1H提案フォームの入力状況:
-{proposals_text}
-* 議論ログ: 
-{chat_log_string}
----
+{meeting_context}
 
 上記の形式で、ユーザーへのフィードバックを作成してください。
 """
         content_to_send = [prompt]
         if files:
             try:
-                file_objects = [client.files.get(name=file_name) for file_name in files]
+                file_objects = await get_file_objects(client, files)
                 content_to_send.extend(file_objects)
             except Exception as e:
                 print(f"File retrieval error for analyze_discussion_progress: {e}")
                 return "エラー: 添付ファイルの取得に失敗しました。"
         
-        response = client.models.generate_content(
-            model='models/gemini-flash-latest',
-            contents=content_to_send
+        response = await get_llm_gateway().generate(
+            'models/gemini-flash-latest',
+            content_to_send,
+            room_id=room_id, owner=owner, purpose="progress_check"
         )
         return response.text.strip()
+    except LLMCancelledError:
+        raise
     except Exception as e:
         print(f"Geminiでの進行状況分析でエラーが発生: {e}")
         return f"申し訳ありません、進行状況の分析中にエラーが発生しました: {e}"
 
-def generate_summary(messages: list, topic: str, files: list = None, note_content: str = "", proposals_data: list = []) -> str:
+async def generate_summary(transcript, topic: str, files: list = None, note_content: str = "", proposals_data: list = [], room_id: str = None, owner: str = None) -> str:
     try:
         client = get_gemini_client()
-        
-        chat_log = []
-        participants = set()
-        for msg in messages:
-            username = msg.get('username', '不明')
-            if username != "Gemini":
-                participants.add(username)
-            
-            username_display = "🤖 Gemini" if username == "Gemini" else username
-            file_info = f" (ファイル: {msg.get('original_filename')})" if msg.get('original_filename') else ""
-            
-            reply_info = ""
-            if msg.get('reply_to'):
-                reply_to_user = msg['reply_to'].get('username', '不明')
-                reply_info = f" (返信 to {reply_to_user})"
-
-            reaction_info = ""
-            if msg.get('stance') == '意見' and msg.get('reactions'):
-                reactions = msg['reactions']
-                agree_count = len(reactions.get('agree', []))
-                partial_count = len(reactions.get('partial', []))
-                disagree_count = len(reactions.get('disagree', []))
-                if agree_count + partial_count + disagree_count > 0:
-                    reaction_info = f" [リアクション: 同意 {agree_count}, 部分同意 {partial_count}, 同意できない {disagree_count}]"
-            
-            chat_log.append(f"{username_display} ({msg.get('stance', '')}){reply_info}: {msg.get('content', '')}{file_info}{reaction_info}")
-        
-        chat_log_string = "\n".join(chat_log)
-
-        proposals_text = format_proposals_for_prompt(proposals_data)
+        meeting_context = build_meeting_context(
+            "会議情報", topic, transcript, note_content, proposals_data,
+            log_label="発言履歴ログ", empty_note="（記入なし）",
+            participants=sorted(transcript.speakers())
+        )
 
         prompt = f"""以下の会議ログから、具体的な議事録を作成してください。
 あなたの役割
@@ -236,57 +234,34 @@ How（どのような手法で実施するか）: 設置補助金制度を新設
 5. 政策提言の発表役割分担
 もし、今後の役割分担について議論されている形跡があれば、その内容を参加者ごとに簡潔にまとめてください。役割分担に関する議論が一切ない場合は、この項目自体を省略してください。
 
----
-**会議情報**
-* 議題: {topic}
-* 参加者: {', '.join(sorted(list(participants)))}
-* 共有ノート: {note_content if note_content else "（記入なし）"}
-* 5W1H提案フォームの入力状況:
-{proposals_text}
-* 発言履歴ログ:
-{chat_log_string}
----
+{meeting_context}
 """
         content_to_send = [prompt]
         if files:
             try:
-                file_objects = [client.files.get(name=file_name) for file_name in files]
+                file_objects = await get_file_objects(client, files)
                 content_to_send.extend(file_objects)
             except Exception as e:
                 print(f"File retrieval error for generate_summary: {e}")
                 return "エラー: 添付ファイルの取得に失敗しました。"
 
-        response = client.models.generate_content(
-            model='models/gemini-pro-latest',
-            contents=content_to_send
+        response = await get_llm_gateway().generate(
+            'models/gemini-pro-latest',
+            content_to_send,
+            room_id=room_id, owner=owner, purpose="meeting_summary"
         )
         return response.text.strip()
         
+    except LLMCancelledError:
+        raise
     except Exception as e:
         print(f"議事録生成エラー (Gemini): {e}")
         return f"議事録生成中にエラーが発生しました (Gemini): {e}"
     
-def get_facilitation_from_gemini(messages: list, topic: str, note_content: str, proposals_data: list = None) -> str:
+async def get_facilitation_from_gemini(transcript, topic: str, note_content: str, proposals_data: list = None, room_id: str = None, owner: str = None, on_text=None) -> str:
     try:
         client = get_gemini_client()
 
-        chat_log = []
-        for msg in messages:
-            username = "🤖 Gemini" if msg.get('username') == "Gemini" else msg.get('username', '不明')
-            content = msg.get('content', '')
-            stance = msg.get('stance', '')
-            file_info = f" (添付ファイルあり)" if msg.get('file_url') else ""
-            reply_info = f" (返信 to {msg['reply_to']['username']})" if msg.get('reply_to') else ""
-            reaction_info = ""
-            if stance == '意見' and msg.get('reactions'):
-                reactions = msg['reactions']
-                agree = len(reactions.get('agree', []))
-                partial = len(reactions.get('partial', []))
-                disagree = len(reactions.get('disagree', []))
-                if agree + partial + disagree > 0:
-                    reaction_info = f" [反応: 👍{agree}, 🤔{partial}, 👎{disagree}]"
-            chat_log.append(f"{username} ({stance}){reply_info}: {content}{file_info}{reaction_info}")
-
         system_prompt = f"""
 あなたの役割
 あなたは、オンライン形式の気候市民会議を円滑に進行させるための、高度なAIファシリテーターです。あなたの目的は、参加者が自分たちの力で建設的な対話を深め、最終的に具体的な政策提言にまとめる手助けをすることです。
@@ -337,26 +312,56 @@ def get_facilitation_from_gemini(messages: list, topic: str, note_content: str,
 一度に複数の要求: 例：「Whenを決め、さらに次の提言も考えましょう」
 """
 
-        chat_log_string = "\n".join(chat_log) if chat_log else "（まだ発言がありません）"
-
-        proposals_text = format_proposals_for_prompt(proposals_data)
-
+        meeting_context = build_meeting_context(
+            "現在の会議情報", topic, transcript, note_content, proposals_data,
+            log_label="チャット履歴", empty_note="（まだ記入されていません）",
+            empty_log="（まだ発言がありません）"
+        )
         full_prompt = f"""{system_prompt}
----
-**現在の会議情報**
-* 議題: {topic}
-* 共有ノート: {note_content if note_content else "（まだ記入されていません）"}
-* 5W1H提案フォームの入力状況:
-{proposals_text}
-* チャット履歴:
-{chat_log_string}
----
+{meeting_context}
 """
-        response = client.models.generate_content(
-            model='models/gemini-flash-latest',
-            contents=full_prompt
+        return await generate_text(
+            'models/gemini-flash-latest',
+            full_prompt,
+            room_id=room_id, owner=owner, purpose="facilitation", on_text=on_text
         )
-        return response.text.strip()
+    except LLMCancelledError:
+        raise
     except Exception as e:
         print(f"AI Facilitation error (Gemini): {e}")
-        return f"申し訳ありません、ファシリテーションの実行中にエラーが発生しました: {e}"
\ No newline at end of file
+        return f"申し訳ありません、ファシリテーションの実行中にエラーが発生しました: {e}"
+
+async def summarize_transcript_segment(lines_text: str, topic: str, room_id: str = None) -> str:
+    """
+    ローリング要約用に、議論ログの一区間を短い要約にまとめる。
+    失敗した場合は例外をそのまま投げる (エラー文を要約として保存しないため)。
+    """
+    prompt = f"""以下は、議題「{topic}」についてのオンライン会議の議論ログの一部です。
+後から議論の流れを追えるように、この区間の内容を要約してください。
+- 誰がどのような意見・提案・質問をしたか、参加者名を残してまとめる
+- 賛否が分かれた点、合意した点、未解決の質問を明記する
+- 400字以内、箇条書き。前置きや思考過程は出力しない
+
+議論ログ:
+{lines_text}
+"""
+    response = await get_llm_gateway().generate(
+        'models/gemini-flash-latest', prompt, room_id=room_id, purpose="segment_summary"
+    )
+    return response.text.strip()
+
+async def merge_transcript_summaries(summaries: list, topic: str, room_id: str = None) -> str:
+    """古い区間の要約を複数まとめて、1つの要約にまとめ直す (要約の要約)"""
+    numbered = "\n".join(f"({idx}) {summary}" for idx, summary in enumerate(summaries, 1))
+    prompt = f"""以下は、議題「{topic}」についてのオンライン会議の議論を、時系列順に区間ごとに要約したものです。
+これらを1つの要約にまとめ直してください。
+- 議論の流れ、主な提案と参加者名、合意点と対立点、未解決の質問を残す
+- 600字以内、箇条書き。前置きや思考過程は出力しない
+
+区間ごとの要約:
+{numbered}
+"""
+    response = await get_llm_gateway().generate(
+        'models/gemini-flash-latest', prompt, room_id=room_id, purpose="segment_merge"
+    )
+    return response.text.strip()
@@ -0,0 +1,374 @@
+import asyncio
+import json
+
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+
+from models import Message, TranscriptSegment
+
+REACTION_EMOJI = {"agree": "👍", "partial": "🤔", "disagree": "👎"}
+
+
+def format_chat_line(entry: dict) -> str:
+    """AIに渡す議論ログの1行。全てのAI呼び出しでこの形式に統一する"""
+    username = entry["username"] or "不明"
+    username_display = "🤖 Gemini" if username == "Gemini" else username
+    reply_info = f" (返信 to {entry['reply_to_username']})" if entry.get("reply_to_username") else ""
+    file_info = f" (ファイル: {entry['original_filename'] or '添付ファイル'})" if entry.get("file_url") else ""
+
+    reaction_info = ""
+    counts = entry.get("reaction_counts") or {}
+    if entry.get("stance") == "意見" and sum(counts.values()) > 0:
+        reaction_info = " [リアクション: " + ", ".join(
+            f"{emoji}{counts.get(reaction, 0)}" for reaction, emoji in REACTION_EMOJI.items()
+        ) + "]"
+    return f"{username_display} ({entry.get('stance') or ''}){reply_info}: {entry.get('content') or ''}{file_info}{reaction_info}"
+
+
+def _entry_from_message_dict(message: dict) -> dict:
+    reactions = message.get("reactions") or {}
+    reply_to = message.get("reply_to") or {}
+    return {
+        "message_id": message["message_id"],
+        "created_at": message.get("created_at") or "",
+        "username": message.get("username"),
+        "content": message.get("content"),
+        "stance": message.get("stance"),
+        "file_url": message.get("file_url"),
+        "original_filename": message.get("original_filename"),
+        "gemini_file_ref": message.get("gemini_file_ref"),
+        "reply_to_username": reply_to.get("username"),
+        "reaction_counts": {reaction: reactions.get(reaction) or 0 for reaction in REACTION_EMOJI},
+    }
+
+
+class RoomTranscript:
+    """1ルーム分の議論ログ。メッセージごとに整形済みの行を持ち、変更のあった行だけを作り直す"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lines = {}
+        self._text = ""
+
+    def add(self, message: dict):
+        if message.get("stance") == "summary" or message["message_id"] in self._entries:
+            return
+        entry = _entry_from_message_dict(message)
+        line = format_chat_line(entry)
+        self._entries[entry["message_id"]] = entry
+        self._lines[entry["message_id"]] = line
+        if self._text is not None:
+            self._text = f"{self._text}\n{line}" if self._text else line
+
+    def update_reactions(self, message_id: str, counts: dict):
+        entry = self._entries.get(message_id)
+        if entry is None:
+            return
+        entry["reaction_counts"] = {reaction: counts.get(reaction, 0) for reaction in REACTION_EMOJI}
+        line = format_chat_line(entry)
+        if line != self._lines[message_id]:
+            self._lines[message_id] = line
+            self._text = None
+
+    def remove(self, message_id: str):
+        if self._entries.pop(message_id, None) is not None:
+            del self._lines[message_id]
+            self._text = None
+
+    def text(self) -> str:
+        """議論ログ全体 (行の追加だけなら連結済みの文字列をそのまま使う)"""
+        if self._text is None:
+            self._text = "\n".join(self._lines.values())
+        return self._text
+
+    def is_empty(self) -> bool:
+        return not self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entries_after(self, boundary=None) -> list:
+        """(created_at, message_id) が boundary より後の発言を、その順に (エントリ, 整形済みの行) のリストで返す"""
+        entries = [
+            (entry, self._lines[message_id])
+            for message_id, entry in self._entries.items()
+            if boundary is None or (entry["created_at"], message_id) > boundary
+        ]
+        entries.sort(key=lambda item: (item[0]["created_at"], item[0]["message_id"]))
+        return entries
+
+    def file_refs(self) -> list:
+        return [entry["gemini_file_ref"] for entry in self._entries.values() if entry.get("gemini_file_ref")]
+
+    def speakers(self) -> set:
+        return {entry["username"] for entry in self._entries.values() if entry["username"] != "Gemini"}
+
+
+class RollingTranscript:
+    """
+    ローリング要約モードでAIに渡す議論ログ。RoomTranscript と同じ使い方ができる。
+    要約済みの区間 (TranscriptSegment) の要約と、直近 tail_size 件の生の発言だけを並べるため、
+    ルームが長くなってもプロンプトの大きさが一定に収まる。
+    """
+
+    def __init__(self, transcript: RoomTranscript, segments: list, tail_size: int):
+        self.transcript = transcript
+        self.segments = segments
+        self.tail_size = tail_size
+
+    def boundary(self):
+        if not self.segments:
+            return None
+        last = self.segments[-1]
+        return (last.last_created_at, last.last_message_id)
+
+    def text(self) -> str:
+        raw = self.transcript.entries_after(self.boundary())
+        if not self.segments and len(raw) <= self.tail_size:
+            return self.transcript.text()
+
+        parts = []
+        if self.segments:
+            parts.append("[これまでの議論の要約]")
+            parts.extend(f"({idx}) {segment.summary}" for idx, segment in enumerate(self.segments, 1))
+        omitted = len(raw) - self.tail_size
+        if omitted > 0:
+            # 要約がまだ追いついていない区間は省略する (バックグラウンドで要約される)
+            parts.append(f"（中略: {omitted}件の発言）")
+            raw = raw[-self.tail_size:]
+        parts.append("[直近の発言]")
+        parts.extend(line for _, line in raw)
+        return "\n".join(parts)
+
+    def is_empty(self) -> bool:
+        return self.transcript.is_empty() and not self.segments
+
+    def file_refs(self) -> list:
+        return self.transcript.file_refs()
+
+    def speakers(self) -> set:
+        return self.transcript.speakers()
+
+
+class _CachedRoom:
+    def __init__(self):
+        self.transcript = None
+        self.pending_frames = []
+        self.loaded = asyncio.Event()
+
+
+class TranscriptCache:
+    """
+    ワーカー内のルームごとの議論ログのキャッシュ。
+    room_hub の購読が生きているルームだけをキャッシュし、配信されたフレーム
+    (message / gemini_response / reaction_update / message_deleted) で差分更新する。
+    購読のないルームでは、呼び出しのたびにDBから作る (キャッシュしない)。
+    """
+
+    def __init__(self, session_factory, hub):
+        self.session_factory = session_factory
+        self.hub = hub
+        self._rooms = {}
+        self.hits = 0
+        self.misses = 0
+        hub.add_observer(self)
+
+    async def get(self, room_id: str) -> RoomTranscript:
+        cached = self._rooms.get(room_id)
+        if cached is not None:
+            await cached.loaded.wait()
+            if cached.transcript is not None:
+                self.hits += 1
+                return cached.transcript
+
+        self.misses += 1
+        if not self.hub.is_live(room_id):
+            return await self._load(room_id)
+
+        # 読み込み中に届いたフレームは溜めておき、読み込み後に適用する
+        cached = _CachedRoom()
+        self._rooms[room_id] = cached
+        try:
+            transcript = await self._load(room_id)
+            for frame in cached.pending_frames:
+                self._apply(transcript, frame)
+            cached.pending_frames = []
+            if self._rooms.get(room_id) is cached:
+                cached.transcript = transcript
+            return transcript
+        except Exception:
+            if self._rooms.get(room_id) is cached:
+                del self._rooms[room_id]
+            raise
+        finally:
+            cached.loaded.set()
+
+    def on_frame(self, room_id: str, raw: str):
+        """room_hub が受け取ったフレーム (エンコード済みの文字列)"""
+        cached = self._rooms.get(room_id)
+        if cached is None:
+            return
+        frame = json.loads(raw)
+        if cached.transcript is None:
+            cached.pending_frames.append(frame)
+        else:
+            self._apply(cached.transcript, frame)
+
+    def on_room_closed(self, room_id: str):
+        # 購読が切れたルームは差分を受け取れないため破棄する
+        self._rooms.pop(room_id, None)
+
+    def stats(self) -> dict:
+        return {"rooms": len(self._rooms), "hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def _apply(transcript: RoomTranscript, frame: dict):
+        frame_type = frame.get("type")
+        if frame_type in ("message", "gemini_response"):
+            transcript.add(frame)
+        elif frame_type == "reaction_update":
+            transcript.update_reactions(frame["message_id"], frame.get("reactions") or {})
+        elif frame_type == "message_deleted":
+            transcript.remove(frame["message_id"])
+
+    async def _load(self, room_id: str) -> RoomTranscript:
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(Message)
+                .filter(Message.room_id == room_id, Message.stance != "summary")
+                .order_by(Message.created_at)
+            )
+            messages = result.scalars().all()
+            usernames = {msg.message_id: msg.username for msg in messages}
+            missing_parent_ids = {msg.reply_to_id for msg in messages if msg.reply_to_id and msg.reply_to_id not in usernames}
+            if missing_parent_ids:
+                res_parents = await db.execute(
+                    select(Message.message_id, Message.username).filter(Message.message_id.in_(missing_parent_ids))
+                )
+                usernames.update(dict(res_parents.all()))
+
+        transcript = RoomTranscript()
+        for msg in messages:
+            parent = {"username": usernames[msg.reply_to_id]} if msg.reply_to_id in usernames else None
+            transcript.add(msg.to_dict(parent))
+        return transcript
+
+
+class _SegmentConflict(Exception):
+    pass
+
+
+class TranscriptCompactor:
+    """
+    ローリング要約の区間 (TranscriptSegment) を作る。
+    要約されていない発言が tail_size + segment_size 件以上溜まったら、古い方から segment_size 件を
+    1つの区間に要約する。区間が max_segments を超えたら、古い半分を1つの区間にまとめ直す。
+    要約はバックグラウンドジョブで行い、AI呼び出し側は保存済みの区間と直近の発言だけを使う。
+    複数ワーカーが同時にまとめた場合は (room_id, seq) の一意制約で片方だけが保存される。
+    """
+
+    def __init__(self, session_factory, cache: TranscriptCache, summarize, merge,
+                 tail_size: int = 60, segment_size: int = 40, max_segments: int = 8):
+        self.session_factory = session_factory
+        self.cache = cache
+        self.summarize = summarize
+        self.merge = merge
+        self.tail_size = tail_size
+        self.segment_size = segment_size
+        self.max_segments = max(max_segments, 2)
+        self._running = set()
+        self.counters = {"segments": 0, "merges": 0, "conflicts": 0, "errors": 0}
+
+    async def rolling(self, room_id: str) -> RollingTranscript:
+        transcript = await self.cache.get(room_id)
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(TranscriptSegment).filter_by(room_id=room_id).order_by(TranscriptSegment.seq)
+            )
+            segments = result.scalars().all()
+        # 要約が追いついている間は、区間にまとまる前の発言 (最大 tail_size + segment_size - 1 件) を省略せずに渡す
+        return RollingTranscript(transcript, segments, self.tail_size + self.segment_size - 1)
+
+    def needs_compaction(self, rolling: RollingTranscript) -> bool:
+        if len(rolling.segments) > self.max_segments:
+            return True
+        return len(rolling.transcript.entries_after(rolling.boundary())) >= self.tail_size + self.segment_size
+
+    async def compact(self, room_id: str, topic: str):
+        """要約が追いつくまで区間を作る (同じルームの要約はワーカー内で1つずつ)"""
+        if room_id in self._running:
+            return
+        self._running.add(room_id)
+        try:
+            while True:
+                rolling = await self.rolling(room_id)
+                if len(rolling.segments) > self.max_segments:
+                    saved = await self._merge_oldest(room_id, topic, rolling.segments)
+                else:
+                    raw = rolling.transcript.entries_after(rolling.boundary())
+                    if len(raw) < self.tail_size + self.segment_size:
+                        return
+                    saved = await self._add_segment(room_id, topic, rolling.segments, raw[:self.segment_size])
+                if not saved:
+                    return
+        except Exception as e:
+            self.counters["errors"] += 1
+            print(f"議論ログの要約に失敗しました (Room: {room_id}): {e}")
+        finally:
+            self._running.discard(room_id)
+
+    def stats(self) -> dict:
+        return {**self.counters, "running": len(self._running)}
+
+    async def _add_segment(self, room_id: str, topic: str, segments: list, chunk: list) -> bool:
+        summary = await self.summarize("\n".join(line for _, line in chunk), topic, room_id=room_id)
+        last_entry = chunk[-1][0]
+        segment = TranscriptSegment(
+            room_id=room_id,
+            seq=segments[-1].seq + 1 if segments else 0,
+            level=0,
+            summary=summary,
+            message_count=len(chunk),
+            last_created_at=last_entry["created_at"],
+            last_message_id=last_entry["message_id"],
+        )
+        if not await self._save(room_id, segment):
+            return False
+        self.counters["segments"] += 1
+        print(f"議論ログの区間を要約しました (Room: {room_id}, seq={segment.seq}, {len(chunk)}件)")
+        return True
+
+    async def _merge_oldest(self, room_id: str, topic: str, segments: list) -> bool:
+        # 区間が3つのときも必ず数が減るよう、少なくとも2つをまとめる
+        group = segments[:max(2, len(segments) // 2)]
+        summary = await self.merge([segment.summary for segment in group], topic, room_id=room_id)
+        merged = TranscriptSegment(
+            room_id=room_id,
+            seq=group[0].seq,
+            level=max(segment.level for segment in group) + 1,
+            summary=summary,
+            message_count=sum(segment.message_count for segment in group),
+            last_created_at=group[-1].last_created_at,
+            last_message_id=group[-1].last_message_id,
+        )
+        if not await self._save(room_id, merged, replace_ids=[segment.id for segment in group]):
+            return False
+        self.counters["merges"] += 1
+        print(f"議論ログの要約をまとめ直しました (Room: {room_id}, {len(group)}区間 -> 1区間)")
+        return True
+
+    async def _save(self, room_id: str, segment: TranscriptSegment, replace_ids: list = None) -> bool:
+        try:
+            async with self.session_factory() as db:
+                async with db.begin():
+                    if replace_ids:
+                        result = await db.execute(delete(TranscriptSegment).where(TranscriptSegment.id.in_(replace_ids)))
+                        if result.rowcount != len(replace_ids):
+                            raise _SegmentConflict()
+                    db.add(segment)
+            return True
+        except (IntegrityError, _SegmentConflict):
+            # 他のワーカーが先に同じ区間を保存した (まとめ直した)
+            self.counters["conflicts"] += 1
+            print(f"議論ログの区間は他のワーカーが保存済みです (Room: {room_id})")
+            return False
@@ -0,0 +1,466 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import Message, UploadedFile
+
+# Gemini へのアップロードが終わる前に返す仮の参照 ("pending:<sha256>")
+PENDING_REF_PREFIX = "pending:"
+
+
+class UploadTooLargeError(Exception):
+    """アップロードされたファイルが上限サイズを超えた場合の例外"""
+
+
+def pending_ref(sha256: str) -> str:
+    return f"{PENDING_REF_PREFIX}{sha256}"
+
+
+class UploadStore:
+    """
+    添付ファイルの保存と Gemini へのアップロードを受け持つ。
+    - 受信したファイルはチャンクごとにディスクへ書き出しながら SHA-256 を計算し、上限サイズを超えたら中断する
+    - 同じ内容のファイルが既にあれば、そのファイルと Gemini 上の参照を使い回す (新しいファイルは残さない)
+    - Gemini へのアップロードはワーカーで行い、応答には仮の参照 (pending:<sha256>) を返す
+      AIに渡す直前に resolve() で Gemini のファイルオブジェクトに置き換える (アップロードが終わっていなければ待つ)
+    - Gemini のファイルの情報は有効期限までキャッシュし、期限切れ・削除済みのファイルは再アップロードする
+    """
+
+    def __init__(self, session_factory, upload_dir: str, client_getter, url_prefix: str = "/static/uploads",
+                 max_bytes: int = 20 * 1024 * 1024, chunk_size: int = 1024 * 1024, workers: int = 2,
+                 resolve_timeout: float = 60.0, stale_after: float = 120.0, poll_interval: float = 0.5,
+                 expiry_margin: float = 600.0):
+        self.session_factory = session_factory
+        self.upload_dir = upload_dir
+        self.url_prefix = url_prefix
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.resolve_timeout = resolve_timeout
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.expiry_margin = timedelta(seconds=expiry_margin)
+        self._client_getter = client_getter
+        self._worker_count = workers
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._uploads = {}
+        self._file_cache = {}
+        self._aliases = {}
+        self.counters = {
+            "stored": 0, "deduplicated": 0, "rejected": 0, "uploaded": 0, "upload_failed": 0, "waited": 0,
+            "file_cache_hits": 0, "file_cache_misses": 0, "reuploaded": 0, "unavailable": 0,
+        }
+
+    def start(self):
+        for idx in range(self._worker_count):
+            self._tasks.append(asyncio.create_task(self._worker(idx)))
+
+    async def stop(self):
+        tasks = self._tasks + list(self._uploads.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            **self.counters, "queued": self._queue.qsize(), "uploading": len(self._uploads),
+            "cached_files": len(self._file_cache),
+        }
+
+    # --- 受信 ---
+    async def save(self, upload) -> dict:
+        """UploadFile をディスクに保存し、フロントエンドに返す情報を返す"""
+        extension = os.path.splitext(upload.filename or "")[1]
+        temp_path = os.path.join(self.upload_dir, f".{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, "wb") as out:
+                while True:
+                    chunk = await upload.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        self.counters["rejected"] += 1
+                        raise UploadTooLargeError(f"ファイルサイズが上限 ({self.max_bytes // (1024 * 1024)}MB) を超えています。")
+                    # 書き込みとハッシュ計算はイベントループの外で行う
+                    await asyncio.to_thread(self._write_chunk, out, digest, chunk)
+        except BaseException:
+            self._remove_quietly(temp_path)
+            raise
+
+        sha256 = digest.hexdigest()
+        existing = await self._get(sha256)
+        if existing and os.path.exists(self._path(existing.file_url)):
+            self._remove_quietly(temp_path)
+            self.counters["deduplicated"] += 1
+            if existing.status != "ready" and sha256 not in self._uploads:
+                # 失敗したもの・既存ファイルとして登録しただけのものは、ここでアップロードを依頼する
+                self._enqueue(sha256)
+            return self._response(existing, upload.filename, deduplicated=True)
+
+        file_url = f"{self.url_prefix}/{uuid.uuid4()}{extension}"
+        os.replace(temp_path, self._path(file_url))
+        async with self.session_factory() as db:
+            if existing:
+                # 登録済みだがディスク上のファイルが失われている場合は、今回のファイルで置き換える
+                await db.execute(
+                    update(UploadedFile).where(UploadedFile.sha256 == sha256)
+                    .values(file_url=file_url, size=size, content_type=upload.content_type)
+                )
+            else:
+                await db.execute(
+                    pg_insert(UploadedFile)
+                    .values(sha256=sha256, file_url=file_url, content_type=upload.content_type, size=size, status="pending")
+                    .on_conflict_do_nothing(index_elements=[UploadedFile.sha256])
+                )
+            await db.commit()
+
+        record = await self._get(sha256)
+        if record.file_url != file_url:
+            # 同じ内容のファイルが同時にアップロードされ、先に登録された方を使う
+            self._remove_quietly(self._path(file_url))
+            self.counters["deduplicated"] += 1
+            return self._response(record, upload.filename, deduplicated=True)
+
+        self.counters["stored"] += 1
+        if record.status != "ready":
+            self._enqueue(sha256)
+        return self._response(record, upload.filename, deduplicated=False)
+
+    # --- 参照の解決 ---
+    async def resolve(self, refs) -> list:
+        """
+        AIに渡すファイル参照 (名前・仮の参照) を Gemini のファイルオブジェクトに変換する。
+        キャッシュにないものは並行に問い合わせ、使えなかったファイルは除いて返す (残りのファイルで問い合わせを続ける)。
+        """
+        refs = [ref for ref in dict.fromkeys(refs) if ref]
+        files = await asyncio.gather(*(self._resolve_one(ref) for ref in refs))
+        resolved = {}
+        for file in files:
+            if file is not None:
+                resolved.setdefault(file.name, file)
+        return list(resolved.values())
+
+    async def _resolve_one(self, ref: str):
+        try:
+            if ref.startswith(PENDING_REF_PREFIX):
+                ref = await self._resolve_pending(ref[len(PENDING_REF_PREFIX):])
+                if ref is None:
+                    return None
+            file = await self._file_object(ref)
+        except Exception as e:
+            print(f"添付ファイルの取得でエラーが発生しました ({ref}): {e}")
+            file = None
+        if file is None:
+            self.counters["unavailable"] += 1
+            print(f"添付ファイルを使えないため除外します ({ref})")
+        return file
+
+    async def _file_object(self, ref: str):
+        """ファイルの情報を返す (有効期限が近いもの・取得できないものは再アップロードする)"""
+        ref = self._aliases.get(ref, ref)
+        cached = self._file_cache.get(ref)
+        if cached is not None and self._is_usable(cached):
+            self.counters["file_cache_hits"] += 1
+            return cached
+
+        self.counters["file_cache_misses"] += 1
+        try:
+            file = await self._client_getter().aio.files.get(name=ref)
+            if self._is_usable(file):
+                self._file_cache[ref] = file
+                return file
+            reason = f"有効期限 {file.expiration_time} / 状態 {file.state}"
+        except Exception as e:
+            reason = str(e)
+        self._file_cache.pop(ref, None)
+        return await self._reupload(ref, reason)
+
+    async def _reupload(self, ref: str, reason: str):
+        record = await self._get_by_ref(ref)
+        if record is None:
+            print(f"再アップロードできる元のファイルが見つかりません ({ref}: {reason})")
+            return None
+        if record.status == "ready" and record.gemini_file_ref != ref:
+            # 他のワーカーが再アップロード済み
+            self._aliases[ref] = record.gemini_file_ref
+            return await self._file_object(record.gemini_file_ref)
+
+        print(f"Gemini 上のファイルが使えないため再アップロードします ({ref}: {reason})")
+        new_ref = await self._upload(record.sha256, replacing=ref)
+        if new_ref is None:
+            return None
+        self.counters["reuploaded"] += 1
+        self._aliases[ref] = new_ref
+        return self._file_cache.get(new_ref) or await self._file_object(new_ref)
+
+    def _is_usable(self, file) -> bool:
+        if getattr(file.state, "name", file.state) == "FAILED":
+            return False
+        expiration_time = file.expiration_time
+        return expiration_time is None or expiration_time - self.expiry_margin > datetime.now(timezone.utc)
+
+    async def _resolve_pending(self, sha256: str):
+        deadline = time.monotonic() + self.resolve_timeout
+        waited = False
+        while True:
+            task = self._uploads.get(sha256)
+            if task is not None:
+                self.counters["waited"] += 1
+                try:
+                    return await asyncio.wait_for(asyncio.shield(task), max(deadline - time.monotonic(), 0.1))
+                except asyncio.TimeoutError:
+                    print(f"Gemini へのファイルのアップロードが間に合いませんでした ({sha256[:12]})")
+                    return None
+
+            record = await self._get(sha256)
+            if record is None:
+                return None
+            if record.status == "ready":
+                return record.gemini_file_ref
+            stale = record.updated_at is None or datetime.utcnow() - record.updated_at > timedelta(seconds=self.stale_after)
+            if record.status == "failed" or stale or time.monotonic() >= deadline:
+                # 失敗したもの・担当のワーカーが居なくなったものは、ここでアップロードし直す
+                return await self._upload(sha256)
+            if not waited:
+                self.counters["waited"] += 1
+                waited = True
+            # 他のワーカーがアップロード中
+            await asyncio.sleep(self.poll_interval)
+
+    # --- Gemini へのアップロード ---
+    def _enqueue(self, sha256: str):
+        self._queue.put_nowait(sha256)
+
+    async def _worker(self, idx: int):
+        while True:
+            sha256 = await self._queue.get()
+            try:
+                await self._upload(sha256)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ファイルのアップロードでエラーが発生 (worker {idx}): {e}")
+
+    async def _upload(self, sha256: str, replacing: str = None):
+        """
+        sha256 のファイルを Gemini にアップロードし、参照を返す (このワーカー内では同時に1回だけ)。
+        replacing には期限切れなどで使えなくなった参照を渡す。
+        """
+        task = self._uploads.get(sha256)
+        if task is None:
+            task = asyncio.create_task(self._upload_to_gemini(sha256, replacing))
+            self._uploads[sha256] = task
+            task.add_done_callback(lambda _: self._uploads.pop(sha256, None))
+        return await asyncio.shield(task)
+
+    async def _upload_to_gemini(self, sha256: str, replacing: str = None):
+        record = await self._get(sha256)
+        if record is None:
+            return None
+        if record.status == "ready" and (replacing is None or record.gemini_file_ref != replacing):
+            return record.gemini_file_ref
+
+        started_at = time.perf_counter()
+        try:
+            config = {"mime_type": record.content_type} if record.content_type else None
+            uploaded = await self._client_getter().aio.files.upload(file=self._path(record.file_url), config=config)
+        except Exception as e:
+            self.counters["upload_failed"] += 1
+            print(f"Gemini へのファイルのアップロードに失敗しました ({record.file_url}): {e}")
+            async with self.session_factory() as db:
+                await db.execute(
+                    update(UploadedFile).where(UploadedFile.sha256 == sha256).values(status="failed", error=str(e))
+                )
+                await db.commit()
+            return None
+
+        async with self.session_factory() as db:
+            await db.execute(
+                update(UploadedFile).where(UploadedFile.sha256 == sha256)
+                .values(status="ready", gemini_file_ref=uploaded.name, error=None)
+            )
+            # 仮の参照のまま保存されたメッセージを本来の参照に置き換える
+            await db.execute(
+                update(Message).where(Message.gemini_file_ref == pending_ref(sha256)).values(gemini_file_ref=uploaded.name)
+            )
+            await db.commit()
+        self._file_cache[uploaded.name] = uploaded
+        self.counters["uploaded"] += 1
+        print(f"Completed upload. File name: {uploaded.name} ({(time.perf_counter() - started_at) * 1000:.0f}ms)")
+        return uploaded.name
+
+    # --- 既存ファイル・ルーム削除 ---
+    async def index_existing(self):
+        """
+        以前から upload_dir にあるファイルを uploaded_files に登録する。
+        同じ内容のファイルが複数ある場合は1つだけを登録し、以降のアップロードはそのファイルにまとめる。
+        """
+        async with self.session_factory() as db:
+            known_urls = set((await db.execute(select(UploadedFile.file_url))).scalars().all())
+            result = await db.execute(
+                select(Message.file_url, Message.gemini_file_ref)
+                .where(Message.file_url.is_not(None), Message.gemini_file_ref.is_not(None))
+            )
+            refs_by_url = {}
+            for file_url, ref in result.all():
+                if not ref.startswith(PENDING_REF_PREFIX):
+                    refs_by_url.setdefault(file_url, ref)
+
+        names = []
+        for name in os.listdir(self.upload_dir):
+            if name.startswith("."):
+                # 中断されたアップロードの一時ファイル (受信中のものを消さないよう、古いものだけ)
+                path = os.path.join(self.upload_dir, name)
+                if name.endswith(".part") and time.time() - os.path.getmtime(path) > 3600:
+                    self._remove_quietly(path)
+                continue
+            if f"{self.url_prefix}/{name}" not in known_urls:
+                names.append(name)
+        # Gemini 上の参照を持つファイルを優先して登録する
+        names.sort(key=lambda name: (f"{self.url_prefix}/{name}" not in refs_by_url, name))
+
+        indexed = 0
+        for name in names:
+            file_url = f"{self.url_prefix}/{name}"
+            sha256, size = await asyncio.to_thread(self._hash_file, self._path(file_url))
+            ref = refs_by_url.get(file_url)
+            async with self.session_factory() as db:
+                result = await db.execute(
+                    pg_insert(UploadedFile)
+                    .values(
+                        sha256=sha256, file_url=file_url, content_type=mimetypes.guess_type(name)[0], size=size,
+                        gemini_file_ref=ref, status="ready" if ref else "pending",
+                    )
+                    .on_conflict_do_nothing(index_elements=[UploadedFile.sha256])
+                )
+                await db.commit()
+            indexed += result.rowcount or 0
+        if names:
+            print(f"既存のアップロードファイルを登録しました ({indexed}件 / {len(names)}件中、残りは内容が重複)")
+
+    async def delete_room_files(self, room_id: str):
+        """ルームの削除前に、他のルームから参照されていない Gemini 上のファイルを削除する"""
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(Message.file_url, Message.gemini_file_ref)
+                .where(Message.room_id == room_id, or_(Message.file_url.is_not(None), Message.gemini_file_ref.is_not(None)))
+            )
+            own = result.all()
+            if not own:
+                return
+            urls = {file_url for file_url, _ in own if file_url}
+            refs = {ref for _, ref in own if ref and not ref.startswith(PENDING_REF_PREFIX)}
+            records = (await db.execute(select(UploadedFile).where(UploadedFile.file_url.in_(urls)))).scalars().all()
+            refs.update(record.gemini_file_ref for record in records if record.gemini_file_ref)
+
+            # 同じファイルを他のルームが使っている場合は残す
+            result = await db.execute(
+                select(Message.file_url, Message.gemini_file_ref)
+                .where(Message.room_id != room_id, or_(Message.file_url.in_(urls), Message.gemini_file_ref.in_(refs)))
+            )
+            shared = result.all()
+            shared_urls = {file_url for file_url, _ in shared}
+            shared_refs = {ref for _, ref in shared}
+            shared_refs.update(record.gemini_file_ref for record in records if record.file_url in shared_urls)
+
+            unused = [record.sha256 for record in records if record.file_url not in shared_urls]
+            if unused:
+                # 削除した Gemini 上のファイルを、以降のアップロードで使い回さないようにする
+                await db.execute(delete(UploadedFile).where(UploadedFile.sha256.in_(unused)))
+                await db.commit()
+
+        to_delete = refs - shared_refs
+        if not to_delete:
+            return
+        print(f"Deleting {len(to_delete)} files from Gemini...")
+        client = self._client_getter()
+        for ref in to_delete:
+            self._file_cache.pop(ref, None)
+            try:
+                await client.aio.files.delete(name=ref)
+                print(f"Deleted Gemini file: {ref}")
+            except Exception as e:
+                print(f"Failed to delete file {ref}: {e}")
+
+    # --- 内部 ---
+    async def _get(self, sha256: str):
+        async with self.session_factory() as db:
+            return await db.get(UploadedFile, sha256)
+
+    async def _get_by_ref(self, ref: str):
+        """Gemini 上の参照から、元のファイルの行を探す (メッセージの file_url からも探す)"""
+        async with self.session_factory() as db:
+            result = await db.execute(select(UploadedFile).where(UploadedFile.gemini_file_ref == ref))
+            record = result.scalars().first()
+            if record is not None:
+                return record
+            # 再アップロード後もメッセージは元の参照のままなので、添付ファイルの file_url からたどる
+            result = await db.execute(
+                select(Message.file_url).where(Message.gemini_file_ref == ref, Message.file_url.is_not(None)).limit(1)
+            )
+            file_url = result.scalar()
+            if file_url is None:
+                return None
+            result = await db.execute(select(UploadedFile).where(UploadedFile.file_url == file_url))
+            record = result.scalars().first()
+            if record is not None or not os.path.exists(self._path(file_url)):
+                return record
+
+        # uploaded_files に未登録の古いファイル
+        sha256, size = await asyncio.to_thread(self._hash_file, self._path(file_url))
+        async with self.session_factory() as db:
+            await db.execute(
+                pg_insert(UploadedFile)
+                .values(
+                    sha256=sha256, file_url=file_url, content_type=mimetypes.guess_type(file_url)[0], size=size,
+                    gemini_file_ref=ref, status="ready",
+                )
+                .on_conflict_do_nothing(index_elements=[UploadedFile.sha256])
+            )
+            await db.commit()
+        return await self._get(sha256)
+
+    def _path(self, file_url: str) -> str:
+        return os.path.join(self.upload_dir, os.path.basename(file_url))
+
+    @staticmethod
+    def _write_chunk(out, digest, chunk: bytes):
+        digest.update(chunk)
+        out.write(chunk)
+
+    def _hash_file(self, path: str):
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            while chunk := f.read(self.chunk_size):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    @staticmethod
+    def _response(record: UploadedFile, original_filename: str, deduplicated: bool) -> dict:
+        return {
+            "file_url": record.file_url,
+            "original_filename": original_filename,
+            "gemini_file_ref": record.gemini_file_ref if record.status == "ready" else pending_ref(record.sha256),
+            "upload_status": record.status,
+            "deduplicated": deduplicated,
+        }
+
+    @staticmethod
+    def _remove_quietly(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
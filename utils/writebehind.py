@@ -0,0 +1,205 @@
+import asyncio
+import os
+import socket
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from models import Room
+from .dbmetrics import query_site
+
+
+class WriteBehindJournal:
+    """
+    頻繁に起きるルームの変更 (ノート・提案フォームの編集、リアクション) を Postgres にまとめて書き込むための記録 (Redis Stream)。
+    - 変更は Redis 上の状態に適用して即座に配信し、同時に (同じ Lua スクリプトの中で) この Stream に1件追記する
+    - flush_interval 秒ごと (またはルームの終了・最後の参加者の退出時) に、溜まった記録を種類ごとのハンドラに渡し、
+      1つのトランザクションで Postgres に反映してから XACK する
+    - 反映の途中でワーカーが落ちた場合、確認 (XACK) されていない記録は claim_idle 秒後に他のワーカーが引き継ぐ
+      (少なくとも1回は配送される。max_deliveries 回失敗した記録は dead_key の Stream に移す)
+    - claim(db, entries) を渡すと、ハンドラの前に同じトランザクションで呼び、反映済みの記録を除いたものだけを
+      ハンドラに渡す。再配送された記録で活動カウンタなどを二重に加算しないためのもの
+    - on_applied() を渡すと、ハンドラに渡した記録があったバッチのコミット後に呼ぶ
+    """
+
+    def __init__(self, session_factory, flush_interval: float = 5.0, batch_size: int = 500,
+                 claim_idle: float = 30.0, max_deliveries: int = 5,
+                 stream_key: str = "writebehind:journal", group: str = "flushers", claim=None, on_applied=None):
+        self.session_factory = session_factory
+        self.claim = claim
+        self.on_applied = on_applied
+        self.redis = None
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self.stream_key = stream_key
+        self.dead_key = f"{stream_key}:dead"
+        self.group = group
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._handlers = {}
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self.counters = {"flushed": 0, "batches": 0, "failures": 0, "claimed": 0, "dead": 0}
+
+    def attach_redis(self, redis_client):
+        self.redis = redis_client
+
+    def register(self, kind: str, handler):
+        """
+        kind の記録を反映するハンドラ handler(db, entries) を登録する (entries は記録の辞書のリストで、
+        "entry_id" に Stream のIDを持つ)。同じ kind に複数登録した場合は登録順に同じトランザクションで呼ぶ
+        """
+        self._handlers.setdefault(kind, []).append(handler)
+
+    async def start(self):
+        if self.redis:
+            try:
+                await self.redis.xgroup_create(self.stream_key, self.group, id="0", mkstream=True)
+            except Exception as e:
+                # 既にグループがある (BUSYGROUP) 場合はそのまま使う
+                if "BUSYGROUP" not in str(e):
+                    raise
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # 終了前に溜まっている記録を反映する
+        if self.redis:
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"変更の記録を保存できませんでした: {e}")
+
+    async def append(self, kind: str, room_id: str, **fields):
+        """Lua スクリプトを通さない変更を記録する"""
+        await self.redis.xadd(self.stream_key, {"kind": kind, "room_id": room_id, **fields})
+
+    def wake(self):
+        """次の間隔を待たずに反映させる (ルームが空いた・終了した場合)"""
+        self._wakeup.set()
+
+    async def flush(self):
+        """溜まっている記録をすべて反映する"""
+        if not self.redis:
+            return
+        # 呼び出し元 (定期反映・議事録の作成など) に関係なく、反映のクエリは "write_behind" として集計する
+        with query_site("write_behind"):
+            async with self._flush_lock:
+                # 落ちたワーカーが確認しないまま残した記録を引き継ぐ
+                _, claimed, *_ = await self.redis.xautoclaim(
+                    self.stream_key, self.group, self.consumer,
+                    min_idle_time=int(self.claim_idle * 1000), start_id="0-0", count=self.batch_size,
+                )
+                if claimed:
+                    self.counters["claimed"] += len(claimed)
+                    await self._apply(claimed, retried=True)
+                while True:
+                    response = await self.redis.xreadgroup(
+                        self.group, self.consumer, {self.stream_key: ">"}, count=self.batch_size
+                    )
+                    entries = response[0][1] if response else []
+                    if not entries:
+                        break
+                    await self._apply(entries)
+                    if len(entries) < self.batch_size:
+                        break
+
+    async def _apply(self, entries, retried: bool = False):
+        """記録をまとめて1つのトランザクションで反映し、成功したら確認して Stream から消す"""
+        if retried:
+            entries = await self._drop_dead(entries)
+        if not entries:
+            return
+        try:
+            async with self.session_factory() as db:
+                # 反映する前に削除されたルームの記録は捨てる
+                room_ids = {fields.get("room_id") for _, fields in entries}
+                result = await db.execute(select(Room.room_id).where(Room.room_id.in_(room_ids)))
+                existing = set(result.scalars().all())
+                items = [
+                    {**fields, "entry_id": entry_id} for entry_id, fields in entries
+                    if fields.get("room_id") in existing
+                ]
+                if self.claim and items:
+                    # 前回コミットしたが確認 (XACK) する前に落ちた記録は、もう一度反映しない
+                    items = await self.claim(db, items)
+                grouped = OrderedDict()
+                for item in items:
+                    grouped.setdefault(item.get("kind"), []).append(item)
+                applied = bool(grouped)
+                for kind, items in grouped.items():
+                    handlers = self._handlers.get(kind)
+                    if handlers:
+                        for handler in handlers:
+                            await handler(db, items)
+                    else:
+                        print(f"変更の記録の種類 '{kind}' に対応するハンドラがありません。")
+                await db.commit()
+        except Exception as e:
+            self.counters["failures"] += 1
+            print(f"変更の記録をDBに反映できませんでした ({len(entries)}件): {e}")
+            if retried and len(entries) > 1:
+                # 再試行でも失敗する場合は1件ずつ反映し、原因の記録だけを残す
+                for entry in entries:
+                    await self._apply([entry])
+            # 確認しないまま残し、claim_idle 秒後に再試行する
+            return
+        ids = [entry_id for entry_id, _ in entries]
+        if ids:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.xack(self.stream_key, self.group, *ids)
+                pipe.xdel(self.stream_key, *ids)
+                await pipe.execute()
+        self.counters["flushed"] += len(ids)
+        self.counters["batches"] += 1
+        if applied and self.on_applied:
+            await self.on_applied()
+
+    async def _drop_dead(self, entries):
+        """何度反映しても失敗する記録は別の Stream に移し、他の記録の反映を妨げないようにする"""
+        pending = await self.redis.xpending_range(
+            self.stream_key, self.group, min=entries[0][0], max=entries[-1][0], count=len(entries)
+        )
+        deliveries = {item["message_id"]: item["times_delivered"] for item in pending}
+        alive = []
+        for entry_id, fields in entries:
+            if deliveries.get(entry_id, 0) > self.max_deliveries:
+                self.counters["dead"] += 1
+                print(f"変更の記録 {entry_id} の反映を諦めました: {fields}")
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.xadd(self.dead_key, fields)
+                    pipe.xack(self.stream_key, self.group, entry_id)
+                    pipe.xdel(self.stream_key, entry_id)
+                    await pipe.execute()
+            else:
+                alive.append((entry_id, fields))
+        return alive
+
+    async def stats(self) -> dict:
+        stats = dict(self.counters)
+        if self.redis:
+            try:
+                stats["backlog"] = await self.redis.xlen(self.stream_key)
+            except Exception:
+                pass
+        return stats
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"変更の記録の定期反映でエラーが発生しました: {e}")